@@ -18,7 +18,7 @@ async def ask_critic(text: str, logger: logging.Logger) -> bool:
     prompt = ("Оцени полноту и корректность ответа по ИБ одним числом 0-1.\n"
               "Только число, без объяснений.\n\n" + text)
     logger.info(f"Asking critic for text: '{text[:100]}...'")
-    raw, _ = await call_llm("gpt-4.1-mini", prompt, temperature=0.0)
+    raw, _ = await call_llm("gpt-4.1-mini", prompt, temperature=0.0, site="critic")
     score = _score_to_float(raw)
     logger.info(f"Critic returned score: {score} (raw: '{raw.strip()}')")
     if score is None:
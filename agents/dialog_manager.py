@@ -1,10 +1,11 @@
-import re, logging, json
-from backend.openai_helpers import call_llm
+import re, logging, json, random, time, asyncio
+from backend.openai_helpers import call_llm, stream_llm
 from backend.memory import get_mem, save_mem
 # from agents.slot_extractor import extract_slots # not used
 from agents.dm_critic import ask_dm_critic
 from backend.agents.kb_search import kb_search
-from backend import status_bus
+from backend import status_bus, config, deadline, metrics, model_router
+from agents import intent_fastpath
 
 
 _SMALL_TALK_PROMPT = """
@@ -34,8 +35,48 @@ intent:
 """
 _INT_MATCH = re.compile(r'"intent"\s*:\s*"([^"]+)"\s*,\s*"conf"\s*:\s*([\d.]+)')
 
+_INTENT_MODEL = "o3-mini"
+_shadow_tasks: set[asyncio.Task] = set()
+
 async def _classify_intent(q:str, slots:dict)->tuple[str,float]:
-    raw,_ = await call_llm("o3-mini", _INTENT_PROMPT.format(q=q, slots=json.dumps(slots)), temperature=0)
+    """
+    Сначала локальный классификатор (правила + центроиды); LLM — только ниже порога уверенности.
+    Часть локальных решений (INTENT_FASTPATH_SHADOW_RATE) перепроверяется LLM в фоне для метрики согласия.
+    """
+    cfg = config.config
+    if str(cfg.INTENT_FASTPATH_ENABLED) in ("0", "false", "False"):
+        return await _classify_intent_llm(q, slots)
+
+    t0 = time.monotonic()
+    local = await intent_fastpath.classify(q)
+    if local and local.conf >= float(cfg.INTENT_FASTPATH_THRESHOLD):
+        metrics.INTENT_FASTPATH.labels(source=local.source).inc()
+        if (p50 := model_router.stats[_INTENT_MODEL].quantile(0.5)) is not None:
+            metrics.INTENT_TIME_SAVED.inc(max(0.0, p50 - (time.monotonic() - t0)))
+        if random.random() < float(cfg.INTENT_FASTPATH_SHADOW_RATE):
+            task = asyncio.create_task(_shadow_check(q, slots, local.intent))
+            _shadow_tasks.add(task)
+            task.add_done_callback(_shadow_tasks.discard)
+        return local.intent, local.conf
+
+    intent, conf = await _classify_intent_llm(q, slots)
+    metrics.INTENT_FASTPATH.labels(source="llm").inc()
+    if local:
+        metrics.INTENT_AGREEMENT.labels(result="agree" if local.intent == intent else "disagree").inc()
+    return intent, conf
+
+async def _shadow_check(q: str, slots: dict, local_intent: str):
+    try:
+        intent, _ = await _classify_intent_llm(q, slots)
+    except Exception as e:
+        logging.debug(f"Intent shadow check failed: {e!r}")
+        return
+    metrics.INTENT_AGREEMENT.labels(result="agree" if intent == local_intent else "disagree").inc()
+
+async def _classify_intent_llm(q:str, slots:dict)->tuple[str,float]:
+    # o3-mini недетерминирован, но метка интента для той же фразы и слотов допустима из кеша
+    raw,_ = await call_llm(_INTENT_MODEL, _INTENT_PROMPT.format(q=q, slots=json.dumps(slots)), temperature=0,
+                           site="intent", cache=True)
     m=_INT_MATCH.search(raw)
     if not m:
         logging.warning("Intent-parse fail: %s", raw.strip()[:120])
@@ -43,21 +84,78 @@ async def _classify_intent(q:str, slots:dict)->tuple[str,float]:
     return m.group(1), float(m.group(2))
 
 
+async def _kb_search_timed(q: str):
+    """kb_search и момент его завершения — чтобы посчитать, сколько он перекрылся с классификацией."""
+    return await kb_search(q), time.monotonic()
+
+def _speculate_kb(q: str) -> tuple[asyncio.Task, float] | None:
+    """
+    Запуск kb_search (эмбеддинг + поиск в Qdrant) до того, как известен интент.
+    Не запускается, если интент даёт правило fast-path: классификация мгновенна, перекрывать нечего,
+    а запрос эмбеддинга приветствия отменить нельзя — future пула под shield.
+    """
+    cfg = config.config
+    if str(cfg.KB_SPECULATIVE) in ("0", "false", "False"):
+        return None
+    if str(cfg.INTENT_FASTPATH_ENABLED) not in ("0", "false", "False") and intent_fastpath.classify_rules(q):
+        return None
+    return asyncio.create_task(_kb_search_timed(q)), time.monotonic()
+
+def _drop_speculation(spec: tuple[asyncio.Task, float] | None):
+    """Интент не требует поиска: отменяем задачу и списываем её время в wasted."""
+    if spec is None:
+        return
+    task, started = spec
+    if not task.done():
+        task.cancel()
+        finished = time.monotonic()
+    elif task.cancelled() or task.exception() is not None:
+        finished = time.monotonic()
+    else:
+        finished = task.result()[1]
+    metrics.KB_SPECULATION.labels(result="cancelled").inc()
+    metrics.KB_SPECULATION_SECONDS.labels(kind="wasted").inc(max(0.0, finished - started))
+
+async def _await_speculation(spec: tuple[asyncio.Task, float], classified_at: float):
+    task, started = spec
+    result, finished = await task
+    metrics.KB_SPECULATION.labels(result="used").inc()
+    metrics.KB_SPECULATION_SECONDS.labels(kind="saved").inc(max(0.0, min(finished, classified_at) - started))
+    return result
+
+
 async def handle_message(thread_id: str, user_q: str, slots: dict, logger: logging.Logger):
+    # Бюджет всего хода: вложенные вызовы LLM и эмбеддингов берут таймауты из остатка
+    with deadline.budget(config.config.TURN_BUDGET_SEC):
+        return await _handle_message(thread_id, user_q, slots, logger)
+
+
+async def _handle_message(thread_id: str, user_q: str, slots: dict, logger: logging.Logger):
     await status_bus.publish(thread_id, "thinking", None)
     logger.info(f"Classifying intent for: '{user_q}'")
-    intent, conf = await _classify_intent(user_q, slots)
+    # Поиск по базе нужен большинству ходов — стартуем его, не дожидаясь интента
+    spec = _speculate_kb(user_q)
+    try:
+        intent, conf = await _classify_intent(user_q, slots)
+    except BaseException:
+        _drop_speculation(spec)
+        raise
+    classified_at = time.monotonic()
     logger.info(f"Intent classified as '{intent}' with confidence {conf:.2f}")
 
     if intent == "small_talk":
+        _drop_speculation(spec)
         logger.info("Handling as small_talk.")
-        raw_response, _ = await call_llm("o3-mini", _SMALL_TALK_PROMPT.format(q=user_q), temperature=0.5)
+        # Ответ стримится клиенту по мере генерации; финальное сообщение ниже его заменяет
+        raw_response, _ = await stream_llm("o3-mini", _SMALL_TALK_PROMPT.format(q=user_q), temperature=0.5,
+                                           site="small_talk")
         return {"type":"chat","role":"assistant",
                 "content": raw_response.strip()}
 
     if intent == "file":
         if (key := slots.get("file_key")):
             from backend.agents.file_retrieval import get_file_link
+            _drop_speculation(spec)
             logger.info(f"Handling as file request for key: {key}")
             return await get_file_link(key)
         else: # fallback to planner
@@ -68,7 +166,7 @@ async def handle_message(thread_id: str, user_q: str, slots: dict, logger: loggi
     # then planner if needed
     await status_bus.publish(thread_id, "searching", "local KB")
     logger.info("Вызываем kb_search для поиска в базе знаний.")
-    status, ctx = await kb_search(user_q)
+    status, ctx = await (_await_speculation(spec, classified_at) if spec else kb_search(user_q))
     
     if status == "reuse":
         logger.info("kb_search нашел готовый ответ. Возвращаем его.")
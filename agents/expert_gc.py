@@ -3,7 +3,7 @@ Expert Group Chat - системные промпты для экспертно
 Включает эксперта, критика и поисковика для глубокого анализа сложных вопросов
 """
 
-from backend.agents.local_search import local_search
+from backend.agents.local_search import local_search_async
 from backend.openai_helpers import call_llm
 import json
 import re
@@ -163,8 +163,8 @@ class SearchAgent:
             else:
                 search_query = query
             
-            # Выполняем поиск в Qdrant
-            results = local_search(search_query, top_k=top_k)
+            # Тот же путь, что у Expert-GC backend: эмбеддинг из общего пула, Qdrant — в потоке
+            results = await local_search_async(search_query, top_k=top_k)
             
             # Форматируем результаты согласно системному промпту
             formatted_results = []
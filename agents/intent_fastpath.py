@@ -0,0 +1,138 @@
+"""
+Локальный первый этап классификации интента: regex-правила и ближайший центроид
+по эмбеддингам примеров. Если уверенность ниже INTENT_FASTPATH_THRESHOLD,
+dialog_manager спрашивает LLM-классификатор.
+"""
+import asyncio
+import logging
+import re
+from dataclasses import dataclass
+
+import numpy as np
+
+from backend import config, embedding_pool
+
+INTENTS = ("small_talk", "file", "kb_search", "request")
+
+# Правила: (интент, уверенность, шаблон). small_talk — только если реплика целиком из вежливых слов
+_RULES = [
+    ("small_talk", 0.97, re.compile(
+        r"^\W*(?:(?:привет(?:ствую)?|здравствуй(?:те)?|добр(?:ый|ое|ой)\s+(?:день|вечер|утро|ночи)|"
+        r"спасибо(?:\s+большое)?|благодарю|пока|до\s+свидания|извин(?:и|ите)|прошу\s+прощения|"
+        r"hi|hello|thanks?|thank\s+you)\W*)+$", re.IGNORECASE)),
+    # file — формат файла или просьба прислать/скачать документ, а не упоминание файлов в вопросе
+    ("file", 0.92, re.compile(
+        r"\b(?:pdf|docx?|xlsx?)\b|"
+        r"(?:пришли|дай|скинь|отправь|скача\w*|нуж(?:ен|на|но))\W+(?:\w+\W+){0,3}?"
+        r"(?:чек-?лист|шаблон|файл|документ|опросник)\w*", re.IGNORECASE)),
+    ("kb_search", 0.9, re.compile(
+        r"(?:у\s+тебя\s+же\s+было|ранее\s+(?:обсуждали|отвечал\w*|спрашивал\w*)|"
+        r"как\s+в\s+прошлый\s+раз|мы\s+уже\s+(?:обсуждали|решали)|напомни\w*)", re.IGNORECASE)),
+]
+
+# Примеры для центроидов: эмбеддинги считаются один раз через пул (и кешируются в Redis/LRU)
+INTENT_EXAMPLES = {
+    "small_talk": [
+        "Привет!", "Добрый день", "Спасибо за помощь", "Благодарю, всё понятно",
+        "Извините за беспокойство", "До свидания", "Как дела?", "Отлично, спасибо",
+    ],
+    "file": [
+        "Пришли PDF с политикой ИБ", "Нужен чек-лист аудита", "Дай шаблон модели угроз",
+        "Скачать опросник по DLP", "Есть документ с регламентом инцидентов?",
+        "Можно файл с требованиями 152-ФЗ?",
+    ],
+    "kb_search": [
+        "У тебя же было про настройку SIEM", "Мы уже обсуждали выбор DLP, напомни",
+        "Как в прошлый раз отвечал про MFA?", "Ранее был ответ про резервное копирование",
+        "Напомни, что ты советовал по сегментации сети",
+    ],
+    "request": [
+        "Как построить процесс управления уязвимостями?", "Сравни EDR и XDR для банка",
+        "Какие меры защиты нужны для КИИ?", "Как настроить DLP для контроля почты?",
+        "Оцени риски перехода в облако", "Что требует ГОСТ Р 57580 для сегментации?",
+    ],
+}
+
+
+@dataclass
+class IntentGuess:
+    intent: str
+    conf: float
+    source: str  # rule | centroid
+
+
+def classify_rules(q: str) -> IntentGuess | None:
+    for intent, conf, pattern in _RULES:
+        if pattern.search(q):
+            return IntentGuess(intent, conf, "rule")
+    return None
+
+
+_centroids: np.ndarray | None = None
+_centroid_task: asyncio.Task | None = None
+
+
+async def _build_centroids() -> np.ndarray:
+    """Матрица (len(INTENTS), dim) нормированных центроидов примеров."""
+    global _centroids
+    rows = []
+    for intent in INTENTS:
+        vectors = await asyncio.gather(*(embedding_pool.get_embedding_async(t) for t in INTENT_EXAMPLES[intent]))
+        mean = np.asarray(vectors, dtype=np.float32).mean(axis=0)
+        rows.append(mean / (np.linalg.norm(mean) or 1.0))
+    _centroids = np.stack(rows)
+    return _centroids
+
+
+def warm_up() -> asyncio.Task:
+    """
+    Построение центроидов в фоне (lifespan приложения). Одна задача на процесс:
+    повторный вызов возвращает её же; упавшая или из другого loop'а перезапускается.
+    """
+    global _centroid_task
+    task = _centroid_task
+    if task is None or task.get_loop() is not asyncio.get_running_loop() or \
+            (task.done() and (task.cancelled() or task.exception() is not None)):
+        _centroid_task = asyncio.create_task(_build_centroids())
+        _centroid_task.add_done_callback(_log_build_failure)
+    return _centroid_task
+
+
+def _log_build_failure(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()) is not None:
+        logging.warning(f"Intent fast path: centroid build failed ({e!r}), will retry on next turn")
+
+
+async def _get_centroids(timeout: float) -> np.ndarray:
+    """Готовые центроиды или ожидание фоновой сборки не дольше timeout (сборка при этом продолжается)."""
+    if _centroids is not None:
+        return _centroids
+    return await asyncio.wait_for(asyncio.shield(warm_up()), timeout)
+
+
+def _softmax_conf(scores: np.ndarray, temperature: float) -> tuple[int, float]:
+    """Индекс лучшего центроида и его вероятность по softmax от косинусов."""
+    z = (scores - scores.max()) / temperature
+    probs = np.exp(z) / np.exp(z).sum()
+    best = int(probs.argmax())
+    return best, float(probs[best])
+
+
+async def classify_centroid(q: str) -> IntentGuess | None:
+    cfg = config.config
+    timeout = float(cfg.INTENT_FASTPATH_TIMEOUT_SEC)
+    try:
+        # Холодный старт не задерживает ход: пока центроидов нет, решает LLM
+        centroids = await _get_centroids(timeout)
+        vec = np.asarray(await embedding_pool.get_embedding_async(q, timeout=timeout), dtype=np.float32)
+    except Exception as e:
+        logging.warning(f"Intent fast path: embedding unavailable ({e!r}), falling back to LLM")
+        return None
+    scores = centroids @ (vec / (np.linalg.norm(vec) or 1.0))
+    best, conf = _softmax_conf(scores, float(cfg.INTENT_FASTPATH_TEMPERATURE))
+    return IntentGuess(INTENTS[best], conf, "centroid")
+
+
+async def classify(q: str) -> IntentGuess | None:
+    """Правило, если сработало; иначе ближайший центроид. None — локально не определить."""
+    return classify_rules(q) or await classify_centroid(q)
@@ -14,7 +14,8 @@ async def ask_critic(text: str) -> bool:
     )
     
     # Используем o3-mini как быструю и дешевую модель для оценки
-    score_raw, _ = await call_llm("o3-mini", prompt)
+    # o3-mini по temperature не кешируется; оценка того же текста допустима из кеша (TTL critic)
+    score_raw, _ = await call_llm("o3-mini", prompt, site="critic", cache=True)
     
     try:
         # Убираем лишние символы и преобразуем в float
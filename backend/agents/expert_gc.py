@@ -5,12 +5,64 @@ except ImportError:
 
 import asyncio
 import json
-from backend.agents.local_search import local_search
+import threading
+import time
+from backend.agents.local_search import local_search_async
 from backend.agents.web_search import web_search
 from backend.prompts.system_messages import SYSTEM_EXPERT_TEMPLATE, SYSTEM_GENERAL_EXPERT, SYSTEM_AGGREGATOR
-from backend import status_bus, config, metrics
+from backend import status_bus, config, metrics, model_router, token_budget
+from backend.openai_helpers import _log_api_usage
 import logging
 
+# --- Учёт токенов агентов ---
+
+class _AgentMeter:
+    """
+    Агенты autogen ходят в OpenAI своим синхронным клиентом в потоке executor'а, минуя call_llm.
+    Метр оборачивает client.create: задержки и ошибки идут в окно model_router.stats модели агента
+    (иначе route("expert"/"search"/…) не видит деградации), usage ответов копится и перед каждым
+    ответом агента (раундом группы) списывается с бюджета хода, затем вызывается token_budget.enforce().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = []  # (usage, model, latency_ms) из потока executor'а
+
+    def attach(self, agent):
+        client = agent.client
+        if client is None:
+            return
+        model = agent.llm_config.get("model")
+        create = client.create
+
+        def metered_create(**params):
+            t0 = time.monotonic()
+            try:
+                response = create(**params)
+            except Exception:
+                model_router.stats[model].add_error()
+                raise
+            seconds = time.monotonic() - t0
+            model_router.stats[model].add(seconds)
+            with self._lock:
+                self._pending.append((getattr(response, "usage", None), model, int(seconds * 1000)))
+            return response
+
+        client.create = metered_create
+        agent.register_reply([autogen.Agent, None], self._before_reply)
+
+    async def settle(self):
+        """Списывает накопленное: в контексте хода, где доступны current_turn и бюджет."""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for rsp_usage, model, latency_ms in pending:
+            await _log_api_usage(rsp_usage, model, latency_ms, None, None)
+
+    async def _before_reply(self, recipient, messages=None, sender=None, config=None):
+        await self.settle()
+        await token_budget.enforce()
+        return False, None
+
 # --- Фабрика для создания доменных экспертов ---
 
 def create_domain_expert(slots: dict) -> "autogen.AssistantAgent":
@@ -28,7 +80,7 @@ def create_domain_expert(slots: dict) -> "autogen.AssistantAgent":
     
     return autogen.AssistantAgent(
         name,
-        llm_config={"model": config.MODEL_GPT4}, # Используем модель из конфига
+        llm_config={"model": model_router.route("expert", config.MODEL_GPT4)}, # Модель из конфига через роутер
         system_message=system_message
     )
 
@@ -50,9 +102,13 @@ async def run_expert_gc(thread_id, user_q, slots, plan, logger: logging.Logger):
     try:
         domain_expert = create_domain_expert(slots)
         # Для Search и Critic можно использовать более простые модели
-        search_agent = autogen.AssistantAgent("Search_Tool", llm_config={"model": config.MODEL_O3_MINI})
-        critic_agent = autogen.AssistantAgent("Critic", llm_config={"model": config.MODEL_GPT4_MINI})
-        aggregator_agent = autogen.AssistantAgent("Aggregator", llm_config={"model": config.MODEL_GPT4_MINI}, system_message=SYSTEM_AGGREGATOR)
+        search_agent = autogen.AssistantAgent("Search_Tool", llm_config={"model": model_router.route("search", config.MODEL_O3_MINI)})
+        critic_agent = autogen.AssistantAgent("Critic", llm_config={"model": model_router.route("critic", config.MODEL_GPT4_MINI)})
+        aggregator_agent = autogen.AssistantAgent("Aggregator", llm_config={"model": model_router.route("aggregate", config.MODEL_GPT4_MINI)},
+                                                  system_message=SYSTEM_AGGREGATOR)
+        meter = _AgentMeter()
+        for agent in (domain_expert, search_agent, critic_agent, aggregator_agent):
+            meter.attach(agent)
         logger.info(f"Агенты созданы. Эксперт: {domain_expert.name}")
     except Exception as e:
         logger.error(f"Ошибка при создании агентов: {e}", exc_info=True)
@@ -62,11 +118,11 @@ async def run_expert_gc(thread_id, user_q, slots, plan, logger: logging.Logger):
     # 2. Регистрация инструментов
     citations = []
     citation_counter = 1
-    def _search_tool(prompt: str) -> str:
+    async def _search_tool(prompt: str) -> str:
         nonlocal citations, citation_counter
         logger.info(f"Инструмент поиска вызван с запросом: '{prompt}'")
-        # ... (логика поиска остается прежней, но можно ее вынести в отдельную функцию)
-        hits = local_search(prompt, top_k=7)
+        # Асинхронный поиск: эмбеддинг и Qdrant не блокируют event loop во время группового чата
+        hits = await local_search_async(prompt, top_k=7)
         if not hits:
             return "В базе знаний ничего не найдено."
         
@@ -120,8 +176,10 @@ async def run_expert_gc(thread_id, user_q, slots, plan, logger: logging.Logger):
     
     mgr = autogen.GroupChatManager(
         groupchat=gc,
-        llm_config={"model": config.MODEL_GPT4},
+        llm_config={"model": model_router.route("expert", config.MODEL_GPT4)},
     )
+    # Ответ менеджера — это прогон группы: перед ним тоже списание и проверка бюджета
+    meter.attach(mgr)
 
     # 4. Публикация статуса о шагах
     plan_steps = plan.get("context", {}).get("plan", [])
@@ -166,12 +224,23 @@ async def run_expert_gc(thread_id, user_q, slots, plan, logger: logging.Logger):
         else:
              final_answer = {"answer": "Не удалось получить финальный ответ от группы.", "model": "system-error", "citations": citations}
 
+    except asyncio.CancelledError:
+        # Клиент отключился: новых раундов не будет, но запрос агента, уже ушедший из потока
+        # executor'а (autogen 0.2.9 a_generate_oai_reply), дорабатывает — прервать его нельзя
+        logger.info("Expert-GC cancelled")
+        raise
+    except token_budget.TokenBudgetExceeded:
+        # Жёсткий лимит — не ошибка группы: chat_core сообщает клиенту о лимите токенов
+        raise
     except asyncio.TimeoutError:
         logger.warning("Expert-GC timeout", exc_info=False)
         final_answer = {"answer": "Таймаут экспертной группы.", "model": "system-error", "citations": []}
     except Exception as e:
         logger.error(f"Ошибка в Expert-GC: {e}", exc_info=True)
         final_answer = {"answer": f"Ошибка сервера в Expert-GC: {e}", "model": "system-error", "citations": []}
+    finally:
+        # Последний раунд (и всё до таймаута или ошибки) тоже оплачивается
+        await meter.settle()
 
     return final_answer
 
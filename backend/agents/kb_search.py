@@ -1,5 +1,5 @@
 from backend.embedding_pool import get_embedding_async as get_async_vec
-from backend.qdrant_client import qdr
+from backend.qdrant_client import aqdr
 import numpy as np
 import logging
 import asyncio
@@ -8,10 +8,15 @@ import time
 SIM_HARD = 0.95    # reuse без изменений
 SIM_SOFT = 0.60    # ниже → прямая эскалация
 
+async def _search(collection: str, vec, k: int):
+    rsp = await aqdr.query_points(collection_name=collection, query=vec, limit=k)
+    return rsp.points
+
 async def kb_search(query:str, expected_tokens:int=1500):
     """
     Выполняет поиск по базе знаний (диалоги и документы).
     Возвращает кортеж (action, data), где action - "reuse" или "escalate".
+    Оба поиска идут одновременно через AsyncQdrantClient; при reuse поиск по документам отменяется.
     """
     logging.info(f"kb_search started for query: '{query}'")
     vec = await get_async_vec(query)
@@ -19,33 +24,42 @@ async def kb_search(query:str, expected_tokens:int=1500):
     k = max(3, min(10, expected_tokens // 400))
     logging.info(f"Dynamic k={k} for search.")
 
-    # 1. Поиск по существующим диалогам
+    # В README указана коллекция 'docs', используем ее.
+    dialogs_task = asyncio.create_task(_search("dialogs", vec, k))
+    docs_task = asyncio.create_task(_search("docs", vec, k))
     try:
-        hits = qdr.search(collection_name="dialogs", query_vector=vec, limit=k)
-        logging.info(f"Found {len(hits)} similar dialogs.")
-        if hits and hits[0].score >= SIM_HARD:
-            logging.info(f"Found a very similar dialog with score {hits[0].score:.4f}. Reusing answer.")
-            return "reuse", hits[0].payload["answer"]
-    except Exception as e:
-        logging.warning(f"Could not search in 'dialogs' collection: {e}")
-        hits = []
+        # 1. Поиск по существующим диалогам
+        try:
+            hits = await dialogs_task
+            logging.info(f"Found {len(hits)} similar dialogs.")
+            if hits and hits[0].score >= SIM_HARD:
+                logging.info(f"Found a very similar dialog with score {hits[0].score:.4f}. Reusing answer.")
+                return "reuse", hits[0].payload["answer"]
+        except Exception as e:
+            logging.warning(f"Could not search in 'dialogs' collection: {e}")
+            hits = []
 
-    # 2. Сбор контекста для эскалации
-    context = {
-        "similar_dialogs": [h.payload for h in hits if h.score >= SIM_SOFT]
-    }
-    logging.info(f"Found {len(context['similar_dialogs'])} dialogs with score >= {SIM_SOFT}.")
+        # 2. Сбор контекста для эскалации
+        context = {
+            "similar_dialogs": [h.payload for h in hits if h.score >= SIM_SOFT]
+        }
+        logging.info(f"Found {len(context['similar_dialogs'])} dialogs with score >= {SIM_SOFT}.")
 
-    # 3. Поиск по документам (RAG)
-    try:
-        # В README указана коллекция 'docs', используем ее.
-        rag_hits = qdr.search(collection_name="docs", query_vector=vec, limit=k)
-        context["rag"] = [h.payload for h in rag_hits] # Сохраняем payload, а не весь объект
-        logging.info(f"Found {len(rag_hits)} relevant document chunks.")
-    except Exception as e:
-        logging.error(f"Failed to search in 'docs' collection: {e}")
-        context["rag"] = []
+        # 3. Поиск по документам (RAG) — к этому моменту обычно уже завершён
+        try:
+            rag_hits = await docs_task
+            context["rag"] = [h.payload for h in rag_hits] # Сохраняем payload, а не весь объект
+            logging.info(f"Found {len(rag_hits)} relevant document chunks.")
+        except Exception as e:
+            logging.error(f"Failed to search in 'docs' collection: {e}")
+            context["rag"] = []
+    finally:
+        # reuse или отмена хода: незавершённый поиск больше не нужен
+        for task in (dialogs_task, docs_task):
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # ошибка ненужного поиска не должна всплыть в логе asyncio
 
     logging.info("Escalating with the collected context.")
     return "escalate", context
-
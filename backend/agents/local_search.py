@@ -1,6 +1,8 @@
 from qdrant_client import QdrantClient
+import asyncio
 import os
 from backend.embedding import get as get_embedding
+from backend.embedding_pool import get_embedding_async
 
 # Инициализация клиента Qdrant
 _q = QdrantClient(
@@ -36,3 +38,13 @@ def local_search(query, top_k: int = 10):
         print(f"❌ Error in local_search: {e}")
         # В случае ошибки возвращаем пустой результат
         return []
+
+async def local_search_async(query: str, top_k: int = 10):
+    """
+    Асинхронный вариант local_search для кода внутри event loop (Expert-GC):
+    эмбеддинг берётся из общего пула, синхронный запрос к Qdrant уходит в поток.
+    """
+    query_vector = await get_embedding_async(query)
+    if not query_vector:
+        return []
+    return await asyncio.to_thread(local_search, query_vector, top_k)
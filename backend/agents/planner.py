@@ -1,7 +1,8 @@
 import json
 import logging
-from backend.openai_helpers import call_llm
-from backend.json_utils import safe_load
+from backend.openai_helpers import stream_llm
+from backend.json_utils import safe_load, JsonFieldStreamer
+from backend import token_budget
 
 PLAN_PROMPT = """Ты — Planner-агент по информационной безопасности.
 Верни ОДИН JSON без комментариев:
@@ -23,7 +24,9 @@ async def _build_plan(q: str, slots: dict, logger: logging.Logger) -> dict:
     """
     logger.info("Calling LLM to build a plan.")
     # `ensure_ascii=False` для корректной передачи кириллицы в JSON
-    raw, _ = await call_llm("gpt-4.1", PLAN_PROMPT.format(q=q, slots=json.dumps(slots, ensure_ascii=False)), temperature=0)
+    # Клиенту стримится только поле draft; если Critic его отклонит, финальный ответ заменит черновик
+    raw, _ = await stream_llm("gpt-4.1", PLAN_PROMPT.format(q=q, slots=json.dumps(slots, ensure_ascii=False)),
+                              temperature=0, visible=JsonFieldStreamer("draft").feed, site="planner")
     
     plan = safe_load(raw)
     
@@ -56,6 +59,10 @@ async def ask_planner(thread_id: str, user_q: str, slots: dict, logger: logging.
 
     # если draft готов и need_escalate=False — задаём Critic-проверку
     if not plan.get("need_escalate") and plan.get("draft"):
+        if token_budget.soft_limited():
+            # Мягкий лимит токенов: черновик уходит без проверки Critic
+            logger.info("Token budget soft limit reached, skipping critic.")
+            return plan
         logger.info(f"Draft found, sending to critic: '{plan['draft']}'")
         from agents.critic import ask_critic
         
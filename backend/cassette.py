@@ -0,0 +1,158 @@
+"""
+Запись и воспроизведение ответов LLM, browser_search и эмбеддингов («кассета»).
+LLM_CASSETTE_MODE=record — живые ответы с задержками пишутся в SQLite по хешу запроса;
+LLM_CASSETTE_MODE=replay — ответы отдаются из кассеты с записанной задержкой,
+умноженной на LLM_CASSETTE_LATENCY_SCALE. Промах при воспроизведении уходит
+обычным путём (stub при OPENAI_API_KEY=stub, иначе API).
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from backend import metrics
+
+MODE = os.getenv("LLM_CASSETTE_MODE", "off")  # off | record | replay
+PATH = os.getenv("LLM_CASSETTE_PATH", "/data/cassette.db")
+LATENCY_SCALE = float(os.getenv("LLM_CASSETTE_LATENCY_SCALE", "1.0"))
+
+
+@dataclass
+class Entry:
+    body: bytes
+    latency_ms: int
+    meta: dict = field(default_factory=dict)
+
+    @property
+    def text(self) -> str:
+        return self.body.decode()
+
+
+def recording() -> bool:
+    return MODE == "record"
+
+
+def replaying() -> bool:
+    return MODE == "replay"
+
+
+def key(kind: str, **request) -> str:
+    """Ключ записи: хеш вида вызова и всех параметров запроса."""
+    payload = json.dumps({"kind": kind, **request}, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CassetteStore:
+    """SQLite-хранилище записей; при воспроизведении кассета целиком читается в память."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded: dict[str, Entry] | None = None
+        self._initialized = False
+
+    def _conn(self) -> sqlite3.Connection:
+        """Новое соединение; закрывает вызывающий (contextlib.closing — `with conn` только коммитит)."""
+        if not self._initialized:
+            # Каталог кассеты создаётся до connect: иначе первая запись падает с «unable to open database file»
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        if not self._initialized:
+            conn.execute("""CREATE TABLE IF NOT EXISTS cassette(
+                key TEXT PRIMARY KEY,
+                kind TEXT,
+                body BLOB,
+                latency_ms INTEGER,
+                meta TEXT
+            )""")
+            self._initialized = True
+        return conn
+
+    def get(self, k: str) -> Entry | None:
+        with self._lock:
+            if self._loaded is None:
+                with contextlib.closing(self._conn()) as c:
+                    rows = c.execute("SELECT key, body, latency_ms, meta FROM cassette").fetchall()
+                self._loaded = {row[0]: Entry(row[1], row[2], json.loads(row[3] or "{}")) for row in rows}
+            return self._loaded.get(k)
+
+    def put_many(self, kind: str, items: list[tuple[str, Entry]]):
+        with self._lock:
+            with contextlib.closing(self._conn()) as c, c:
+                c.executemany(
+                    "INSERT OR REPLACE INTO cassette(key, kind, body, latency_ms, meta) VALUES (?,?,?,?,?)",
+                    [(k, kind, e.body, e.latency_ms, json.dumps(e.meta, ensure_ascii=False)) for k, e in items],
+                )
+            if self._loaded is not None:
+                self._loaded.update(items)
+
+
+_stores: dict[str, CassetteStore] = {}
+
+
+def store() -> CassetteStore:
+    if PATH not in _stores:
+        _stores[PATH] = CassetteStore(PATH)
+    return _stores[PATH]
+
+
+def delay(latency_ms: int) -> float:
+    """Пауза воспроизведения в секундах с учётом LATENCY_SCALE."""
+    return max(0.0, latency_ms * LATENCY_SCALE / 1000)
+
+
+async def replay(kind: str, k: str, wait: bool = True) -> Entry | None:
+    """Запись из кассеты с паузой на записанную задержку (wait=False — паузу делает вызывающий); None — промах."""
+    entry = await asyncio.to_thread(store().get, k)
+    metrics.LLM_CASSETTE.labels(kind=kind, result="hit" if entry else "miss").inc()
+    if entry is not None and wait:
+        await asyncio.sleep(delay(entry.latency_ms))
+    return entry
+
+
+async def record(kind: str, k: str, body: str | bytes, latency_ms: int, **meta):
+    body = body.encode() if isinstance(body, str) else body
+    await asyncio.to_thread(store().put_many, kind, [(k, Entry(body, latency_ms, meta))])
+    metrics.LLM_CASSETTE.labels(kind=kind, result="recorded").inc()
+
+
+def _embed_keys(texts: list[str], model: str) -> list[str]:
+    return [key("embedding", model=model, text=t) for t in texts]
+
+
+def embed_lookup(texts: list[str], model: str) -> tuple[list[list[float]], int] | None:
+    """Векторы батча из кассеты и задержка (максимум по элементам); промах хотя бы одного — None."""
+    entries = [store().get(k) for k in _embed_keys(texts, model)]
+    if any(e is None for e in entries):
+        metrics.LLM_CASSETTE.labels(kind="embedding", result="miss").inc()
+        return None
+    metrics.LLM_CASSETTE.labels(kind="embedding", result="hit").inc()
+    vectors = [np.frombuffer(e.body, dtype=np.float32).tolist() for e in entries]
+    return vectors, max(e.latency_ms for e in entries)
+
+
+def embed_store(texts: list[str], model: str, vectors: list[list[float]], latency_ms: int):
+    """Векторы хранятся как float32 — вчетверо компактнее JSON."""
+    items = [(k, Entry(np.asarray(v, dtype=np.float32).tobytes(), latency_ms))
+             for k, v in zip(_embed_keys(texts, model), vectors)]
+    store().put_many("embedding", items)
+    metrics.LLM_CASSETTE.labels(kind="embedding", result="recorded").inc(len(items))
+
+
+async def embed_replay(texts: list[str], model: str) -> list[list[float]] | None:
+    hit = await asyncio.to_thread(embed_lookup, texts, model)
+    if hit is None:
+        return None
+    vectors, latency_ms = hit
+    await asyncio.sleep(delay(latency_ms))
+    return vectors
+
+
+async def embed_record(texts: list[str], model: str, vectors: list[list[float]], latency_ms: int):
+    await asyncio.to_thread(embed_store, texts, model, vectors, latency_ms)
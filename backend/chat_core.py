@@ -3,16 +3,44 @@ from agents.dialog_manager import handle_message
 from backend.memory import get_mem
 from backend.log_streamer import SessionLogHandler
 from backend.chat_db import save_dialog_full, get_current_thread_messages
+from backend.openai_helpers import partial_sink
+from backend.usage import current_turn
+from backend import coalesce, token_budget, usage
+from backend.protocol import WsOutgoing
 import logging
+import statistics
+import time
 import traceback
+from collections import deque
+
+# Завершённые ходы процесса (секунды, токены): по ним оценивается, сколько сэкономила отмена хода
+_completed_turns: deque[tuple[float, int]] = deque(maxlen=200)
+
+
+def _record_completed_turn(seconds: float, tokens: int):
+    _completed_turns.append((seconds, tokens))
+
+
+def _record_cancelled_turn(seconds: float, tokens: int):
+    """Сэкономлено ≈ медиана завершённых ходов минус уже потраченное отменённым ходом."""
+    from backend import metrics
+    metrics.TURN_CANCELLED.inc()
+    if not _completed_turns:
+        return
+    metrics.CANCEL_SAVED_SECONDS.inc(max(0.0, statistics.median(t[0] for t in _completed_turns) - seconds))
+    metrics.CANCEL_SAVED_TOKENS.inc(max(0, statistics.median(t[1] for t in _completed_turns) - tokens))
+
 
 async def chat_stream(thread_id: str,
                       incoming: asyncio.Queue,
-                      outgoing: asyncio.Queue):
+                      outgoing: asyncio.Queue,
+                      client_ip: str | None = None):
     """
     Универсальный «двигатель»: читает сообщения из incoming,
     вызывает handle_message() и кладёт ответы в outgoing.
-    incoming.put_nowait(None) → graceful shutdown.
+    incoming.put_nowait(None) → graceful shutdown (текущий ход дорабатывает);
+    отмена задачи → текущий ход прерывается (клиент отключился).
+    client_ip — для бюджета токенов на IP (backend.token_budget).
     """
     import json
     from backend import status_bus
@@ -37,63 +65,95 @@ async def chat_stream(thread_id: str,
     
     session_logger.info("Chat stream started.")
 
-    while True:
-        msg = await incoming.get()
-        # Считаем входящие запросы
-        from backend import metrics
-        metrics.STARTED.labels(stage="inbound").inc()
-        if msg is None:
-            break
-        # Обрабатываем входящее сообщение
-        try:
-            # Парсим JSON и получаем текст сообщения
-            data = json.loads(msg)
-            user_message = data.get("message")
-            if not isinstance(user_message, str):
-                session_logger.warning(f"Skipping message without 'message' key or non-string: {msg}")
-                continue
-
-            # Логируем получение и считаем запрос
-            slots = get_mem(thread_id)
-            session_logger.info(f"Received message: '{user_message}'")
-
-            # Обрабатываем сообщение и отправляем ответ
-            resp = await handle_message(thread_id, user_message, slots, session_logger)
-            if resp:
-                await outgoing.put(resp)
-            session_logger.info("Response sent to outgoing queue.")
-
-            # Сохраняем полную историю диалога
-            messages = get_current_thread_messages(thread_id)
-            save_dialog_full(thread_id, messages)
-            session_logger.info(f"Dialog history saved for thread {thread_id}.")
-        except json.JSONDecodeError as e:
-            # Логируем ошибку парсинга и уведомляем клиента
-            session_logger.error(f"JSON decode error: {e}. Message: '{msg}'")
-            await outgoing.put({
-                "type": "error",
-                "role": "system",
-                "content": f"Ошибка формата запроса: {e}. Ожидается JSON с ключом 'message'."
-            })
-        except Exception as e:
-            # Логируем полное исключение в лог сессии и уведомляем клиента
-            session_logger.error(f"An error occurred: {e}\n{traceback.format_exc()}")
-            await outgoing.put({
-                "type": "error",
-                "role": "system",
-                "content": f"Произошла внутренняя ошибка сервера. ID: {thread_id}"
-            })
-    
-    session_logger.info("Chat stream finished.")
-    # Отменяем задачу status_forward
-    if 'status_task' in locals():
+    # Частичные ответы LLM (stream_llm) уходят в тот же outgoing до финального chat
+    async def send_partial(delta: str):
+        await outgoing.put(WsOutgoing(type="chunk", role="assistant", content=delta).dict(exclude_none=True))
+
+    turn_index = 0
+    try:
+        while True:
+            msg = await incoming.get()
+            # Считаем входящие запросы
+            from backend import metrics
+            metrics.STARTED.labels(stage="inbound").inc()
+            if msg is None:
+                break
+            # Обрабатываем входящее сообщение
+            try:
+                # Парсим JSON и получаем текст сообщения
+                data = json.loads(msg)
+                user_message = data.get("message")
+                if not isinstance(user_message, str):
+                    session_logger.warning(f"Skipping message without 'message' key or non-string: {msg}")
+                    continue
+
+                # Логируем получение и считаем запрос
+                slots = get_mem(thread_id)
+                session_logger.info(f"Received message: '{user_message}'")
+
+                # Обрабатываем сообщение и отправляем ответ
+                # Учёт токенов всех LLM-вызовов хода привязывается к (thread_id, turn_index)
+                sink_token = partial_sink.set(send_partial)
+                turn_token = current_turn.set((thread_id, turn_index))
+                scope_token = token_budget.current_scope.set((thread_id, client_ip))
+                turn_started = time.monotonic()
+                turn_index += 1
+                try:
+                    # Исчерпанный бюджет отклоняет ход до поиска и агентов
+                    await token_budget.enforce()
+                    # Одинаковый вопрос из другой сессии уже в работе — ждём его ответ (backend.coalesce)
+                    resp = await coalesce.run(handle_message, thread_id, user_message, slots, session_logger)
+                except asyncio.CancelledError:
+                    # Клиент отключился: CancelledError уже прервал LLM-запросы, поиск и Expert-GC
+                    _record_cancelled_turn(time.monotonic() - turn_started, usage.pop_turn_tokens(thread_id, turn_index - 1))
+                    session_logger.info("Turn cancelled: client disconnected.")
+                    raise
+                finally:
+                    token_budget.current_scope.reset(scope_token)
+                    current_turn.reset(turn_token)
+                    partial_sink.reset(sink_token)
+                _record_completed_turn(time.monotonic() - turn_started, usage.pop_turn_tokens(thread_id, turn_index - 1))
+                if resp:
+                    await outgoing.put(resp)
+                session_logger.info("Response sent to outgoing queue.")
+
+                # Сохраняем полную историю диалога
+                messages = get_current_thread_messages(thread_id)
+                save_dialog_full(thread_id, messages)
+                session_logger.info(f"Dialog history saved for thread {thread_id}.")
+            except json.JSONDecodeError as e:
+                # Логируем ошибку парсинга и уведомляем клиента
+                session_logger.error(f"JSON decode error: {e}. Message: '{msg}'")
+                await outgoing.put({
+                    "type": "error",
+                    "role": "system",
+                    "content": f"Ошибка формата запроса: {e}. Ожидается JSON с ключом 'message'."
+                })
+            except token_budget.TokenBudgetExceeded as e:
+                session_logger.warning(f"Token budget exceeded ({e.scope}): {e.used}/{e.limit}")
+                await outgoing.put({
+                    "type": "error",
+                    "role": "system",
+                    "content": str(e)
+                })
+            except Exception as e:
+                # Логируем полное исключение в лог сессии и уведомляем клиента
+                session_logger.error(f"An error occurred: {e}\n{traceback.format_exc()}")
+                await outgoing.put({
+                    "type": "error",
+                    "role": "system",
+                    "content": f"Произошла внутренняя ошибка сервера. ID: {thread_id}"
+                })
+    finally:
+        # Выполняется и при отмене задачи (отключение клиента): status_forward не должен пережить сессию
+        session_logger.info("Chat stream finished.")
         status_task.cancel()
         try:
             await status_task
         except asyncio.CancelledError:
             pass
-    # Сигнал завершения для очереди outgoing
-    await outgoing.put(None)
+        # Сигнал завершения для очереди outgoing
+        await outgoing.put(None)
 
 from fastapi import WebSocket
 import json
@@ -49,6 +49,23 @@ def log_message(thread, turn, role, content,
             (thread, turn, role, content, model, latency_ms, intent)
         )
 
+def log_usage_many(records):
+    """Пачка записей учёта токенов (backend.usage) одной транзакцией, role='meta'."""
+    rows = [
+        (r.thread_id, r.turn_index, "meta",
+         json.dumps({"model": r.model, "prompt_tokens": r.prompt_tokens,
+                     "completion_tokens": r.completion_tokens,
+                     "total_tokens": r.prompt_tokens + r.completion_tokens}),
+         r.model, r.latency_ms)
+        for r in records
+    ]
+    with _conn() as c:
+        c.executemany(
+            """INSERT INTO chatlog(thread_id,turn_index,role,content,model,latency_ms)
+               VALUES (?,?,?,?,?,?)""",
+            rows
+        )
+
 def log_raw(thread_id: str, turn: int, model: str, raw: str):
     """Логирование сырого ответа модели для отладки"""
     with _conn() as c:
@@ -57,11 +74,11 @@ def log_raw(thread_id: str, turn: int, model: str, raw: str):
                   (thread_id, turn, "raw", raw, model))
 
 def get_current_thread_messages(thread_id: str) -> list[dict]:
-    """Возвращает все сообщения (кроме raw) для данного thread_id."""
+    """Возвращает все сообщения (кроме raw и учёта токенов meta) для данного thread_id."""
     with _conn() as c:
         # Выбираем только сообщения от user, assistant и system
         rows = c.execute("""SELECT role, content FROM chatlog 
-                            WHERE thread_id = ? AND role != 'raw'
+                            WHERE thread_id = ? AND role NOT IN ('raw', 'meta')
                             ORDER BY ts ASC""", (thread_id,)).fetchall()
         # Преобразуем каждую строку sqlite3.Row в словарь
         return [dict(row) for row in rows]
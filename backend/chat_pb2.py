@@ -24,7 +24,7 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"<\n\x0b\x43hatMessage\x12\x0c\n\x04role\x18\x01 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x02 \x01(\t\x12\x0e\n\x06status\x18\x03 \x01(\t20\n\x04\x43hat\x12(\n\x06Stream\x12\x0c.ChatMessage\x1a\x0c.ChatMessage(\x01\x30\x01\x62\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\nchat.proto\"M\n\x0b\x43hatMessage\x12\x0c\n\x04role\x18\x01 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x02 \x01(\t\x12\x0e\n\x06status\x18\x03 \x01(\t\x12\x0f\n\x07partial\x18\x04 \x01(\x08\x32\x30\n\x04\x43hat\x12(\n\x06Stream\x12\x0c.ChatMessage\x1a\x0c.ChatMessage(\x01\x30\x01\x62\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
@@ -32,7 +32,7 @@ _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'chat_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
   _globals['_CHATMESSAGE']._serialized_start=14
-  _globals['_CHATMESSAGE']._serialized_end=74
-  _globals['_CHAT']._serialized_start=76
-  _globals['_CHAT']._serialized_end=124
+  _globals['_CHATMESSAGE']._serialized_end=91
+  _globals['_CHAT']._serialized_start=93
+  _globals['_CHAT']._serialized_end=141
 # @@protoc_insertion_point(module_scope)
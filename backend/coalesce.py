@@ -0,0 +1,165 @@
+"""
+Склейка одинаковых вопросов из разных сессий, пока первый ещё обрабатывается.
+Ключ — нормализованный вопрос и слоты сессии. Первый запрос (ведущий) запускает
+handle_message отдельной задачей в новом контексте с бюджетом ведущего; следующие (ведомые)
+ждут её результат. Всем ожидающим уходят статусы (через status_bus) и частичные ответы стрима,
+токены прогона списываются с бюджета каждого. Ведомых не больше COALESCE_MAX_FOLLOWERS — сверх лимита
+запрос выполняется сам. Задача отменяется, только когда отключились все ожидающие.
+"""
+import asyncio
+import contextvars
+import hashlib
+import json
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from backend import config, metrics, status_bus, token_budget, usage
+from backend.openai_helpers import partial_sink
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+
+def normalize(q: str) -> str:
+    """Регистр, ё/е, пунктуация и пробелы не делают вопросы разными."""
+    return _NON_WORD.sub(" ", q.lower().replace("ё", "е")).strip()
+
+
+def key(user_q: str, slots: dict) -> str:
+    payload = json.dumps({"q": normalize(user_q), "slots": slots}, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+@dataclass
+class _Flight:
+    leader: str
+    task: asyncio.Task | None = None
+    followers: set[str] = field(default_factory=set)
+    waiters: int = 0
+    sinks: dict[str, Callable[[str], Awaitable[None]]] = field(default_factory=dict)
+    chunks: list[str] = field(default_factory=list)
+    tokens: int = 0
+
+    async def fan_out(self, delta: str):
+        """partial_sink общего прогона: дельта уходит всем, кто ещё ждёт."""
+        self.chunks.append(delta)
+        for thread_id, sink in list(self.sinks.items()):
+            try:
+                await sink(delta)
+            except Exception as e:
+                logging.debug(f"Coalesced chunk to {thread_id} failed: {e!r}")
+
+    async def attach_sink(self, thread_id: str, sink: Callable[[str], Awaitable[None]] | None):
+        """Опоздавшему — уже выданные дельты, затем подписка на новые (без пропусков между ними)."""
+        if sink is None:
+            return
+        sent = 0
+        while sent < len(self.chunks):
+            await sink(self.chunks[sent])
+            sent += 1
+        self.sinks[thread_id] = sink
+
+
+_inflight: dict[str, _Flight] = {}
+
+
+def _enabled() -> bool:
+    return str(config.config.COALESCE_ENABLED) not in ("0", "false", "False")
+
+
+async def _run_shared(flight: _Flight, handler, turn, thread_id: str, user_q: str, slots: dict,
+                      logger: logging.Logger) -> dict:
+    """
+    Тело общей задачи. Из контекста ведущего — только бюджет: enforce(), понижение модели
+    и soft_limited() работают как в обычном ходе, вызовы списываются с ведущего сразу.
+    Стрим идёт в fan_out, а не в очередь ведущего; токены прогона собираются в flight.tokens
+    и списываются с ведомых в run(). Записи usage помечаются ходом ведущего.
+    """
+    partial_sink.set(flight.fan_out)
+    if turn is not None:
+        usage.current_turn.set(turn)
+    try:
+        return await handler(thread_id, user_q, slots, logger)
+    finally:
+        if turn is not None:
+            flight.tokens = usage.pop_turn_tokens(*turn)
+
+
+async def run(handler: Callable[..., Awaitable[dict]], thread_id: str, user_q: str, slots: dict,
+              logger: logging.Logger) -> dict:
+    """handler(thread_id, user_q, slots, logger) — один на все одинаковые вопросы в полёте."""
+    if not _enabled():
+        return await handler(thread_id, user_q, slots, logger)
+
+    k = key(user_q, slots)
+    flight = _inflight.get(k)
+    if flight is not None and len(flight.followers) >= int(config.config.COALESCE_MAX_FOLLOWERS):
+        metrics.COALESCE.labels(role="overflow").inc()
+        return await handler(thread_id, user_q, slots, logger)
+
+    if flight is None:
+        metrics.COALESCE.labels(role="leader").inc()
+        flight = _Flight(thread_id)
+        # Отдельная задача в новом контексте: отключение ведущего не должно обрывать ответ
+        # ведомым, а его partial_sink и ход — достаться общему прогону. Бюджет переносится:
+        # без него лимиты внутри хода не действовали бы вовсе
+        ctx = contextvars.Context()
+        ctx.run(token_budget.current_scope.set, token_budget.current_scope.get())
+        ctx.run(token_budget.current_level.set, token_budget.current_level.get())
+        shared = _run_shared(flight, handler, usage.current_turn.get(), thread_id, user_q, slots, logger)
+        flight.task = asyncio.create_task(shared, context=ctx)
+        _inflight[k] = flight
+        flight.task.add_done_callback(lambda _, k=k, flight=flight: _finish(k, flight))
+    else:
+        metrics.COALESCE.labels(role="follower").inc()
+        logger.info(f"Joining in-flight identical question of thread {flight.leader}")
+        flight.followers.add(thread_id)
+        status_bus.follow(flight.leader, thread_id)
+
+    flight.waiters += 1
+    try:
+        await flight.attach_sink(thread_id, partial_sink.get())
+        result = await asyncio.shield(flight.task)
+    except asyncio.CancelledError:
+        flight.waiters -= 1
+        if flight.waiters == 0 and not flight.task.done():
+            # Ответ больше никому не нужен — гасим конвейер и дожидаемся его остановки
+            flight.task.cancel()
+            await asyncio.wait({flight.task})
+            # Потраченное до отмены учитывает последний отключившийся (ведущий уже оплатил)
+            await _account(flight.tokens, charge=thread_id != flight.leader)
+        raise
+    except token_budget.TokenBudgetExceeded:
+        flight.waiters -= 1
+        if thread_id == flight.leader:
+            raise
+        # Исчерпан бюджет ведущего, а не ведомого — ведомый отвечает сам
+        logger.info(f"Shared run of thread {flight.leader} hit its token budget, running alone")
+        return await handler(thread_id, user_q, slots, logger)
+    else:
+        flight.waiters -= 1
+    finally:
+        flight.sinks.pop(thread_id, None)
+        if thread_id != flight.leader:
+            status_bus.unfollow(flight.leader, thread_id)
+
+    # Каждый получивший ответ учитывает его в своём ходе; ведомые платят из своего бюджета
+    await _account(flight.tokens, charge=thread_id != flight.leader)
+    if thread_id != flight.leader:
+        metrics.COALESCE_SHARED_TOKENS.inc(flight.tokens)
+    return dict(result) if isinstance(result, dict) else result
+
+
+async def _account(tokens: int, charge: bool):
+    """Учёт токенов общего прогона в ходе текущей сессии и (charge) списание с её бюджета."""
+    if charge:
+        await token_budget.charge(tokens)
+    if (turn := usage.current_turn.get()) is not None:
+        usage.add_turn_tokens(*turn, tokens)
+
+
+def _finish(k: str, flight: _Flight):
+    if _inflight.get(k) is flight:
+        del _inflight[k]
+    metrics.COALESCE_FANOUT.observe(len(flight.followers))
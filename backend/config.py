@@ -24,6 +24,45 @@ class Config:
                     "DB_PATH": "/data/chat.db",
                     "GC_TIMEOUT_SEC": "300",
                     "WEB_SEARCH_TIMEOUT_SEC": "20",
+                    "LLM_TIMEOUT_SEC": "60",
+                    "LLM_CONNECT_TIMEOUT_SEC": "5",
+                    # Бюджеты по местам вызова LLM и на весь ход диалога (Expert-GC до GC_TIMEOUT_SEC)
+                    "LLM_BUDGET_INTENT_SEC": "8",
+                    "LLM_BUDGET_SMALL_TALK_SEC": "15",
+                    "LLM_BUDGET_CRITIC_SEC": "15",
+                    "LLM_BUDGET_PLANNER_SEC": "45",
+                    "TURN_BUDGET_SEC": "360",
+                    "LLM_RETRY_MAX": "2",
+                    "LLM_RETRY_BASE_SEC": "0.5",
+                    "LLM_RETRY_CAP_SEC": "8",
+                    "LLM_MIN_ATTEMPT_SEC": "1",
+                    "LLM_HEDGE_MODELS": "o3-mini",
+                    # Бюджет токенов: лимит сессии — Settings.max_tokens_per_session
+                    "TOKEN_BUDGET_IP_LIMIT": "200000",
+                    "TOKEN_BUDGET_IP_WINDOW_SEC": "3600",
+                    "TOKEN_BUDGET_SESSION_TTL_SEC": "86400",
+                    "TOKEN_BUDGET_SOFT_RATIO": "0.8",
+                    "TOKEN_BUDGET_DOWNGRADE": "gpt-4.1:gpt-4.1-mini,o3-mini:gpt-4.1-mini",
+                    # Маршрутизация моделей (backend.model_router); ROUTE_<CLASS> задаёт цепочку явно
+                    "MODEL_FALLBACKS": "gpt-4.1:gpt-4.1-mini,o3-mini:gpt-4.1-mini,gpt-4.1-mini:o3-mini",
+                    "MODEL_COSTS": "gpt-4.1:8,gpt-4.1-mini:1.6,o3-mini:4.4",
+                    "ROUTER_COST_WEIGHT": "0",
+                    "ROUTER_SLO_RATIO": "0.5",
+                    "ROUTER_MAX_ERROR_RATE": "0.25",
+                    "ROUTER_WINDOW_SEC": "300",
+                    # Локальный классификатор интента (agents/intent_fastpath.py)
+                    "INTENT_FASTPATH_ENABLED": "1",
+                    "INTENT_FASTPATH_THRESHOLD": "0.85",
+                    "INTENT_FASTPATH_TIMEOUT_SEC": "1",
+                    "INTENT_FASTPATH_TEMPERATURE": "0.05",
+                    "INTENT_FASTPATH_SHADOW_RATE": "0.05",
+                    # kb_search запускается параллельно с классификацией интента и отменяется для small_talk/file
+                    "KB_SPECULATIVE": "1",
+                    # Склейка одинаковых вопросов разных сессий в полёте (backend.coalesce)
+                    "COALESCE_ENABLED": "1",
+                    "COALESCE_MAX_FOLLOWERS": "50",
+                    "OPENAI_MAX_CONNECTIONS": "100",
+                    "OPENAI_MAX_KEEPALIVE": "20",
                     "MODEL_GPT4": "gpt-4-turbo",
                     "MODEL_GPT4_MINI": "gpt-4.1-mini",
                     "MODEL_O3_MINI": "gpt-3.5-turbo",
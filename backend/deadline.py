@@ -0,0 +1,36 @@
+"""
+Дедлайн текущего хода диалога (contextvar).
+handle_message задаёт бюджет, вложенные вызовы LLM и эмбеддингов
+берут таймауты из остатка, а не каждый свой полный.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_deadline: ContextVar[float | None] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def budget(seconds: float):
+    """Ограничивает вложенный код seconds секундами (но не дольше внешнего дедлайна)."""
+    current = _deadline.get()
+    new = time.monotonic() + seconds
+    token = _deadline.set(new if current is None else min(current, new))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float | None:
+    """Сколько секунд осталось до дедлайна; None — дедлайн не задан."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def clamp(timeout: float) -> float:
+    """Таймаут вызова, урезанный до остатка дедлайна."""
+    left = remaining()
+    return timeout if left is None else min(timeout, left)
@@ -1,17 +1,43 @@
-import os, openai, functools, hashlib, json, redis
+import os, openai, hashlib, json, redis
+import contextlib, threading, time
+import numpy as np
 from backend.utils import is_test_mode
+from backend.lru_cache import LRUCache
+from backend.token_counter import get_encoder
+from backend import metrics, cassette
 import warnings
 
-# Отложенная инициализация OpenAI клиента
+# Единая модель эмбеддингов для синхронного (get) и асинхронного (embedding_pool) путей
 MODEL = os.getenv("EMBED_MODEL", "text-embedding-3-small")
+EMBED_DIM = 1536  # размерность text-embedding-3-small (и коллекций Qdrant)
+# Лимит входа модели в токенах: длинные тексты режутся на куски, а не обрезаются
+MAX_INPUT_TOKENS = int(os.getenv("EMBED_MAX_INPUT_TOKENS", "8191"))
+# Лимиты одного запроса к API: суммарные токены входов и число входов.
+# Промахи длинного документа делятся на несколько запросов, а не уходят одним.
+BATCH_TOKEN_BUDGET = int(os.getenv("EMBED_BATCH_TOKEN_BUDGET", "50000"))
+MAX_BATCH_INPUTS = int(os.getenv("EMBED_BATCH_MAX_INPUTS", "2048"))
 _r = None
 
+# Бинарный формат кеша: 4-байтовый заголовок (магия + версия) и сырые float32 little-endian.
+# Вектор 1536 float32 занимает ~6 КБ вместо ~30 КБ JSON и читается без парсинга.
+_CACHE_MAGIC = b"F32"
+_CACHE_VERSION = 1
+_CACHE_HEADER = _CACHE_MAGIC + bytes([_CACHE_VERSION])
+_CACHE_TTL = 60*60*24
+
+# Первый уровень кеша — LRU в памяти процесса (float32-массивы), второй — Redis.
+# Частые FAQ-вопросы обслуживаются из памяти без сетевого RTT.
+_LRU_MAX_BYTES = int(os.getenv("EMBED_LRU_MAX_BYTES", str(64 * 1024 * 1024)))
+_LRU_TTL = float(os.getenv("EMBED_LRU_TTL_SEC", "3600"))
+_mem = LRUCache(_LRU_MAX_BYTES, ttl=_LRU_TTL)
+
 def _get_redis():
     """Ленивая инициализация Redis с обработкой ошибок"""
     global _r
     if _r is None:
         try:
-            _r = redis.Redis(host=os.getenv("REDIS_HOST","redis"), decode_responses=True)
+            # decode_responses=False: значения кеша — бинарные float32, а не текст
+            _r = redis.Redis(host=os.getenv("REDIS_HOST","redis"), decode_responses=False)
             # Проверяем подключение
             _r.ping()
         except (redis.ConnectionError, Exception) as e:
@@ -31,86 +57,283 @@ def _get_client():
         raise ValueError("OPENAI_API_KEY environment variable is required")
     return openai.OpenAI(api_key=api_key)
 
-def _cache_key(txt:str)->str:
+def _cache_key(txt:str, model:str|None=None)->str:
     h=hashlib.sha1(txt.encode()).hexdigest()
-    return f"emb:{MODEL}:{h}"
+    return f"emb:{model or MODEL}:{h}"
 
-def get(text:str)->list[float]:
-    text=text[:8192]          # safety
-    key=_cache_key(text)
-    
-    # Получаем Redis или fallback
-    cache = _get_redis()
-    
-    # Пытаемся получить из кеша
+def _pack(vec) -> bytes:
+    """Кодирует вектор в бинарный формат кеша (заголовок + float32)."""
+    return _CACHE_HEADER + np.asarray(vec, dtype="<f4").tobytes()
+
+def _unpack(raw: bytes) -> np.ndarray | None:
+    """
+    Декодирует значение из кеша в массив float32 без копирования.
+    Старые записи в JSON-формате читаются на время миграции.
+    Возвращает None для неизвестной версии формата.
+    """
+    if raw[:len(_CACHE_HEADER)] == _CACHE_HEADER:
+        # np.frombuffer не копирует данные: массив смотрит прямо в bytes из Redis
+        return np.frombuffer(raw, dtype="<f4", offset=len(_CACHE_HEADER))
+    if raw[:len(_CACHE_MAGIC)] == _CACHE_MAGIC:
+        return None  # другая версия бинарного формата — считаем промахом
+    return np.asarray(json.loads(raw), dtype=np.float32)
+
+def _mem_get(key: str) -> np.ndarray | None:
+    """Ищет вектор в LRU процесса."""
+    vec = _mem.get(key)
+    metrics.EMBED_CACHE.labels(tier="memory", result="miss" if vec is None else "hit").inc()
+    return vec
+
+def _mem_put(key: str, vec) -> np.ndarray:
+    """Кладёт вектор в LRU процесса как неизменяемый float32-массив."""
+    if isinstance(vec, np.ndarray) and not vec.flags.writeable:
+        arr = vec  # массив из Redis (np.frombuffer) — уже float32 и только для чтения
+    else:
+        arr = np.array(vec, dtype=np.float32)
+        arr.flags.writeable = False
+    _mem.put(key, arr)
+    metrics.EMBED_LRU_BYTES.set(_mem.bytes)
+    return arr
+
+def flush_local_cache() -> int:
+    """Админ-хук: сбрасывает LRU эмбеддингов в памяти процесса. Redis не трогает."""
+    n = _mem.flush()
+    metrics.EMBED_LRU_BYTES.set(0)
+    return n
+
+def _cache_get(cache, key: str) -> np.ndarray | None:
+    """Читает вектор из Redis (или dict-fallback). Legacy JSON перезаписывается в бинарном виде."""
     try:
-        if isinstance(cache, dict):
-            # Простой словарь fallback
-            if key in cache:
-                return json.loads(cache[key])
-        else:
-            # Реальный Redis
-            if vec := cache.get(key):
-                return json.loads(vec)
+        raw = cache.get(key)
+        metrics.EMBED_CACHE.labels(tier="redis", result="hit" if raw else "miss").inc()
+        if not raw:
+            return None
+        if isinstance(raw, str):
+            raw = raw.encode()
+        vec = _unpack(raw)
+        if vec is not None and not raw.startswith(_CACHE_MAGIC):
+            # Запись в старом JSON-формате — переписываем в бинарный при первом чтении
+            _cache_set(cache, key, vec)
+        return vec
     except Exception as e:
         print(f"Cache read error: {e}")
-    
-    # Проверяем API ключ
-    api_key = os.getenv("OPENAI_API_KEY")
-    
-    # Stub-режим для CI и разработки
-    if api_key == "stub":
-        print(f"🔧 Stub embedding for: {text[:50]}...")
-        # Создаем простой фиктивный вектор из хэша текста
-        import hashlib
-        hash_val = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
-        # Создаем вектор размером 1536 (как у text-embedding-3-small)
-        vec = [(hash_val + i) % 100 / 100.0 for i in range(1536)]
-        
-        # Сохраняем в кеш
-        try:
-            if isinstance(cache, dict):
-                cache[key] = json.dumps(vec)
-            else:
-                cache.set(key, json.dumps(vec), ex=60*60*24)
-        except Exception as e:
-            print(f"Cache write error: {e}")
-        
-        return vec
-    
-    # Проверяем тестовый режим
-    if is_test_mode():
-        # Возвращаем фиктивный вектор для тестового режима
-        print(f"🔧 Mock embedding for: {text[:50]}...")
-        # Создаем простой фиктивный вектор из хэша текста
-        import hashlib
-        hash_val = int(hashlib.md5(text.encode()).hexdigest()[:8], 16)
-        # Создаем вектор размером 1536 (как у text-embedding-3-small)
-        vec = [(hash_val + i) % 100 / 100.0 for i in range(1536)]
-        
-        # Сохраняем в кеш
-        try:
-            if isinstance(cache, dict):
-                cache[key] = json.dumps(vec)
-            else:
-                cache.set(key, json.dumps(vec), ex=60*60*24)
-        except Exception as e:
-            print(f"Cache write error: {e}")
-        
-        return vec
-    
-    # Используем новый API OpenAI v1.0+
-    client = _get_client()
-    resp = client.embeddings.create(model=MODEL, input=text)
-    vec = resp.data[0].embedding
-    
-    # Сохраняем в кеш
+        return None
+
+def _cache_set(cache, key: str, vec) -> None:
+    """Сохраняет вектор в кеш в бинарном формате."""
     try:
         if isinstance(cache, dict):
-            cache[key] = json.dumps(vec)
+            cache[key] = _pack(vec)
         else:
-            cache.set(key, json.dumps(vec), ex=60*60*24)
+            cache.set(key, _pack(vec), ex=_CACHE_TTL)
     except Exception as e:
         print(f"Cache write error: {e}")
-    
-    return vec
+
+def _normalize(text: str) -> str:
+    """Единая нормализация входа для синхронного и асинхронного путей."""
+    return text.strip().replace("\n", " ")
+
+def _encoding(model: str):
+    """
+    Токенизатор модели эмбеддингов из общего реестра backend.token_counter.
+    None, если tiktoken не смог загрузить словарь (нет сети) — тогда режем по байтам.
+    """
+    return get_encoder(model)
+
+def _offline_mode() -> bool:
+    """Stub-режим (CI, разработка) или тестовый режим: эмбеддинги без обращения к API."""
+    return os.getenv("OPENAI_API_KEY") == "stub" or is_test_mode()
+
+def stub_vectors(texts: list[str], dim: int = EMBED_DIM) -> np.ndarray:
+    """
+    Детерминированные фиктивные эмбеддинги для stub/тестового режима: матрица (len(texts), dim) float32.
+    Каждая строка — нормальный вектор с зерном из хэша текста, нормированный на единицу,
+    поэтому cosine одинаковых текстов = 1, а разных — около 0, как у настоящей модели.
+    """
+    out = np.empty((len(texts), dim), dtype=np.float32)
+    for row, text in zip(out, texts):
+        seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "little")
+        np.random.default_rng(seed).standard_normal(dim, dtype=np.float32, out=row)
+    out /= np.linalg.norm(out, axis=1, keepdims=True)
+    return out
+
+def _embed_uncached(texts: list[str]) -> list[list[float]]:
+    """Один батч-запрос к API (или stub-векторы, или кассета) для списка текстов без кеша."""
+    if cassette.replaying() and (hit := cassette.embed_lookup(texts, MODEL)) is not None:
+        vectors, latency_ms = hit
+        time.sleep(cassette.delay(latency_ms))
+        return vectors
+    if _offline_mode():
+        print(f"🔧 Stub embedding for {len(texts)} text(s): {texts[0][:50]}...")
+        return stub_vectors(texts).tolist()
+
+    # Используем новый API OpenAI v1.0+
+    client = _get_client()
+    t0 = time.monotonic()
+    resp = client.embeddings.create(model=MODEL, input=texts)
+    vectors = [item.embedding for item in resp.data]
+    if cassette.recording():
+        cassette.embed_store(texts, MODEL, vectors, int((time.monotonic() - t0) * 1000))
+    return vectors
+
+def split_counted(text: str, max_tokens: int | None = None) -> list[tuple[str, int]]:
+    """
+    Режет текст на куски не длиннее max_tokens токенов по границам токенов tiktoken,
+    чтобы ни один вход не превышал лимит модели (кириллица — до нескольких токенов на символ).
+    Возвращает пары (кусок, число токенов). Для текста, который короче лимита в байтах,
+    и без словаря tiktoken число — длина в байтах UTF-8, верхняя граница токенов.
+    """
+    max_tokens = max_tokens or MAX_INPUT_TOKENS
+    size = len(text.encode())
+    if size <= max_tokens:
+        return [(text, size)]  # токенов не больше, чем байт UTF-8 — резать нечего
+    enc = _encoding(MODEL)
+    if enc is None:
+        # tiktoken недоступен: символ UTF-8 занимает не больше 4 байт, а значит и токенов
+        step = max(1, max_tokens // 4)
+        return [(c, len(c.encode())) for c in (text[i:i + step] for i in range(0, len(text), step))]
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))]
+    return [(enc.decode(tokens[i:i + max_tokens]), len(tokens[i:i + max_tokens]))
+            for i in range(0, len(tokens), max_tokens)]
+
+def split_tokens(text: str, max_tokens: int | None = None) -> list[str]:
+    """Куски текста из split_counted без числа токенов."""
+    return [chunk for chunk, _ in split_counted(text, max_tokens)]
+
+def _token_batches(texts: list[str], tokens: list[int]):
+    """Делит тексты на запросы не больше BATCH_TOKEN_BUDGET токенов и MAX_BATCH_INPUTS входов."""
+    batch, used = [], 0
+    for text, n in zip(texts, tokens):
+        if batch and (used + n > BATCH_TOKEN_BUDGET or len(batch) >= MAX_BATCH_INPUTS):
+            yield batch
+            batch, used = [], 0
+        batch.append(text)
+        used += n
+    if batch:
+        yield batch
+
+def _mean_pool(vectors: list[list[float]], weights: list[int]) -> list[float]:
+    """Среднее векторов кусков, взвешенное по числу токенов, нормированное на единичную длину (для cosine)."""
+    pooled = np.average(np.asarray(vectors, dtype=np.float32), axis=0, weights=weights)
+    norm = np.linalg.norm(pooled)
+    if norm:
+        pooled = pooled / norm
+    return pooled.astype(np.float32).tolist()
+
+# Single-flight для синхронного пути: один поток считает вектор, остальные ждут на замке ключа
+_flight_guard = threading.Lock()
+_flight_locks: dict[str, list] = {}  # key -> [Lock, число ожидающих]
+
+@contextlib.contextmanager
+def _key_locks(keys: list[str]):
+    """Захватывает замки ключей в отсортированном порядке (без взаимных блокировок)."""
+    with _flight_guard:
+        entries = []
+        for key in sorted(keys):
+            entry = _flight_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            entries.append((key, entry))
+    for _, entry in entries:
+        entry[0].acquire()
+    try:
+        yield
+    finally:
+        with _flight_guard:
+            for key, entry in entries:
+                entry[0].release()
+                entry[1] -= 1
+                if not entry[1]:
+                    del _flight_locks[key]
+
+def _get_flat(texts: list[str], tokens: list[int]) -> list[list[float]]:
+    """
+    Кеш (память → Redis) + батч-запросы на промахи в пределах BATCH_TOKEN_BUDGET.
+    Тексты уже нормализованы и не пустые, tokens — их длины в токенах.
+    """
+    result: list[list[float] | None] = [None] * len(texts)
+
+    # Получаем Redis или fallback
+    cache = _get_redis()
+
+    # Пытаемся получить из кеша
+    misses: dict[str, list[int]] = {}
+    for i, text in enumerate(texts):
+        key = _cache_key(text)
+        if (cached := _mem_get(key)) is not None:
+            result[i] = cached.tolist()
+        elif (cached := _cache_get(cache, key)) is not None:
+            _mem_put(key, cached)
+            result[i] = cached.tolist()
+        else:
+            misses.setdefault(text, []).append(i)
+
+    if not misses:
+        return result
+
+    # Повторы одного текста внутри батча считаются один раз
+    deduped = sum(len(idx) - 1 for idx in misses.values())
+    with _key_locks([_cache_key(t) for t in misses]):
+        # Пока ждали замок, другой поток мог уже посчитать эти векторы
+        for text in list(misses):
+            if (cached := _mem.get(_cache_key(text))) is not None:
+                for i in misses.pop(text):
+                    result[i] = cached.tolist()
+                    deduped += 1
+        unique = list(misses)
+        for batch in _token_batches(unique, [tokens[misses[t][0]] for t in unique]):
+            for text, vec in zip(batch, _embed_uncached(batch)):
+                # Сохраняем в оба уровня кеша сразу: сбой следующего запроса не теряет готовые
+                key = _cache_key(text)
+                _mem_put(key, vec)
+                _cache_set(cache, key, vec)
+                for i in misses[text]:
+                    result[i] = vec
+
+    if deduped:
+        metrics.EMBED_DEDUP.labels(path="sync").inc(deduped)
+    return result
+
+def get_many(texts: list[str]) -> list[list[float]]:
+    """
+    Синхронный фасад сервиса эмбеддингов: кеш + батч-запросы на промахи.
+    Тексты длиннее лимита модели режутся на куски и сводятся mean-pooling'ом;
+    куски всех текстов идут в те же батчи.
+    Из асинхронного кода используйте backend.embedding_pool.get_embedding_async —
+    он работает с тем же кешем и моделью, но не блокирует event loop.
+    """
+    pieces = [split_counted(t) if t else [] for t in map(_normalize, texts)]
+    flat_pieces = [piece for chunks in pieces for piece in chunks]
+    flat = _get_flat([c for c, _ in flat_pieces], [n for _, n in flat_pieces])
+
+    result, pos = [], 0
+    for chunks in pieces:
+        vectors = flat[pos:pos + len(chunks)]
+        pos += len(chunks)
+        if len(chunks) > 1:
+            result.append(_mean_pool(vectors, [n for _, n in chunks]))
+        else:
+            result.append(vectors[0] if vectors else [])
+    return result
+
+def embed_document(text: str, mode: str = "mean", chunk_tokens: int | None = None):
+    """
+    Эмбеддинг длинного документа: куски по chunk_tokens токенов, запросы — в пределах BATCH_TOKEN_BUDGET.
+    mode="mean"   → один вектор документа (взвешенное среднее кусков);
+    mode="chunks" → список пар (кусок, вектор) для поштучной индексации.
+    """
+    if mode not in ("mean", "chunks"):
+        raise ValueError(f"Unknown embed_document mode: {mode}")
+    text = _normalize(text)
+    pieces = split_counted(text, chunk_tokens) if text else []
+    chunks, tokens = [c for c, _ in pieces], [n for _, n in pieces]
+    vectors = _get_flat(chunks, tokens)
+    if mode == "chunks":
+        return list(zip(chunks, vectors))
+    if len(vectors) > 1:
+        return _mean_pool(vectors, tokens)
+    return vectors[0] if vectors else []
+
+def get(text:str)->list[float]:
+    return get_many([text])[0]
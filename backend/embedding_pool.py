@@ -4,98 +4,477 @@ from openai import AsyncOpenAI
 
 # backend/embedding_pool.py
 import asyncio
+import logging
+import time
+import redis.asyncio as aioredis
 from openai import AsyncOpenAI
 from backend.openai_helpers import _get_async_client
+from backend.token_counter import count_tokens
+from backend import metrics, deadline, cassette
+from backend.retry import retry_reason, retry_delay
+from backend.embedding import (
+    MODEL, _cache_key, _pack, _unpack, _CACHE_TTL,
+    _normalize, _offline_mode, stub_vectors, _mem_get, _mem_put,
+    split_counted, _mean_pool, BATCH_TOKEN_BUDGET,
+)
 
 # --- Клиент OpenAI ---
 # Используем Async-клиент для асинхронных операций
+# Модель общая с backend.embedding (EMBED_MODEL), чтобы векторы обоих путей совпадали
 client: AsyncOpenAI | None = None
-MODEL = "text-embedding-ada-002"  # Модель для эмбеддингов
 
 def _ensure_client():
     """Инициализирует асинхронного клиента, если его нет."""
     global client
     if client is None:
+        # Повторы делает сам пул (с учётом лимитера и дедлайнов), у общего клиента ретраи SDK выключены
         client = _get_async_client()
 
-# --- Очередь и воркер ---
-# Очередь для задач на получение эмбеддингов
-queue = asyncio.Queue()
-BATCH_SIZE = 16  # Размер батча для отправки в API
+async def _embed_batch(texts: list[str]) -> list[list[float]]:
+    """
+    Один батч-запрос к API; в stub/тестовом режиме — те же векторы, что и у backend.embedding.
+    В режиме кассеты (backend.cassette) векторы воспроизводятся или записываются.
+    """
+    if cassette.replaying() and (vectors := await cassette.embed_replay(texts, MODEL)) is not None:
+        return vectors
+    if _offline_mode():
+        return stub_vectors(texts).tolist()
+    # Убеждаемся, что клиент инициализирован
+    _ensure_client()
+    # Выполняем запрос к OpenAI API
+    t0 = time.monotonic()
+    response = await client.embeddings.create(model=MODEL, input=texts)
+    vectors = [item.embedding for item in response.data]
+    if cassette.recording():
+        await cassette.embed_record(texts, MODEL, vectors, int((time.monotonic() - t0) * 1000))
+    return vectors
 
-async def worker():
+# --- Политика батчинга ---
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_MAX", "64"))               # жёсткий потолок батча
+BATCH_MIN = int(os.getenv("EMBED_BATCH_MIN", "4"))                 # нижняя граница адаптивного лимита
+BATCH_LINGER_MS = float(os.getenv("EMBED_BATCH_LINGER_MS", "10"))  # сколько ждём добора батча
+BATCH_TARGET_LATENCY_MS = float(os.getenv("EMBED_BATCH_TARGET_MS", "400"))
+
+class BatchPolicy:
     """
-    Воркер, который накапливает задачи из очереди,
-    обрабатывает их батчем и возвращает результаты.
+    Адаптивный размер батча: пока API отвечает быстрее целевой задержки
+    и батчи заполняются, лимит растёт; при медленных ответах — уменьшается.
     """
-    while True:
-        # Собираем задачи в батч
-        batch = []
+
+    def __init__(self, max_size: int = BATCH_SIZE, min_size: int = BATCH_MIN,
+                 linger_ms: float = BATCH_LINGER_MS, token_budget: int = BATCH_TOKEN_BUDGET,
+                 target_latency_ms: float = BATCH_TARGET_LATENCY_MS):
+        self.max_size = max_size
+        self.min_size = min(min_size, max_size)
+        self.linger = linger_ms / 1000
+        self.token_budget = token_budget
+        self.target_latency = target_latency_ms / 1000
+        self.limit = max(self.min_size, max_size // 4)
+        metrics.EMBED_BATCH_LIMIT.set(self.limit)
+
+    def observe(self, latency: float, size: int):
+        """Подстраивает лимит по задержке последнего батча."""
+        if latency > self.target_latency:
+            self.limit = max(self.min_size, int(self.limit * 0.75))
+        elif size >= self.limit:
+            self.limit = min(self.max_size, self.limit + BATCH_MIN)
+        metrics.EMBED_BATCH_LIMIT.set(self.limit)
+
+# --- Адаптивная конкурентность и повторы ---
+EMBED_CONCURRENCY_MAX = int(os.getenv("EMBED_CONCURRENCY_MAX", "8"))  # потолок одновременных запросов
+EMBED_RETRY_MAX = int(os.getenv("EMBED_RETRY_MAX", "4"))              # повторов на батч
+EMBED_RETRY_BASE_MS = float(os.getenv("EMBED_RETRY_BASE_MS", "200"))
+EMBED_RETRY_CAP_SEC = float(os.getenv("EMBED_RETRY_CAP_SEC", "10"))
+EMBED_DEADLINE_SEC = float(os.getenv("EMBED_DEADLINE_SEC", "30"))    # дедлайн вызывающего по умолчанию
+
+class AIMDLimiter:
+    """
+    Ограничитель одновременных запросов к API по схеме AIMD:
+    успешный ответ добавляет ~1 к лимиту за «окно» (+1/limit на запрос),
+    429/5xx уменьшает лимит вдвое — не чаще раза в cooldown, чтобы пачка
+    одновременных отказов не обрушила его до минимума.
+    """
+
+    def __init__(self, max_limit: int = EMBED_CONCURRENCY_MAX, min_limit: int = 1,
+                 decrease: float = 0.5, cooldown: float = 1.0):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.active = 0
+        self._waiters: list[asyncio.Future] = []
+        self._last_decrease = float("-inf")
+        metrics.EMBED_CONCURRENCY_LIMIT.set(self.limit)
+
+    async def acquire(self):
+        while self.active >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self._wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.release()
+        return False
+
+    def on_success(self):
+        self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+        metrics.EMBED_CONCURRENCY_LIMIT.set(self.limit)
+        self._wake()
+
+    def on_overload(self):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit * self.decrease)
+        metrics.EMBED_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _wake(self):
+        free = int(self.limit) - self.active
+        for waiter in self._waiters[:max(free, 0)]:
+            if not waiter.done():
+                waiter.set_result(None)
+
+# --- Пул: очередь и воркеры ---
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))                 # воркеров, собирающих батчи
+EMBED_QUEUE_MAX = int(os.getenv("EMBED_QUEUE_MAX", "1024"))          # предел очереди (backpressure)
+EMBED_DRAIN_TIMEOUT = float(os.getenv("EMBED_DRAIN_TIMEOUT_SEC", "10"))
+
+
+class EmbeddingPool:
+    """
+    Батчер эмбеддингов, привязанный к одному event loop.
+    Очередь ограничена: при переполнении put() ждёт, и вызывающие получают
+    backpressure вместо неограниченного роста памяти. N воркеров собирают
+    батчи параллельно, число одновременных запросов к API держит AIMDLimiter;
+    stop() дожидается очереди и завершает висящие future.
+    """
+
+    def __init__(self, workers: int = EMBED_WORKERS, maxsize: int = EMBED_QUEUE_MAX,
+                 policy: BatchPolicy | None = None, limiter: AIMDLimiter | None = None):
+        self.workers = max(1, workers)
+        self.policy = policy or BatchPolicy()
+        self.limiter = limiter or AIMDLimiter()
+        # Очередь задач: (text, future, tokens, deadline) — deadline во времени loop'а
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        # Single-flight: нормализованный текст → future, общий для всех одновременных запросов
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._tasks: list[asyncio.Task] = []
+        self._closing = False
+        # Тот же формат и схема ключей, что и в backend.embedding, но через redis.asyncio,
+        # чтобы чтение кеша не блокировало event loop. Клиент живёт в loop'е пула.
+        self._redis: aioredis.Redis | None = None
+        self._redis_checked = False
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks) and not self._closing
+
+    def start(self):
+        """Запускает воркеры в текущем event loop (повторный вызов — no-op)."""
+        if self._closing:
+            raise RuntimeError("EmbeddingPool is stopped")
+        if self._tasks:
+            return
+        self._tasks = [asyncio.create_task(self._worker(), name=f"embed-worker-{i}")
+                       for i in range(self.workers)]
+
+    async def stop(self, timeout: float = EMBED_DRAIN_TIMEOUT):
+        """
+        Останавливает пул: новые задачи не принимаются, очередь дорабатывается
+        не дольше timeout, оставшиеся future завершаются ошибкой.
+        """
+        if self._closing:
+            return
+        self._closing = True
+        if self._tasks:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Embedding pool drain timed out, {self.queue.qsize()} tasks left")
+            for task in self._tasks:
+                task.cancel()
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            self._tasks = []
+
+        # Всё, что не успело обработаться, завершаем ошибкой — ожидающие не должны висеть
+        error = RuntimeError("EmbeddingPool stopped")
+        while not self.queue.empty():
+            future = self.queue.get_nowait()[1]
+            self.queue.task_done()
+            if not future.done():
+                future.set_exception(error)
+        for future in list(self._inflight.values()):
+            if not future.done():
+                future.set_exception(error)
+        metrics.EMBED_QUEUE_DEPTH.set(0)
+
+        if self._redis is not None:
+            try:
+                await self._redis.aclose()
+            except Exception:
+                pass
+            self._redis = None
+
+    async def embed(self, text: str, timeout: float | None = None,
+                    tokens: int | None = None) -> list[float]:
+        """
+        Эмбеддинг одного нормализованного текста, укладывающегося в лимит модели.
+        timeout — дедлайн вызывающего: повторы после 429/5xx не выходят за него,
+        по истечении поднимается asyncio.TimeoutError.
+        tokens — уже посчитанное число токенов (из split_counted); без него считаем сами.
+        """
+        # Попадание в кеш не затрагивает очередь батчей
+        if (cached := await self._cache_lookup(text)) is not None:
+            return cached
+
+        loop = asyncio.get_running_loop()
+        timeout = EMBED_DEADLINE_SEC if timeout is None else timeout
+        deadline = loop.time() + timeout
+
+        # Тот же текст уже в очереди или в батче — ждём его future, а не платим второй раз
+        if (pending := self._inflight.get(text)) is not None:
+            metrics.EMBED_DEDUP.labels(path="async").inc()
+            # shield: отмена одного из ожидающих не должна отменять общий future
+            return await asyncio.wait_for(asyncio.shield(pending), timeout)
+
+        self.start()
+        future = loop.create_future()
+        self._inflight[text] = future
+        future.add_done_callback(lambda _, text=text: self._inflight.pop(text, None))
         try:
-            # Ждем первую задачу с таймаутом, чтобы не блокироваться вечно
-            first_item = await asyncio.wait_for(queue.get(), timeout=1.0)
-            batch.append(first_item)
-            # Быстро собираем остальные задачи, если они есть
-            while len(batch) < BATCH_SIZE:
-                batch.append(queue.get_nowait())
-        except asyncio.TimeoutError:
-            continue # Если задач нет, просто ждем дальше
-        except asyncio.QueueEmpty:
-            pass # Если очередь опустела, обрабатываем то, что есть
-
-        if not batch:
-            continue
-
-        # Разделяем тексты и фьючерсы
-        texts_to_embed = [text for text, _ in batch]
-        futures = [fut for _, fut in batch]
+            # При заполненной очереди ждём здесь — это и есть backpressure
+            if tokens is None:
+                tokens = count_tokens(text, MODEL)
+            await asyncio.wait_for(self.queue.put((text, future, tokens, deadline)), timeout)
+        except BaseException:
+            if not future.done():
+                future.cancel()
+            raise
+        metrics.EMBED_QUEUE_DEPTH.set(self.queue.qsize())
+        return await asyncio.wait_for(asyncio.shield(future), max(0.0, deadline - loop.time()))
 
+    async def _get_cache(self) -> aioredis.Redis | None:
+        """Ленивая инициализация асинхронного Redis. None — кеш недоступен."""
+        if not self._redis_checked:
+            self._redis_checked = True
+            try:
+                client = aioredis.Redis(host=os.getenv("REDIS_HOST", "redis"), socket_connect_timeout=1)
+                await client.ping()
+                self._redis = client
+            except Exception as e:
+                logging.warning(f"Redis not available for embedding_pool cache: {e}")
+                self._redis = None
+        return self._redis
+
+    async def _cache_lookup(self, text: str) -> list[float] | None:
+        """Ищет эмбеддинг в LRU процесса, затем в Redis; ошибки Redis считаются промахом."""
+        key = _cache_key(text, MODEL)
+        if (vec := _mem_get(key)) is not None:
+            return vec.tolist()
+        cache = await self._get_cache()
+        if cache is None:
+            return None
         try:
-            # Убеждаемся, что клиент инициализирован
-            _ensure_client()
-            # Выполняем запрос к OpenAI API
-            response = await client.embeddings.create(model=MODEL, input=texts_to_embed)
-            vectors = response.data
-
-            # Распределяем результаты по фьючерсам
-            for future, vector in zip(futures, vectors):
-                future.set_result(vector.embedding)
+            raw = await cache.get(key)
         except Exception as e:
-            print(f"❌ Error processing embedding batch: {e}")
-            # В случае ошибки завершаем все фьючерсы в батче с ошибкой
-            for future in futures:
-                if not future.done():
-                    future.set_exception(e)
-
-# --- Запуск воркера ---
-# Глобальная переменная для отслеживания, запущен ли воркер
-_worker_task = None
-
-def _ensure_worker_started():
-    """Проверяет, что воркер запущен. Если нет - запускает его."""
-    global _worker_task
-    if _worker_task is None or _worker_task.done():
+            logging.warning(f"Embedding cache read error: {e}")
+            return None
+        metrics.EMBED_CACHE.labels(tier="redis", result="hit" if raw else "miss").inc()
+        if not raw:
+            return None
+        vec = _unpack(raw)
+        if vec is None:
+            return None
+        _mem_put(key, vec)
+        return vec.tolist()
+
+    async def _cache_store_many(self, texts: list[str], vectors: list[list[float]]):
+        """Пишет результаты батча в LRU процесса и в Redis одним pipeline-запросом."""
+        for text, vec in zip(texts, vectors):
+            _mem_put(_cache_key(text, MODEL), vec)
+        cache = await self._get_cache()
+        if cache is None or not texts:
+            return
         try:
-            _worker_task = asyncio.create_task(worker())
-        except RuntimeError:
-            # Если нет активного event loop, воркер будет запущен при первом вызове
-            pass
+            async with cache.pipeline(transaction=False) as pipe:
+                for text, vec in zip(texts, vectors):
+                    pipe.set(_cache_key(text, MODEL), _pack(vec), ex=_CACHE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logging.warning(f"Embedding cache write error: {e}")
+
+    async def _collect_batch(self, first, loop) -> tuple[list, tuple | None]:
+        """
+        Добирает батч после первой задачи: до лимита policy, не дольше linger
+        и не больше бюджета токенов. Задача, не влезшая по токенам, возвращается
+        отдельно и открывает следующий батч.
+        """
+        policy, queue = self.policy, self.queue
+        batch, tokens = [first], first[2]
+        started = loop.time()
+        deadline = started + policy.linger
+        carry = None
+        while len(batch) < policy.limit:
+            try:
+                item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=remaining)
+                except asyncio.TimeoutError:
+                    break
+            if tokens + item[2] > policy.token_budget:
+                carry = item
+                break
+            batch.append(item)
+            tokens += item[2]
+
+        metrics.EMBED_BATCH_LINGER.observe(loop.time() - started)
+        metrics.EMBED_BATCH_FILL.observe(len(batch) / policy.limit)
+        metrics.EMBED_QUEUE_DEPTH.set(queue.qsize())
+        return batch, carry
+
+    async def _worker(self):
+        """
+        Воркер: ждёт первую задачу (без опроса по таймауту), добирает батч,
+        отправляет его одним запросом и раздаёт результаты по future.
+        """
+        loop = asyncio.get_running_loop()
+        carry = None
+        while True:
+            if carry is None:
+                first_item = await self.queue.get()
+            else:
+                first_item, carry = carry, None
 
-async def get_embedding_async(text: str) -> list[float]:
+            batch, carry = await self._collect_batch(first_item, loop)
+            try:
+                await self._process(batch, loop)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def _process(self, batch: list, loop):
+        """
+        Отправляет батч под AIMD-лимитером. 429/5xx/сетевые ошибки повторяются
+        с jitter-backoff (не раньше Retry-After); задачи, чей дедлайн наступит
+        раньше следующей попытки, завершаются TimeoutError, остальные ждут повтора.
+        """
+        attempt = 0
+        while True:
+            # Разделяем тексты и фьючерсы
+            texts_to_embed = [item[0] for item in batch]
+            futures = [item[1] for item in batch]
+            try:
+                async with self.limiter:
+                    t0 = loop.time()
+                    vectors = await _embed_batch(texts_to_embed)
+                self.limiter.on_success()
+                self.policy.observe(loop.time() - t0, len(batch))
+                break
+            except Exception as e:
+                reason = retry_reason(e)
+                if reason is None or attempt >= EMBED_RETRY_MAX:
+                    print(f"❌ Error processing embedding batch: {e}")
+                    metrics.EMBED_GIVEUP.labels(reason="exhausted" if reason else "fatal").inc()
+                    # В случае ошибки завершаем все фьючерсы в батче с ошибкой
+                    for future in futures:
+                        if not future.done():
+                            future.set_exception(e)
+                    return
+                if reason in ("429", "5xx"):
+                    self.limiter.on_overload()
+                delay = retry_delay(e, attempt, EMBED_RETRY_BASE_MS / 1000, EMBED_RETRY_CAP_SEC)
+                retry_at = loop.time() + delay
+                keep = []
+                for item in batch:
+                    if item[1].done():
+                        continue
+                    if item[3] < retry_at:
+                        metrics.EMBED_GIVEUP.labels(reason="deadline").inc()
+                        item[1].set_exception(asyncio.TimeoutError(
+                            f"embedding deadline exceeded after {reason}"))
+                    else:
+                        keep.append(item)
+                if not keep:
+                    return
+                batch = keep
+                attempt += 1
+                metrics.EMBED_RETRIES.labels(reason=reason).inc()
+                logging.warning(f"Embedding batch of {len(batch)} failed ({reason}), retry in {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+        # Распределяем результаты по фьючерсам
+        for future, vector in zip(futures, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+        # Ожидающие уже получили результат — пишем батч в кеш
+        await self._cache_store_many(texts_to_embed, vectors)
+
+
+# --- Пул на event loop ---
+# asyncio-примитивы привязаны к loop'у, поэтому у каждого loop'а свой пул
+# (тесты, asyncio.run в скриптах, несколько uvicorn-воркеров не делят очередь).
+_pools: dict[asyncio.AbstractEventLoop, EmbeddingPool] = {}
+
+def get_pool() -> EmbeddingPool:
+    """Пул текущего event loop'а; создаётся при первом обращении."""
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None or pool._closing:
+        for stale in [l for l in _pools if l.is_closed()]:
+            del _pools[stale]
+        pool = _pools[loop] = EmbeddingPool()
+    return pool
+
+async def start():
+    """Запуск пула текущего loop'а (FastAPI lifespan)."""
+    get_pool().start()
+
+async def stop(timeout: float = EMBED_DRAIN_TIMEOUT):
+    """Остановка пула текущего loop'а с дренажом очереди."""
+    pool = _pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.stop(timeout)
+
+async def get_embedding_async(text: str, timeout: float | None = None) -> list[float]:
     """
     Асинхронная функция для получения эмбеддинга текста.
-    Добавляет текст в очередь и ждет результата от воркера.
+    Добавляет текст в очередь пула текущего loop'а и ждет результата от воркера
+    не дольше timeout (по умолчанию EMBED_DEADLINE_SEC).
     """
-    # Убираем лишние пробелы и переносы строк
-    text = text.strip().replace("\n", " ")
+    # Убираем лишние пробелы и переносы строк (как в синхронном пути)
+    text = _normalize(text)
     if not text:
         # Возвращаем пустой вектор для пустых строк
         return []
 
-    # Убеждаемся, что воркер запущен
-    _ensure_worker_started()
-
-    loop = asyncio.get_running_loop()
-    future = loop.create_future()
-    await queue.put((text, future))
-    return await future
+    # Дедлайн хода (если задан) ограничивает ожидание эмбеддинга
+    timeout = deadline.clamp(EMBED_DEADLINE_SEC if timeout is None else timeout)
+    pool = get_pool()
+    # Текст длиннее лимита модели: куски идут через тот же батчер и сводятся mean-pooling'ом.
+    # Число токенов из split_counted уходит в очередь — повторно не считаем
+    chunks = split_counted(text)
+    if len(chunks) > 1:
+        vectors = await asyncio.gather(*(pool.embed(chunk, timeout, n) for chunk, n in chunks))
+        return _mean_pool(vectors, [n for _, n in chunks])
+    chunk, n = chunks[0]
+    return await pool.embed(chunk, timeout, n)
@@ -20,7 +20,8 @@ class Chat(chat_grpc.ChatBase):
                 pb_msg = chat_pb2.ChatMessage(
                     role=msg.get("role", ""),
                     content=msg.get("content", ""),
-                    status=msg.get("status", "")
+                    status=msg.get("status", ""),
+                    partial=msg.get("type") == "chunk",
                 )
                 await stream.send_message(pb_msg)
                 
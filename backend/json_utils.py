@@ -33,3 +33,59 @@ def safe_load(text: str) -> dict:
             except json.JSONDecodeError:
                 pass
         raise BadJSON(f"{exc}. RAW: {text[:280]}…") from exc
+
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonFieldStreamer:
+    """
+    Инкрементально достаёт значение строкового поля из JSON, который приходит
+    кусками (стриминг LLM). feed() возвращает только новую часть значения,
+    уже раскодированную из JSON-escape.
+    """
+
+    def __init__(self, field: str):
+        self._key = re.compile(r'"%s"\s*:\s*"' % re.escape(field))
+        self._buf = ""
+        self._pos: int | None = None
+        self._done = False
+
+    def feed(self, chunk: str) -> str:
+        if self._done:
+            return ""
+        self._buf += chunk
+        if self._pos is None:
+            m = self._key.search(self._buf)
+            if not m:
+                return ""
+            self._pos = m.end()
+
+        buf, i, out = self._buf, self._pos, []
+        while i < len(buf):
+            ch = buf[i]
+            if ch == '"':
+                self._done = True
+                i += 1
+                break
+            if ch == "\\":
+                # Незавершённый escape — ждём следующий кусок
+                if i + 1 >= len(buf):
+                    break
+                esc = buf[i + 1]
+                if esc == "u":
+                    if i + 6 > len(buf):
+                        break
+                    try:
+                        out.append(chr(int(buf[i + 2:i + 6], 16)))
+                    except ValueError:
+                        out.append(buf[i:i + 6])
+                    i += 6
+                    continue
+                out.append(_ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            out.append(ch)
+            i += 1
+        self._pos = i
+        return "".join(out)
@@ -0,0 +1,138 @@
+"""
+Кеш ответов LLM: явный cache=True или temperature=0 на местах вызова из SITE_TTLS
+(кроме reasoning-моделей — они игнорируют temperature).
+Два уровня, как у эмбеддингов: LRU в памяти процесса и Redis.
+Ключ — модель, хеш промпта, tools и temperature; TTL задаётся по месту вызова.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from dataclasses import dataclass
+
+import redis
+
+from backend import metrics
+from backend.lru_cache import LRUCache
+
+ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") not in ("0", "false", "False")
+DEFAULT_TTL = int(os.getenv("LLM_CACHE_TTL_SEC", "3600"))
+
+# TTL по месту вызова: классификация интента стабильна дольше черновика планировщика,
+# который зависит от содержимого базы знаний. Переопределяется LLM_CACHE_TTL_<SITE>.
+SITE_TTLS = {
+    "intent": 6 * 3600,
+    "critic": 24 * 3600,
+    "planner": 1800,
+}
+
+_LRU_MAX_BYTES = int(os.getenv("LLM_CACHE_LRU_MAX_BYTES", str(16 * 1024 * 1024)))
+_mem = LRUCache(_LRU_MAX_BYTES)
+
+_r: redis.Redis | None = None
+_r_checked = False
+
+
+@dataclass(frozen=True)
+class CachePolicy:
+    key: str
+    ttl: int
+
+
+def site_ttl(site: str | None) -> int:
+    if site is None:
+        return DEFAULT_TTL
+    env = os.getenv(f"LLM_CACHE_TTL_{site.upper()}")
+    if env is not None:
+        return int(env)
+    return SITE_TTLS.get(site, DEFAULT_TTL)
+
+
+# o-серия не принимает temperature: ответ недетерминирован и при temperature=0
+_REASONING_PREFIXES = ("o1", "o3", "o4")
+
+
+def _auto_cached_site(site: str | None) -> bool:
+    return site is not None and (site in SITE_TTLS or os.getenv(f"LLM_CACHE_TTL_{site.upper()}") is not None)
+
+
+def policy(model: str, prompt: str, tools: list | None, temperature: float,
+           cache: bool | None = None, site: str | None = None) -> CachePolicy | None:
+    """
+    Решает, кешировать ли вызов. Без явного cache — только temperature=0 на месте вызова
+    из SITE_TTLS (или с LLM_CACHE_TTL_<SITE>) и не для reasoning-моделей;
+    cache=True включает кеш явно, cache=False выключает.
+    """
+    if not ENABLED or cache is False:
+        return None
+    if cache is None and (temperature != 0 or not _auto_cached_site(site)
+                          or model.startswith(_REASONING_PREFIXES)):
+        return None
+    ttl = site_ttl(site)
+    if ttl <= 0:
+        return None
+    payload = json.dumps({"p": prompt, "tools": tools, "t": temperature},
+                         ensure_ascii=False, sort_keys=True, default=str)
+    digest = hashlib.sha256(payload.encode()).hexdigest()
+    return CachePolicy(key=f"llm:{model}:{digest}", ttl=ttl)
+
+
+def _get_redis() -> redis.Redis | None:
+    """Ленивая инициализация Redis. None — второй уровень недоступен, работает только LRU."""
+    global _r, _r_checked
+    if not _r_checked:
+        _r_checked = True
+        try:
+            client = redis.Redis(host=os.getenv("REDIS_HOST", "redis"),
+                                 socket_connect_timeout=1, socket_timeout=0.5)
+            client.ping()
+            _r = client
+        except Exception as e:
+            logging.warning(f"Redis not available for LLM cache: {e}")
+            _r = None
+    return _r
+
+
+def _redis_get(key: str) -> bytes | None:
+    r = _get_redis()
+    return r.get(key) if r is not None else None
+
+
+def _redis_set(key: str, value: str, ttl: int):
+    r = _get_redis()
+    if r is not None:
+        r.set(key, value.encode(), ex=ttl)
+
+
+async def get(p: CachePolicy, model: str) -> str | None:
+    """Ответ из LRU процесса, затем из Redis; ошибки Redis считаются промахом."""
+    if (value := _mem.get(p.key)) is not None:
+        metrics.LLM_CACHE.labels(model=model, tier="memory", result="hit").inc()
+        return value
+    metrics.LLM_CACHE.labels(model=model, tier="memory", result="miss").inc()
+    try:
+        # Синхронный клиент в потоке: не зависит от event loop вызывающего
+        raw = await asyncio.to_thread(_redis_get, p.key)
+    except Exception as e:
+        logging.warning(f"LLM cache read error: {e}")
+        return None
+    metrics.LLM_CACHE.labels(model=model, tier="redis", result="hit" if raw else "miss").inc()
+    if not raw:
+        return None
+    value = raw.decode()
+    _mem.put(p.key, value, ttl=p.ttl)
+    return value
+
+
+async def put(p: CachePolicy, value: str):
+    _mem.put(p.key, value, ttl=p.ttl)
+    try:
+        await asyncio.to_thread(_redis_set, p.key, value, p.ttl)
+    except Exception as e:
+        logging.warning(f"LLM cache write error: {e}")
+
+
+def flush_local() -> int:
+    """Сбрасывает LRU-уровень, возвращает число удалённых записей."""
+    return _mem.flush()
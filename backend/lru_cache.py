@@ -0,0 +1,81 @@
+"""
+Ограниченный по памяти LRU-кеш в процессе (с TTL).
+Используется как первый уровень перед Redis: попадание стоит микросекунды, а не RTT.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+def _default_sizeof(value: Any) -> int:
+    """Размер значения в байтах: nbytes у numpy-массивов, len у bytes/str."""
+    nbytes = getattr(value, "nbytes", None)
+    if nbytes is not None:
+        return int(nbytes)
+    return len(value)
+
+
+class LRUCache:
+    """
+    LRU-кеш с лимитом в байтах и TTL записей.
+    Потокобезопасен: синхронный путь эмбеддингов вызывается и из worker-потоков.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float | None = None,
+                 sizeof: Callable[[Any], int] = _default_sizeof):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof
+        self._data: OrderedDict[str, tuple[Any, float, int]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires, _ = entry
+            if expires and expires < time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: str, value: Any, ttl: float | None = None):
+        size = self._sizeof(value)
+        if size > self.max_bytes:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else 0.0
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (value, expires, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def flush(self) -> int:
+        """Очищает кеш, возвращает количество удалённых записей."""
+        with self._lock:
+            n = len(self._data)
+            self._data.clear()
+            self.bytes = 0
+            return n
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _drop(self, key: str):
+        _, _, size = self._data.pop(key)
+        self.bytes -= size
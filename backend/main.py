@@ -13,7 +13,8 @@ from backend.env_validator import validate_environment
 from prometheus_fastapi_instrumentator import Instrumentator
 # from backend import grpc_server  # Temporarily disabled due to protobuf version conflict
 from backend.chat_core import chat_stream
-from backend import metrics
+from agents import intent_fastpath
+from backend import metrics, embedding_pool, usage
 from backend.log_streamer import log_streamer
 from sse_starlette.sse import EventSourceResponse
 import json
@@ -36,9 +37,16 @@ async def lifespan(app: FastAPI):
     await setup_qdrant(recreate_collection=True) # Создаем коллекцию при старте
     # Запускаем Prometheus metrics сервер
     metrics.init()
+    # Воркеры батчера эмбеддингов живут в loop'е приложения
+    await embedding_pool.start()
+    # Центроиды локального классификатора интента считаются заранее, а не в первом ходе
+    intent_fastpath.warm_up()
     yield
     # Действия при завершении
     logger.info("Application shutdown")
+    await embedding_pool.stop()
+    # Дописываем накопленный учёт токенов
+    await usage.flush()
 
 
 app = FastAPI(
@@ -93,6 +101,18 @@ def version():
         ]
     }
 
+@app.post("/admin/cache/embeddings/flush")
+def flush_embedding_cache():
+    """Сбрасывает LRU эмбеддингов в памяти процесса (Redis-уровень не затрагивается)."""
+    from backend.embedding import flush_local_cache
+    return {"flushed": flush_local_cache()}
+
+@app.post("/admin/cache/llm/flush")
+def flush_llm_cache():
+    """Сбрасывает LRU ответов LLM в памяти процесса (Redis-уровень не затрагивается)."""
+    from backend import llm_cache
+    return {"flushed": llm_cache.flush_local()}
+
 @app.get("/validate")
 async def validate():
     """Validate environment configuration and external dependencies"""
@@ -117,6 +137,9 @@ async def chat(ws: WebSocket):
     status_task = None
     stream_task = None
     q_in, q_out = asyncio.Queue(), asyncio.Queue()
+    # Клиент отключился (или закрыт нами по rate limit) — ответ некому отдать,
+    # текущий ход отменяется; в остальных случаях chat_stream дорабатывает его
+    client_gone = False
     try:
         await ws.accept()
         print("✅ WebSocket connection accepted")
@@ -126,16 +149,20 @@ async def chat(ws: WebSocket):
         await ws.send_json({"type": "session", "sessionId": thread_id})
         # Запускаем перенаправление статуса и обработчик чата
         status_task = asyncio.create_task(_status_forwarder(ws, thread_id))
-        stream_task = asyncio.create_task(chat_stream(thread_id, q_in, q_out))
-        print(f"📡 Status forwarder and chat stream started for thread {thread_id}")
-        # Получаем IP клиента для rate limiting
+        # Получаем IP клиента для rate limiting и бюджета токенов
         client_ip = ws.client.host if ws.client else "unknown"
+        stream_task = asyncio.create_task(chat_stream(thread_id, q_in, q_out, client_ip))
+        print(f"📡 Status forwarder and chat stream started for thread {thread_id}")
         # Запускаем sender для отправки сообщений из очереди в WebSocket
         async def sender():
             while True:
                 resp = await q_out.get()
                 if resp is None:  # Сигнал для завершения
                     break
+                if resp.get("type") == "chunk":
+                    # Фрагменты стрима отправляем без логирования каждого
+                    await ws.send_json(resp)
+                    continue
                 print(f"📤 Sending response: {resp}")
                 await ws.send_json(resp)
                 print("✅ Response sent successfully")
@@ -148,6 +175,7 @@ async def chat(ws: WebSocket):
             if await check_rate_limit(client_ip):
                 logger.warning(f"Rate limit exceeded for IP: {client_ip}")
                 await ws.close(code=4008, reason="Rate limit exceeded")
+                client_gone = True
                 break
             await q_in.put(data)
             # Закрыть цикл после одного сообщения в тестовом режиме
@@ -155,6 +183,7 @@ async def chat(ws: WebSocket):
                 break
     except WebSocketDisconnect as e:
         print(f"🔌 WebSocket disconnected normally: {e}")
+        client_gone = True
     except Exception as e:
         print(f"❌ WebSocket error: {e}")
         traceback.print_exc()
@@ -164,11 +193,14 @@ async def chat(ws: WebSocket):
             print("🛑 Cancelling status forwarder task")
             status_task.cancel()
         
-        # Корректное завершение
-        if q_in:
-            await q_in.put(None) # Сигнал для chat_stream
         if stream_task and not stream_task.done():
-            await stream_task
+            if client_gone:
+                print("🛑 Cancelling in-flight turn: client is gone")
+                stream_task.cancel()
+            else:
+                await q_in.put(None)  # Сигнал для chat_stream: доработать текущий ход и выйти
+            # chat_stream сам гасит свой status_forward (в т.ч. при отмене)
+            await asyncio.gather(stream_task, return_exceptions=True)
         if q_out:
             await q_out.put(None) # Сигнал для sender_task
 
@@ -9,6 +9,68 @@ LAT = Histogram("ib_stage_latency_sec", "Latency по стадиям", ["stage"]
 STATUS_BUS_THROUGHPUT = Counter("ib_status_bus_throughput", "Status Bus throughput", ["stage"])
 EXPERT_GC_CALLS = Counter("ib_expert_gc_calls_total", "Количество вызовов Expert-GC")
 
+# Батчинг эмбеддингов (backend.embedding_pool)
+EMBED_BATCH_FILL = Histogram("ib_embed_batch_fill_ratio", "Заполненность батча эмбеддингов относительно лимита",
+                             buckets=(0.1, 0.25, 0.5, 0.75, 0.9, 1.0))
+EMBED_BATCH_LINGER = Histogram("ib_embed_batch_linger_sec", "Время добора батча эмбеддингов",
+                               buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1))
+EMBED_QUEUE_DEPTH = Gauge("ib_embed_queue_depth", "Задач в очереди эмбеддингов")
+EMBED_BATCH_LIMIT = Gauge("ib_embed_batch_limit", "Текущий адаптивный лимит размера батча эмбеддингов")
+EMBED_CONCURRENCY_LIMIT = Gauge("ib_embed_concurrency_limit", "Текущий AIMD-лимит одновременных запросов эмбеддингов")
+EMBED_RETRIES = Counter("ib_embed_retries_total", "Повторы батчей эмбеддингов", ["reason"])  # reason=429|5xx|timeout|connection
+EMBED_GIVEUP = Counter("ib_embed_giveup_total", "Задачи эмбеддингов, завершённые ошибкой", ["reason"])  # reason=deadline|exhausted|fatal
+
+# Двухуровневый кеш эмбеддингов (LRU процесса + Redis)
+EMBED_CACHE = Counter("ib_embed_cache_total", "Обращения к кешу эмбеддингов", ["tier", "result"])  # tier=memory|redis
+EMBED_LRU_BYTES = Gauge("ib_embed_lru_bytes", "Объём LRU-кеша эмбеддингов в памяти процесса")
+EMBED_DEDUP = Counter("ib_embed_dedup_total", "Запросы эмбеддингов, присоединённые к уже выполняющимся", ["path"])  # path=sync|async
+
+# Кеш ответов LLM (backend.llm_cache)
+LLM_CACHE = Counter("ib_llm_cache_total", "Обращения к кешу ответов LLM", ["model", "tier", "result"])  # tier=memory|redis
+
+# Токены по моделям — из usage ответов API (backend.usage)
+LLM_TOKENS = Counter("ib_llm_tokens_total", "Токены LLM по данным API", ["model", "kind"])  # kind=prompt|completion
+
+# Бюджет токенов на сессию/IP (backend.token_budget)
+TOKEN_BUDGET_USAGE = Histogram("ib_token_budget_usage_ratio", "Доля израсходованного бюджета токенов при проверке",
+                               ["scope"], buckets=(0.25, 0.5, 0.75, 0.8, 0.9, 1.0))  # scope=session|ip
+TOKEN_BUDGET_EXCEEDED = Counter("ib_token_budget_exceeded_total", "Проверки сверх лимита токенов", ["scope", "level"])  # level=soft|hard
+TOKEN_BUDGET_LIMIT = Gauge("ib_token_budget_limit_tokens", "Настроенный лимит токенов", ["scope"])
+
+# Выбор модели роутером (backend.model_router); reason=primary|fallback|all_degraded
+LLM_ROUTE = Counter("ib_llm_route_total", "Выбор модели по классу места вызова", ["route", "model", "reason"])
+
+# Кассета запись/воспроизведение (backend.cassette); result=hit|miss|recorded
+LLM_CASSETTE = Counter("ib_llm_cassette_total", "Обращения к кассете ответов", ["kind", "result"])
+
+# Локальный классификатор интента: source=rule|centroid|llm — кто принял решение
+INTENT_FASTPATH = Counter("ib_intent_fastpath_total", "Решения классификатора интента", ["source"])
+INTENT_AGREEMENT = Counter("ib_intent_fastpath_agreement_total", "Совпадение локального интента с LLM", ["result"])  # agree|disagree
+INTENT_TIME_SAVED = Counter("ib_intent_fastpath_saved_seconds_total", "Сэкономленное время LLM-классификации (по p50 модели)")
+
+# Спекулятивный kb_search параллельно с классификацией интента (agents/dialog_manager.py)
+KB_SPECULATION = Counter("ib_kb_speculation_total", "Исход спекулятивного kb_search", ["result"])  # used|cancelled
+KB_SPECULATION_SECONDS = Counter("ib_kb_speculation_seconds_total",
+                                 "Время спекулятивного kb_search: перекрытое классификацией или выброшенное",
+                                 ["kind"])  # saved|wasted
+
+# Ходы, отменённые после отключения клиента (backend.chat_core); сэкономленное — оценка
+# по медиане завершённых ходов за вычетом уже потраченного
+TURN_CANCELLED = Counter("ib_turn_cancelled_total", "Ходы, отменённые после отключения клиента")
+CANCEL_SAVED_SECONDS = Counter("ib_turn_cancel_saved_seconds_total", "Оценка времени, сэкономленного отменой хода")
+CANCEL_SAVED_TOKENS = Counter("ib_turn_cancel_saved_tokens_total", "Оценка токенов, сэкономленных отменой хода")
+
+# Склейка одинаковых вопросов разных сессий (backend.coalesce); role=leader|follower|overflow
+COALESCE = Counter("ib_coalesce_total", "Ходы по роли в склейке одинаковых вопросов", ["role"])
+COALESCE_FANOUT = Histogram("ib_coalesce_fanout", "Ведомых сессий на один выполненный ход",
+                            buckets=(0, 1, 2, 5, 10, 20, 50))
+COALESCE_SHARED_TOKENS = Counter("ib_coalesce_shared_tokens_total",
+                                 "Токены склеенных прогонов, списанные с бюджетов ведомых сессий")
+
+# Повторы и хеджирование вызовов LLM (backend.openai_helpers)
+LLM_RETRIES = Counter("ib_llm_retries_total", "Повторы вызовов LLM в пределах бюджета", ["model", "reason"])  # reason=429|5xx|timeout|connection
+LLM_HEDGE = Counter("ib_llm_hedge_total", "Хеджированные запросы LLM", ["model", "result"])  # result=fired|primary_won|hedge_won
+
 _initialized = False
 
 def init(port: int = None):
@@ -0,0 +1,146 @@
+"""
+Маршрутизация моделей по классам мест вызова (classify, plan, critic, expert, aggregate).
+По каждой модели в процессе копится окно исходов вызовов: p50/p95 задержки успешных
+и доля ошибок. Модель, у которой p95 выходит за SLO класса или много ошибок,
+считается деградировавшей, и трафик уходит дальше по цепочке fallback.
+"""
+import collections
+import logging
+import threading
+import time
+
+from backend import config, metrics
+
+logger = logging.getLogger(__name__)
+
+# Место вызова (site у call_llm) → класс маршрутизации
+SITE_CLASSES = {
+    "intent": "classify",
+    "small_talk": "classify",
+    "planner": "plan",
+    "critic": "critic",
+}
+
+
+class ModelStats:
+    """
+    Скользящее окно исходов вызовов модели: задержки успешных и ошибки.
+    Исходы старше ROUTER_WINDOW_SEC отбрасываются — иначе деградировавшая модель,
+    на которую route() больше не шлёт трафик, осталась бы деградировавшей навсегда.
+    """
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self._samples = collections.deque(maxlen=size)  # (monotonic, ok, seconds)
+        self._lock = threading.Lock()
+        self.min_samples = min_samples
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append((time.monotonic(), True, seconds))
+
+    def add_error(self):
+        with self._lock:
+            self._samples.append((time.monotonic(), False, 0.0))
+
+    def _window(self) -> list[tuple[float, bool, float]]:
+        horizon = time.monotonic() - float(config.config.ROUTER_WINDOW_SEC)
+        with self._lock:
+            while self._samples and self._samples[0][0] < horizon:
+                self._samples.popleft()
+            return list(self._samples)
+
+    def quantile(self, q: float) -> float | None:
+        ordered = sorted(s for _, ok, s in self._window() if ok)
+        if len(ordered) < self.min_samples:
+            return None
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def error_rate(self) -> float | None:
+        samples = self._window()
+        if len(samples) < self.min_samples:
+            return None
+        return sum(1 for _, ok, _ in samples if not ok) / len(samples)
+
+
+# Ключ — модель (полная задержка ответа: хедж и SLO) или (модель, "ttft") для стримов
+stats: dict[str | tuple[str, str], ModelStats] = collections.defaultdict(ModelStats)
+
+
+def _pairs(raw: str) -> dict[str, str]:
+    """"a:x,b:y" → {"a": "x", "b": "y"}"""
+    pairs = (p.split(":", 1) for p in str(raw).split(",") if ":" in p)
+    return {k.strip(): v.strip() for k, v in pairs}
+
+
+def _setting(name: str) -> str | None:
+    try:
+        return getattr(config.config, name)
+    except AttributeError:
+        return None
+
+
+def route_class(site: str | None) -> str:
+    return SITE_CLASSES.get(site, site) if site else "default"
+
+
+def chain(site: str | None, model: str) -> list[str]:
+    """
+    Цепочка кандидатов: ROUTE_<CLASS>="m1,m2,…", если задан,
+    иначе модель вызывающего и её fallback'и из MODEL_FALLBACKS ("model:fb1|fb2,…").
+    """
+    explicit = _setting(f"ROUTE_{route_class(site).upper()}")
+    if explicit:
+        return [m.strip() for m in str(explicit).split(",") if m.strip()]
+    fallbacks = _pairs(config.config.MODEL_FALLBACKS).get(model, "")
+    models = [model] + [m.strip() for m in fallbacks.split("|") if m.strip()]
+    return list(dict.fromkeys(models))
+
+
+def slo(site: str | None) -> float:
+    """
+    Порог p95 для класса: ROUTER_P95_SLO_<CLASS>_SEC или доля ROUTER_SLO_RATIO
+    от бюджета места вызова — иначе повторы и хедж уже не укладываются в бюджет.
+    """
+    cfg = config.config
+    explicit = _setting(f"ROUTER_P95_SLO_{route_class(site).upper()}_SEC")
+    if explicit is not None:
+        return float(explicit)
+    budget = cfg.LLM_TIMEOUT_SEC
+    if site:
+        budget = _setting(f"LLM_BUDGET_{site.upper()}_SEC") or budget
+    return float(budget) * float(cfg.ROUTER_SLO_RATIO)
+
+
+def degraded(model: str, site: str | None) -> bool:
+    s = stats[model]
+    p95, errors = s.quantile(0.95), s.error_rate()
+    return (p95 is not None and p95 > slo(site)) or \
+        (errors is not None and errors > float(config.config.ROUTER_MAX_ERROR_RATE))
+
+
+def _cost(model: str) -> float:
+    return float(_pairs(config.config.MODEL_COSTS).get(model, 0))
+
+
+def route(site: str | None, model: str) -> str:
+    """
+    Модель для вызова. Среди здоровых кандидатов — первая по цепочке с поправкой
+    на стоимость (ROUTER_COST_WEIGHT × MODEL_COSTS); если деградировали все —
+    та, у которой сейчас меньше p95 с учётом ошибок.
+    """
+    candidates = chain(site, model)
+    healthy = [m for m in candidates if not degraded(m, site)]
+    if healthy:
+        weight = float(config.config.ROUTER_COST_WEIGHT)
+        chosen = min(healthy, key=lambda m: candidates.index(m) + weight * _cost(m))
+        reason = "primary" if chosen == candidates[0] else "fallback"
+    else:
+        def expected(m: str) -> float:
+            s = stats[m]
+            return (s.quantile(0.95) or 0.0) * (1 + (s.error_rate() or 0.0))
+        chosen = min(candidates, key=expected)
+        reason = "all_degraded"
+    if reason != "primary":
+        logger.info(f"Model route {route_class(site)}: {candidates[0]} → {chosen} ({reason})")
+    metrics.LLM_ROUTE.labels(route=route_class(site), model=chosen, reason=reason).inc()
+    return chosen
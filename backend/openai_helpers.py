@@ -4,11 +4,19 @@ import openai
 import time
 import json
 import logging
-from openai import OpenAI, AsyncClient
+import re
+import asyncio
+import collections
+import httpx
+from contextvars import ContextVar
+from types import SimpleNamespace
+from typing import AsyncIterator, Awaitable, Callable
+from openai import OpenAI, AsyncClient, DefaultAsyncHttpxClient
 from backend.utils import is_test_mode
-from backend.token_counter import count_tokens
+from backend.token_counter import count_tokens, count_tokens_many
 from qdrant_client import QdrantClient, models
-from backend import config
+from backend import config, llm_cache, deadline, metrics, usage, token_budget, model_router, cassette
+from backend.retry import retry_reason, retry_delay
 
 logger = logging.getLogger(__name__)
 
@@ -37,14 +45,41 @@ def _get_async_client() -> AsyncClient:
             raise RuntimeError("OPENAI_API_KEY env var missing or dummy")
 
     if _async_client is None or _async_client.api_key != api_key:
-        _async_client = AsyncClient(api_key=api_key)
+        cfg = config.config
+        # Встроенные повторы SDK выключены: повторяют call_llm и пул эмбеддингов,
+        # с учётом дедлайна хода и AIMD-лимитера
+        _async_client = AsyncClient(
+            api_key=api_key,
+            timeout=openai.Timeout(cfg.LLM_TIMEOUT_SEC, connect=cfg.LLM_CONNECT_TIMEOUT_SEC),
+            max_retries=0,
+            http_client=_make_http_client(),
+        )
     return _async_client
 
+def _make_http_client() -> httpx.AsyncClient:
+    """
+    Общий пул соединений для всех async-вызовов OpenAI (LLM, эмбеддинги, browser).
+    Keep-alive соединения переиспользуются между сессиями; таймауты задаются
+    на клиенте и переопределяются на уровне вызова.
+    """
+    cfg = config.config
+    return DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=int(cfg.OPENAI_MAX_CONNECTIONS),
+            max_keepalive_connections=int(cfg.OPENAI_MAX_KEEPALIVE),
+            keepalive_expiry=30,
+        ),
+    )
+
 async def browser_search(query: str, k: int = 5) -> str:
     """
     Выполняет web-поиск через OpenAI Browser-tool.
     Возвращает markdown-список заголовок+URL+excerpt (k результатов).
     """
+    tape_key = cassette.key("browser", query=query, k=k) if cassette.MODE != "off" else None
+    if cassette.replaying() and (hit := await cassette.replay("browser", tape_key)) is not None:
+        return hit.text
+    t0 = time.time()
     client = _get_async_client()
     resp = await client.chat.completions.create(
         model="o3-mini",
@@ -58,23 +93,48 @@ async def browser_search(query: str, k: int = 5) -> str:
     if resp.tools_output and resp.tools_output[0].get("results"):
         for item in resp.tools_output[0]["results"][:k]:
             snippets.append(f"- **{item['title']}** — {item['url']}\n  {item['excerpt']}")
-    return "\n".join(snippets)
+    result = "\n".join(snippets)
+    if cassette.recording():
+        await cassette.record("browser", tape_key, result, int((time.time() - t0) * 1000))
+    return result
 
-async def call_llm(model: str, prompt: str, tools: list | None = None, temperature: float = 0, thread_id: str = None, turn_index: int = None):
+async def _resolve_model(site: str | None, model: str) -> str:
+    """Модель вызова после роутера и бюджета токенов (на мягком лимите — дешевле)."""
+    model = model_router.route(site, model)
+    if await token_budget.enforce() == token_budget.SOFT:
+        model = token_budget.downgrade(model)
+    return model
+
+async def call_llm(model: str, prompt: str, tools: list | None = None, temperature: float = 0, thread_id: str = None, turn_index: int = None,
+                   timeout: float | None = None, cache: bool | None = None, site: str | None = None):
     """
     Вызов LLM с проверкой API ключа, поддержкой stub-режима и учетом токенов
     Возвращает ответ и время задержки в миллисекундах.
+    Запрос идёт через AsyncClient и не блокирует event loop.
+    site — место вызова (intent, small_talk, critic, planner…): задаёт бюджет
+    времени (LLM_BUDGET_<SITE>_SEC) и TTL кеша. Бюджет урезается до остатка
+    дедлайна хода (backend.deadline); временные ошибки повторяются, пока он не исчерпан.
+    Ответ берётся из кеша backend.llm_cache при cache=True или temperature=0
+    на месте вызова из llm_cache.SITE_TTLS (кроме reasoning-моделей).
+    Токены берутся из usage ответа API и пишутся через backend.usage; thread_id/turn_index
+    по умолчанию — из контекста текущего хода.
+    Модель выбирает backend.model_router: при деградации переданной (p95/ошибки)
+    вызов уходит на следующую по цепочке fallback. Внутри хода действует бюджет
+    токенов (backend.token_budget): на мягком лимите модель заменяется более дешёвой,
+    на жёстком — TokenBudgetExceeded.
+    В режиме кассеты (backend.cassette) ответы записываются или воспроизводятся.
     """
+    tape_key = _tape_key(model, prompt, tools, temperature)
+    if cassette.replaying() and (hit := await cassette.replay("llm", tape_key)) is not None:
+        await _log_replayed_usage(hit, thread_id, turn_index)
+        return hit.text, hit.latency_ms
+
+    model = await _resolve_model(site, model)
     api_key = config.config.OPENAI_API_KEY
-    prompt_tokens = count_tokens(prompt, model)
 
     if api_key == "stub":
-        completion_tokens = 10
-        if "Planner-агент" in prompt:
-            response = '{"need_clarify": false, "clarify": "", "need_escalate": false, "draft": "Тестовый ответ планировщика"}'
-        else:
-            response = f"[stub] Тестовый ответ для промпта: {prompt[:20]}..."
-        _log_token_usage(thread_id, turn_index, model, prompt_tokens, completion_tokens)
+        response = _stub_response(prompt)
+        await _log_offline_usage(thread_id, turn_index, model, prompt, response)
         return response, 0
 
     if is_test_mode():
@@ -82,13 +142,17 @@ async def call_llm(model: str, prompt: str, tools: list | None = None, temperatu
             content = "simple_faq"
         else:
             content = "Это тестовый ответ от ассистента. API ключ не настроен для реальных запросов к OpenAI."
-        completion_tokens = count_tokens(content, model)
-        _log_token_usage(thread_id, turn_index, model, prompt_tokens, completion_tokens)
+        await _log_offline_usage(thread_id, turn_index, model, prompt, content)
         return content, 100
 
-    client = _get_client()
     t0 = time.time()
+    policy = llm_cache.policy(model, prompt, tools, temperature, cache, site)
+    if policy and (cached := await llm_cache.get(policy, model)) is not None:
+        # Попадание в кеш: токены не тратились, учёт не пишем
+        return cached, int((time.time() - t0) * 1000)
 
+    budget = _call_budget(site, timeout)
+    client = _get_async_client()
     params = {
         "model": model,
         "messages": [{"role": "user", "content": prompt}],
@@ -98,29 +162,267 @@ async def call_llm(model: str, prompt: str, tools: list | None = None, temperatu
     if model != "o3-mini":
         params["temperature"] = temperature
 
-    rsp = client.chat.completions.create(**params)
+    rsp = await _complete_with_retries(client, params, model, budget)
     content = rsp.choices[0].message.content.strip()
     latency_ms = int((time.time() - t0) * 1000)
     
-    completion_tokens = count_tokens(content, model)
-    _log_token_usage(thread_id, turn_index, model, prompt_tokens, completion_tokens)
+    await _log_api_usage(getattr(rsp, "usage", None), model, latency_ms, thread_id, turn_index)
+    if policy and content:
+        await llm_cache.put(policy, content)
+    if cassette.recording():
+        await _record_tape(tape_key, content, latency_ms, model, getattr(rsp, "usage", None))
     
     return content, latency_ms
 
-def _log_token_usage(thread_id: str, turn_index: int, model: str, prompt_tokens: int, completion_tokens: int):
-    """Логирует использование токенов"""
-    if thread_id and turn_index is not None:
+def _tape_key(model: str, prompt: str, tools: list | None, temperature: float) -> str | None:
+    """Ключ кассеты по запрошенной модели (до роутера и бюджета), чтобы запись совпадала при воспроизведении."""
+    if cassette.MODE == "off":
+        return None
+    return cassette.key("llm", model=model, prompt=prompt, tools=tools, temperature=temperature)
+
+async def _record_tape(tape_key: str, content: str, latency_ms: int, model: str, rsp_usage):
+    tokens = {"prompt_tokens": rsp_usage.prompt_tokens, "completion_tokens": rsp_usage.completion_tokens} if rsp_usage else None
+    await cassette.record("llm", tape_key, content, latency_ms, model=model, usage=tokens)
+
+async def _log_replayed_usage(hit: "cassette.Entry", thread_id: str | None, turn_index: int | None):
+    """Воспроизведённый ответ проходит учёт и бюджет токенов так же, как живой."""
+    if hit.meta.get("usage"):
+        await _log_api_usage(SimpleNamespace(**hit.meta["usage"]), hit.meta.get("model", "cassette"),
+                             hit.latency_ms, thread_id, turn_index)
+
+def _call_budget(site: str | None, timeout: float | None) -> float:
+    """Бюджет вызова: явный timeout или бюджет места вызова, не дольше остатка дедлайна хода."""
+    if timeout is None:
+        timeout = config.config.LLM_TIMEOUT_SEC
+        if site:
+            timeout = getattr(config.config, f"LLM_BUDGET_{site.upper()}_SEC", timeout)
+    budget = deadline.clamp(float(timeout))
+    if budget <= 0:
+        metrics.TIMEOUT.labels(kind="llm").inc()
+        raise asyncio.TimeoutError(f"LLM deadline exceeded before call ({site or 'default'})")
+    return budget
+
+def _hedge_delay(model: str) -> float | None:
+    """Через сколько секунд запускать дублирующий запрос; None — не хеджировать."""
+    models = {m.strip() for m in str(config.config.LLM_HEDGE_MODELS).split(",") if m.strip()}
+    if model not in models:
+        return None
+    return model_router.stats[model].quantile(0.95)
+
+async def _timed_create(client, params: dict, model: str, budget: float):
+    """Один запрос с жёстким общим таймаутом; исход идёт в окно модели для роутера и хеджа."""
+    t0 = time.monotonic()
+    try:
+        rsp = await asyncio.wait_for(client.chat.completions.create(**params, timeout=budget), budget)
+    except Exception:
+        # Отмена проигравшего хеджа — не ошибка модели (CancelledError сюда не попадает)
+        model_router.stats[model].add_error()
+        raise
+    model_router.stats[model].add(time.monotonic() - t0)
+    return rsp
+
+async def _complete(client, params: dict, model: str, budget: float):
+    """
+    Запрос с хеджированием: если ответа нет дольше p95 для модели, уходит
+    второй такой же запрос, берётся первый успешный, проигравший отменяется.
+    """
+    hedge_after = _hedge_delay(model)
+    if hedge_after is None or hedge_after >= budget:
+        return await _timed_create(client, params, model, budget)
+
+    end = time.monotonic() + budget
+    primary = asyncio.create_task(_timed_create(client, params, model, budget))
+    hedge = None
+    # finally гасит запросы и при отмене вызывающего (клиент отключился), а не только проигравший хедж
+    try:
+        done, _ = await asyncio.wait({primary}, timeout=hedge_after)
+        if done:
+            return primary.result()
+
+        metrics.LLM_HEDGE.labels(model=model, result="fired").inc()
+        hedge = asyncio.create_task(_timed_create(client, params, model, end - time.monotonic()))
+        pending, error = {primary, hedge}, None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, end - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise asyncio.TimeoutError(f"LLM {model} hedged request timed out")
+            for task in done:
+                if task.exception() is None:
+                    metrics.LLM_HEDGE.labels(model=model, result="hedge_won" if task is hedge else "primary_won").inc()
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+async def _complete_with_retries(client, params: dict, model: str, budget: float):
+    """
+    Повторяет временные ошибки (429/5xx/сеть) с jitter-backoff и Retry-After,
+    пока следующая попытка успевает в бюджет вызова.
+    """
+    cfg = config.config
+    end = time.monotonic() + budget
+    attempt = 0
+    while True:
+        left = end - time.monotonic()
         try:
-            from backend.chat_db import log_message
-            meta_data = {
-                "model": model,
-                "prompt_tokens": prompt_tokens,
-                "completion_tokens": completion_tokens,
-                "total_tokens": prompt_tokens + completion_tokens
-            }
-            log_message(thread_id, turn_index, "meta", json.dumps(meta_data))
-        except ImportError:
-            pass
+            return await _complete(client, params, model, left)
+        except Exception as e:
+            reason = retry_reason(e)
+            if reason is None or attempt >= int(cfg.LLM_RETRY_MAX):
+                raise
+            delay = retry_delay(e, attempt, float(cfg.LLM_RETRY_BASE_SEC), float(cfg.LLM_RETRY_CAP_SEC))
+            if time.monotonic() + delay + float(cfg.LLM_MIN_ATTEMPT_SEC) >= end:
+                metrics.TIMEOUT.labels(kind="llm").inc()
+                raise
+            attempt += 1
+            metrics.LLM_RETRIES.labels(model=model, reason=reason).inc()
+            logger.warning(f"LLM {model} failed ({reason}), retry {attempt} in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+def _stub_response(prompt: str) -> str:
+    if "Planner-агент" in prompt:
+        return '{"need_clarify": false, "clarify": "", "need_escalate": false, "draft": "Тестовый ответ планировщика"}'
+    return f"[stub] Тестовый ответ для промпта: {prompt[:20]}..."
+
+async def call_llm_stream(model: str, prompt: str, temperature: float = 0, thread_id: str = None, turn_index: int = None,
+                          timeout: float | None = None, site: str | None = None,
+                          routed: str | None = None) -> AsyncIterator[str]:
+    """
+    Потоковый вариант call_llm: отдаёт дельты текста по мере генерации.
+    В stub/тестовом режиме ответ call_llm режется на слова.
+    Бюджет — как у call_llm; повторов и хеджирования нет — часть ответа уже у пользователя.
+    Время до первого токена пишется в отдельное окно model_router.stats[(model, "ttft")]:
+    хедж и SLO роутера считаются по полной задержке ответа, с которой TTFT смешивать нельзя.
+    Ошибки стрима — в общее окно модели.
+    Воспроизведение из кассеты растягивает записанную задержку на все дельты.
+    routed — модель, уже выбранная роутером и бюджетом (stream_llm); ключ кассеты — по model.
+    """
+    tape_key = _tape_key(model, prompt, None, temperature)
+    if cassette.replaying() and (hit := await cassette.replay("llm", tape_key, wait=False)) is not None:
+        pieces = re.findall(r"\S+\s*|\s+", hit.text)
+        for piece in pieces:
+            await asyncio.sleep(cassette.delay(hit.latency_ms) / len(pieces))
+            yield piece
+        await _log_replayed_usage(hit, thread_id, turn_index)
+        return
+
+    api_key = config.config.OPENAI_API_KEY
+    if routed is not None:
+        model = routed
+    elif api_key != "stub" and not is_test_mode():
+        model = await _resolve_model(site, model)
+    if api_key == "stub" or is_test_mode():
+        content, _ = await call_llm(model, prompt, temperature=temperature, thread_id=thread_id, turn_index=turn_index,
+                                    timeout=timeout, site=site)
+        for piece in re.findall(r"\S+\s*|\s+", content):
+            yield piece
+        return
+
+    budget = _call_budget(site, timeout)
+    end = time.monotonic() + budget
+    client = _get_async_client()
+    params = {
+        "model": model,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+        # Последний чанк несёт usage — без него токены стрима пришлось бы считать самим
+        "stream_options": {"include_usage": True},
+        "timeout": budget,
+    }
+    if model != "o3-mini":
+        params["temperature"] = temperature
+
+    t0 = time.time()
+    first_token = None
+    rsp_usage = None
+    parts = []
+    stream = None
+    try:
+        stream = await asyncio.wait_for(client.chat.completions.create(**params), budget)
+        async for chunk in stream:
+            if time.monotonic() > end:
+                metrics.TIMEOUT.labels(kind="llm").inc()
+                raise asyncio.TimeoutError(f"LLM {model} stream exceeded its budget")
+            rsp_usage = getattr(chunk, "usage", None) or rsp_usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if first_token is None:
+                    first_token = time.time() - t0
+                parts.append(delta)
+                yield delta
+    except Exception:
+        model_router.stats[model].add_error()
+        raise
+    finally:
+        # Отмена хода, таймаут или брошенный генератор: соединение с API рвём, а не дочитываем
+        if stream is not None and hasattr(stream, "close"):
+            await stream.close()
+    model_router.stats[(model, "ttft")].add(time.time() - t0 if first_token is None else first_token)
+    latency_ms = int((time.time() - t0) * 1000)
+    await _log_api_usage(rsp_usage, model, latency_ms, thread_id, turn_index)
+    if cassette.recording():
+        await _record_tape(tape_key, "".join(parts).strip(), latency_ms, model, rsp_usage)
+
+# Куда отдавать частичные ответы текущего запроса; ставит chat_stream на время handle_message
+partial_sink: ContextVar[Callable[[str], Awaitable[None]] | None] = ContextVar("partial_sink", default=None)
+
+async def stream_llm(model: str, prompt: str, temperature: float = 0, visible: Callable[[str], str] | None = None,
+                     cache: bool | None = None, site: str | None = None, **kwargs) -> tuple[str, int]:
+    """
+    call_llm со стримингом пользователю: дельты уходят в partial_sink (если он задан),
+    возвращается полный ответ и задержка, как у call_llm.
+    visible — фильтр дельт для показа (например, только поле draft из JSON планировщика).
+    Кеш — тот же, что у call_llm, и ключ — по модели после роутера и бюджета:
+    попадание отдаётся в sink одним куском.
+    """
+    sink = partial_sink.get()
+    if sink is None:
+        return await call_llm(model, prompt, temperature=temperature, cache=cache, site=site, **kwargs)
+
+    t0 = time.time()
+    offline = config.config.OPENAI_API_KEY == "stub" or is_test_mode()
+    # Ответ пониженной или fallback-модели не должен попасть в кеш под ключом запрошенной
+    used = None if offline else await _resolve_model(site, model)
+    policy = None if offline else llm_cache.policy(used, prompt, None, temperature, cache, site)
+    if policy and (cached := await llm_cache.get(policy, used)) is not None:
+        shown = visible(cached) if visible else cached
+        if shown:
+            await sink(shown)
+        return cached, int((time.time() - t0) * 1000)
+
+    parts = []
+    async for delta in call_llm_stream(model, prompt, temperature=temperature, site=site, routed=used, **kwargs):
+        parts.append(delta)
+        shown = visible(delta) if visible else delta
+        if shown:
+            await sink(shown)
+    content = "".join(parts).strip()
+    if policy and content:
+        await llm_cache.put(policy, content)
+    return content, int((time.time() - t0) * 1000)
+
+async def _log_api_usage(rsp_usage, model: str, latency_ms: int, thread_id: str | None, turn_index: int | None):
+    """Учёт токенов по usage ответа API (локально ничего не токенизируется) и списание с бюджета."""
+    if rsp_usage is None:
+        logger.debug(f"LLM {model} response without usage, tokens not recorded")
+        return
+    rec = usage.record(model, rsp_usage.prompt_tokens or 0, rsp_usage.completion_tokens or 0,
+                       latency_ms, thread_id, turn_index)
+    await token_budget.charge(rec.prompt_tokens + rec.completion_tokens)
+
+async def _log_offline_usage(thread_id: str | None, turn_index: int | None, model: str, prompt: str, completion: str):
+    """stub/тестовый режим: usage нет, токены оцениваются локально и только внутри хода"""
+    if thread_id is None and turn_index is None and usage.current_turn.get() is None:
+        return
+    prompt_tokens, completion_tokens = count_tokens_many([prompt, completion], model)
+    usage.record(model, prompt_tokens, completion_tokens, None, thread_id, turn_index)
+    await token_budget.charge(prompt_tokens + completion_tokens)
 
 def get_qdrant_client():
     return QdrantClient(host=config.config.QDRANT_HOST, port=6333)
@@ -2,8 +2,8 @@ from pydantic import BaseModel
 from typing import Literal, Any, List, Tuple, Optional
 
 class WsOutgoing(BaseModel):
-    type: Literal["status","chat"]
-    role: str | None = None      # for type="chat"
+    type: Literal["status","chat","chunk"]  # chunk — фрагмент ответа, следующий chat его заменяет
+    role: str | None = None      # for type="chat"/"chunk"
     content: str | None = None
     citations: Optional[List[Tuple[int, str]]] = None  # Добавляем поддержку цитат
     status: Literal["thinking","searching","generating"] | None = None
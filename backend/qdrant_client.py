@@ -1,11 +1,13 @@
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
 from backend.settings import get_settings
 import logging
 
 settings = get_settings()
 qdr = None
+aqdr = None  # асинхронный клиент для кода внутри event loop (kb_search)
 try:
     qdr = QdrantClient(url=settings.qdrant_url)
+    aqdr = AsyncQdrantClient(url=settings.qdrant_url)
     logging.info("Qdrant client initialized successfully.")
 except Exception as e:
     logging.error(f"Failed to initialize Qdrant client: {e}", exc_info=True)
@@ -0,0 +1,49 @@
+"""
+Общие правила повторов для вызовов OpenAI (эмбеддинги, LLM):
+какие ошибки временные, сколько ждать с учётом Retry-After.
+"""
+import random
+import time
+from email.utils import parsedate_to_datetime
+
+import openai
+
+
+def retry_reason(exc: Exception) -> str | None:
+    """Причина для повтора (метка метрики) или None, если ошибка не временная."""
+    if isinstance(exc, openai.RateLimitError):
+        return "429"
+    if isinstance(exc, openai.APIStatusError):
+        return "5xx" if exc.status_code >= 500 else None
+    if isinstance(exc, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(exc, openai.APIConnectionError):
+        return "connection"
+    return None
+
+
+def retry_after(exc: Exception) -> float | None:
+    """Retry-After из ответа (retry-after-ms, секунды или HTTP-дата)."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if (ms := headers.get("retry-after-ms")) is not None:
+            return float(ms) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(exc: Exception, attempt: int, base: float, cap: float) -> float:
+    """Full-jitter экспоненциальная задержка (секунды), но не меньше Retry-After сервера."""
+    backoff = random.uniform(0, min(cap, base * 2 ** attempt))
+    server = retry_after(exc)
+    return max(backoff, server) if server is not None else backoff
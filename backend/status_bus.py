@@ -11,7 +11,24 @@ except Exception:
     _redis_pub = None
     _redis_sub = None
 
+# Ведомые сессии (backend.coalesce): статусы ведущего дублируются в их потоки
+_followers: dict[str, set[str]] = {}
+
+def follow(leader:str, follower:str):
+    _followers.setdefault(leader, set()).add(follower)
+
+def unfollow(leader:str, follower:str):
+    if (followers := _followers.get(leader)) is not None:
+        followers.discard(follower)
+        if not followers:
+            del _followers[leader]
+
 async def publish(thread_id:str, stage:str, detail:str|None=None):
+    for follower in list(_followers.get(thread_id, ())):
+        await _publish(follower, stage, detail)
+    await _publish(thread_id, stage, detail)
+
+async def _publish(thread_id:str, stage:str, detail:str|None=None):
     msg = json.dumps({"thread":thread_id, "stage":stage, "detail":detail})
     # Публикация в Redis или локальную очередь
     if _redis_pub:
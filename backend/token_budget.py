@@ -0,0 +1,196 @@
+"""
+Бюджет токенов на сессию и на IP.
+Расход копится атомарно в Redis (или в памяти процесса, если Redis недоступен)
+и проверяется перед каждым call_llm внутри хода диалога:
+мягкий лимит — дешёвые модели и без Critic, жёсткий — отказ с ошибкой в WS.
+"""
+import asyncio
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+import redis
+
+from backend import config, metrics
+
+logger = logging.getLogger(__name__)
+
+OK, SOFT, HARD = "ok", "soft", "hard"
+
+# (thread_id, client_ip) текущего хода; ставит chat_stream
+current_scope: ContextVar[tuple[str | None, str | None] | None] = ContextVar("token_budget_scope", default=None)
+# Уровень после последней проверки в этом контексте
+current_level: ContextVar[str] = ContextVar("token_budget_level", default=OK)
+
+# INCRBY по всем ключам; TTL ставится только при создании счётчика (окно не продлевается)
+_CHARGE_LUA = """
+for i, key in ipairs(KEYS) do
+    redis.call('INCRBY', key, ARGV[1])
+    if redis.call('TTL', key) < 0 then
+        redis.call('EXPIRE', key, ARGV[i + 1])
+    end
+end
+return 1
+"""
+
+
+class TokenBudgetExceeded(RuntimeError):
+    """Жёсткий лимит токенов исчерпан — ход не выполняется."""
+
+    def __init__(self, scope: str, used: int, limit: int):
+        self.scope = scope
+        self.used = used
+        self.limit = limit
+        who = "сессии" if scope == "session" else "IP-адреса"
+        super().__init__(f"Исчерпан лимит токенов {who}: {used} из {limit}. Попробуйте позже или начните новую сессию.")
+
+
+def session_limit() -> int:
+    """Settings.max_tokens_per_session; без полного окружения — легаси MAX_TOKENS_SESSION."""
+    from backend.settings import get_settings, MAX_TOKENS_SESSION
+    try:
+        return int(get_settings().max_tokens_per_session)
+    except Exception:
+        return MAX_TOKENS_SESSION
+
+
+def ip_limit() -> int:
+    return int(config.config.TOKEN_BUDGET_IP_LIMIT)
+
+
+def _soft_ratio() -> float:
+    return float(config.config.TOKEN_BUDGET_SOFT_RATIO)
+
+
+def downgrade(model: str) -> str:
+    """Более дешёвая модель для мягкого лимита (TOKEN_BUDGET_DOWNGRADE="from:to,...")."""
+    pairs = (p.split(":", 1) for p in str(config.config.TOKEN_BUDGET_DOWNGRADE).split(",") if ":" in p)
+    return {src.strip(): dst.strip() for src, dst in pairs}.get(model, model)
+
+
+class TokenBudget:
+    def __init__(self):
+        self._redis_client: Optional[redis.Redis] = None
+        self._redis_initialized = False
+        self._charge_script = None
+        self.local_cache: Dict[str, Tuple[int, float]] = {}  # key -> (used, expires_at)
+
+    def _get_redis_client(self) -> Optional[redis.Redis]:
+        """Ленивая инициализация Redis клиента"""
+        if not self._redis_initialized:
+            self._redis_initialized = True
+            try:
+                client = redis.Redis(host=os.getenv("REDIS_HOST", "localhost"),
+                                     port=int(os.getenv("REDIS_PORT", "6379")),
+                                     db=0, decode_responses=True,
+                                     socket_connect_timeout=1, socket_timeout=0.5)
+                client.ping()
+                self._charge_script = client.register_script(_CHARGE_LUA)
+                self._redis_client = client
+            except Exception as e:
+                logger.warning(f"Redis unavailable for token budget, using in-memory: {e}")
+                self._redis_client = None
+        return self._redis_client
+
+    @staticmethod
+    def _keys(session: str | None, ip: str | None) -> list[tuple[str, str, int]]:
+        """(scope, ключ, TTL окна) для заданных измерений бюджета."""
+        cfg = config.config
+        keys = []
+        if session:
+            keys.append(("session", f"tb:session:{session}", int(cfg.TOKEN_BUDGET_SESSION_TTL_SEC)))
+        if ip:
+            keys.append(("ip", f"tb:ip:{ip}", int(cfg.TOKEN_BUDGET_IP_WINDOW_SEC)))
+        return keys
+
+    async def charge(self, session: str | None, ip: str | None, tokens: int):
+        """Атомарно добавляет расход ко всем счётчикам; ошибки Redis — в локальный счётчик."""
+        keys = self._keys(session, ip)
+        if not keys or tokens <= 0:
+            return
+        r = self._get_redis_client()
+        if r is not None:
+            try:
+                await asyncio.to_thread(self._charge_script, keys=[k for _, k, _ in keys],
+                                        args=[tokens] + [ttl for _, _, ttl in keys])
+                return
+            except Exception as e:
+                logger.error(f"Redis token budget error: {e}")
+        self._charge_local(keys, tokens)
+
+    def _charge_local(self, keys, tokens: int):
+        now = time.monotonic()
+        for _, key, ttl in keys:
+            used, expires = self.local_cache.get(key, (0, now + ttl))
+            if expires <= now:
+                used, expires = 0, now + ttl
+            self.local_cache[key] = (used + tokens, expires)
+
+    async def used(self, session: str | None, ip: str | None) -> dict[str, int]:
+        """Израсходовано по каждому измерению: {"session": n, "ip": m}."""
+        keys = self._keys(session, ip)
+        if not keys:
+            return {}
+        r = self._get_redis_client()
+        if r is not None:
+            try:
+                values = await asyncio.to_thread(r.mget, [k for _, k, _ in keys])
+                return {scope: int(v or 0) for (scope, _, _), v in zip(keys, values)}
+            except Exception as e:
+                logger.error(f"Redis token budget error: {e}")
+        now = time.monotonic()
+        out = {}
+        for scope, key, _ in keys:
+            used, expires = self.local_cache.get(key, (0, 0.0))
+            out[scope] = used if expires > now else 0
+        return out
+
+    async def check(self, session: str | None, ip: str | None) -> str:
+        """Уровень бюджета OK/SOFT/HARD; на HARD бросает TokenBudgetExceeded."""
+        limits = {"session": session_limit(), "ip": ip_limit()}
+        level = OK
+        for scope, used in (await self.used(session, ip)).items():
+            limit = limits[scope]
+            metrics.TOKEN_BUDGET_LIMIT.labels(scope=scope).set(limit)
+            if limit <= 0:
+                continue
+            metrics.TOKEN_BUDGET_USAGE.labels(scope=scope).observe(used / limit)
+            if used >= limit:
+                metrics.TOKEN_BUDGET_EXCEEDED.labels(scope=scope, level=HARD).inc()
+                raise TokenBudgetExceeded(scope, used, limit)
+            if used >= limit * _soft_ratio() and level == OK:
+                metrics.TOKEN_BUDGET_EXCEEDED.labels(scope=scope, level=SOFT).inc()
+                level = SOFT
+        return level
+
+
+# Глобальный экземпляр
+budget = TokenBudget()
+
+
+async def enforce() -> str:
+    """Проверка перед вызовом LLM в текущем ходе; вне хода бюджет не применяется."""
+    scope = current_scope.get()
+    if scope is None:
+        return OK
+    try:
+        level = await budget.check(*scope)
+    except TokenBudgetExceeded:
+        current_level.set(HARD)
+        raise
+    current_level.set(level)
+    return level
+
+
+async def charge(tokens: int):
+    """Списывает токены с бюджета текущего хода."""
+    scope = current_scope.get()
+    if scope is not None:
+        await budget.charge(*scope, tokens)
+
+
+def soft_limited() -> bool:
+    """Мягкий лимит достигнут — необязательные шаги (Critic) пропускаются."""
+    return current_level.get() != OK
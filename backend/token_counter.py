@@ -1,35 +1,69 @@
 """
 Модуль для подсчета токенов в сообщениях
 """
+import functools
+import logging
+import math
 import tiktoken
+import tiktoken.model
 from typing import List, Dict, Any
 
+# Семейства моделей без записи в таблице tiktoken (короткие алиасы вроде "4.1-mini")
+_O200K_MARKERS = ("4.1", "4o", "o1", "o3", "o4")
+
+def _encoding_name(model: str) -> str:
+    """Имя BPE-словаря для модели: o200k_base для 4.1/4o/o-серии, иначе cl100k_base."""
+    try:
+        return tiktoken.model.encoding_name_for_model(model)
+    except KeyError:
+        if any(marker in model for marker in _O200K_MARKERS):
+            return "o200k_base"
+        return "cl100k_base"
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(model: str) -> tiktoken.Encoding | None:
+    """
+    Токенизатор модели из реестра процесса: словарь загружается один раз на модель.
+    None, если tiktoken не смог загрузить словарь (нет сети) — неудача тоже кешируется,
+    чтобы горячий путь не повторял попытку загрузки.
+    """
+    name = _encoding_name(model)
+    try:
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logging.warning(f"tiktoken encoding {name} unavailable for {model}, using estimate: {e}")
+        return None
+
+def _estimate(text: str) -> int:
+    # Простая эвристика если tiktoken не работает: примерно 1.3 токена на слово
+    return math.ceil(len(text.split()) * 1.3)
+
 def count_tokens(text: str, model: str = "gpt-4") -> int:
     """
     Подсчитывает количество токенов в тексте для указанной модели
     """
-    try:
-        # Для большинства моделей OpenAI используем cl100k_base encoding
-        if "gpt-4" in model or "o3" in model:
-            encoding = tiktoken.get_encoding("cl100k_base")
-        else:
-            # Fallback для других моделей
-            encoding = tiktoken.get_encoding("cl100k_base")
-        
-        return len(encoding.encode(text))
-    except Exception:
-        # Простая эвристика если tiktoken не работает
-        return len(text.split()) * 1.3  # Примерно 1.3 токена на слово
+    enc = get_encoder(model)
+    if enc is None:
+        return _estimate(text)
+    # Спецтокены в пользовательском тексте считаем обычным текстом, а не ошибкой
+    return len(enc.encode(text, disallowed_special=()))
+
+def count_tokens_many(texts: List[str], model: str = "gpt-4") -> List[int]:
+    """
+    Подсчитывает токены для списка текстов одним вызовом encode_batch
+    """
+    enc = get_encoder(model)
+    if enc is None:
+        return [_estimate(t) for t in texts]
+    if len(texts) == 1:
+        return [len(enc.encode(texts[0], disallowed_special=()))]
+    return [len(tokens) for tokens in enc.encode_batch(texts, disallowed_special=())]
 
 def count_messages_tokens(messages: List[Dict[str, Any]], model: str = "gpt-4") -> int:
     """
     Подсчитывает общее количество токенов в списке сообщений
     """
-    total = 0
-    for message in messages:
-        content = message.get("content", "")
-        total += count_tokens(content, model)
-        # Добавляем небольшой overhead на структуру сообщения
-        total += 4  # ~4 токена на role, name и другие метаданные
-    
-    return total
+    contents = [message.get("content") or "" for message in messages]
+    # Добавляем небольшой overhead на структуру сообщения:
+    # ~4 токена на role, name и другие метаданные
+    return sum(count_tokens_many(contents, model)) + 4 * len(messages)
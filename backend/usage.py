@@ -0,0 +1,122 @@
+"""
+Учёт токенов по ходам диалога.
+Количество токенов берётся из usage ответа API, thread/turn — из контекста,
+который задаёт chat_stream; записи уходят в SQLite пачками вне пути запроса.
+"""
+import asyncio
+import logging
+import os
+import threading
+from contextvars import ContextVar
+from dataclasses import dataclass
+
+from backend import metrics
+
+# (thread_id, turn_index) текущего хода; ставит chat_stream на время handle_message
+current_turn: ContextVar[tuple[str, int] | None] = ContextVar("current_turn", default=None)
+
+FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL_SEC", "1.0"))
+FLUSH_MAX = int(os.getenv("USAGE_FLUSH_MAX", "100"))
+
+
+@dataclass
+class UsageRecord:
+    thread_id: str | None
+    turn_index: int | None
+    model: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_ms: int | None = None
+
+
+_buffer: list[UsageRecord] = []
+_lock = threading.Lock()
+_timer: asyncio.TimerHandle | None = None
+_timer_loop: asyncio.AbstractEventLoop | None = None
+_tasks: set[asyncio.Task] = set()
+# Токены ходов в работе (из контекста current_turn); chat_stream забирает сумму по окончании хода
+_turn_tokens: dict[tuple[str, int], int] = {}
+
+
+def record(model: str, prompt_tokens: int, completion_tokens: int, latency_ms: int | None = None,
+           thread_id: str | None = None, turn_index: int | None = None) -> UsageRecord:
+    """
+    Ставит запись в буфер и планирует сброс: по таймеру FLUSH_INTERVAL
+    или сразу, если набралось FLUSH_MAX. Без event loop пишет синхронно.
+    """
+    in_turn = thread_id is None and turn_index is None and (turn := current_turn.get()) is not None
+    if in_turn:
+        thread_id, turn_index = turn
+    rec = UsageRecord(thread_id, turn_index, model, int(prompt_tokens), int(completion_tokens), latency_ms)
+    metrics.LLM_TOKENS.labels(model=model, kind="prompt").inc(rec.prompt_tokens)
+    metrics.LLM_TOKENS.labels(model=model, kind="completion").inc(rec.completion_tokens)
+    with _lock:
+        _buffer.append(rec)
+        size = len(_buffer)
+        if in_turn:
+            _turn_tokens[turn] = _turn_tokens.get(turn, 0) + rec.prompt_tokens + rec.completion_tokens
+
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _write(_drain())
+        return rec
+
+    global _timer, _timer_loop
+    if size >= FLUSH_MAX:
+        _spawn_flush(loop)
+    elif _timer is None or _timer_loop is not loop:
+        _timer_loop = loop
+        _timer = loop.call_later(FLUSH_INTERVAL, _on_timer, loop)
+    return rec
+
+
+def pop_turn_tokens(thread_id: str, turn_index: int) -> int:
+    """Сколько токенов потратил ход (0, если LLM не вызывался); счётчик хода удаляется."""
+    with _lock:
+        return _turn_tokens.pop((thread_id, turn_index), 0)
+
+
+def add_turn_tokens(thread_id: str, turn_index: int, tokens: int):
+    """Токены, которые ход получил не своим вызовом LLM (склеенный прогон, backend.coalesce)."""
+    if tokens:
+        with _lock:
+            _turn_tokens[(thread_id, turn_index)] = _turn_tokens.get((thread_id, turn_index), 0) + tokens
+
+
+def _on_timer(loop: asyncio.AbstractEventLoop):
+    global _timer
+    if _timer_loop is loop:
+        _timer = None
+    _spawn_flush(loop)
+
+
+def _spawn_flush(loop: asyncio.AbstractEventLoop):
+    task = loop.create_task(flush())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def _drain() -> list[UsageRecord]:
+    with _lock:
+        batch = _buffer[:]
+        _buffer.clear()
+    return batch
+
+
+def _write(batch: list[UsageRecord]):
+    if not batch:
+        return
+    try:
+        from backend.chat_db import log_usage_many
+        log_usage_many(batch)
+    except Exception as e:
+        logging.warning(f"Token usage write failed, {len(batch)} records dropped: {e}")
+
+
+async def flush() -> int:
+    """Пишет накопленные записи одной транзакцией в потоке; возвращает их число."""
+    batch = _drain()
+    if batch:
+        await asyncio.to_thread(_write, batch)
+    return len(batch)
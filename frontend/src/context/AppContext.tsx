@@ -6,6 +6,7 @@ export type ChatMsg = {
   role: "user" | "assistant" | "system" | "file";
   content: string;
   name?: string;
+  partial?: boolean; // ответ ещё стримится (type="chunk")
 };
 
 interface AppContextType {
@@ -76,7 +77,11 @@ export const AppProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
             return;
           }
           if (m.type === "error") {
-            setChat((c) => [...c, { role: "system", content: `⚠️ ${m.msg} (ID ${m.id})` }]);
+            // Оборванный стрим остаётся в ленте, но больше не дописывается
+            setChat((c) => [
+              ...c.map((x) => (x.partial ? { ...x, partial: false } : x)),
+              { role: "system", content: `⚠️ ${m.msg} (ID ${m.id})` },
+            ]);
             setStatus("");
             return;
           }
@@ -85,7 +90,22 @@ export const AppProvider: React.FC<{ children: ReactNode }> = ({ children }) =>
             setStatus("");
             return;
           }
-          setChat((c) => [...c, { role: m.role ?? "assistant", content: m.content }]);
+          if (m.type === "chunk") {
+            // Дописываем фрагмент к стримящемуся сообщению или открываем новое
+            setChat((c) => {
+              const last = c[c.length - 1];
+              if (last?.partial) {
+                return [...c.slice(0, -1), { ...last, content: last.content + m.content }];
+              }
+              return [...c, { role: m.role ?? "assistant", content: m.content, partial: true }];
+            });
+            return;
+          }
+          // Финальный ответ заменяет стримившийся черновик
+          setChat((c) => {
+            const rest = c[c.length - 1]?.partial ? c.slice(0, -1) : c;
+            return [...rest, { role: m.role ?? "assistant", content: m.content }];
+          });
           setStatus("");
         } catch (error) {
           setChat((c) => [...c, { role: "assistant", content: e.data }]);
@@ -12,7 +12,7 @@ except ImportError:
     )
 from backend import config
 import qdrant_client
-from backend.embedding import get
+from backend.embedding import get_many
 
 def run():
     try:
@@ -73,10 +73,11 @@ def reindex_dialogs():
     conn = sqlite3.connect(config.DB_PATH)
     cur  = conn.execute("SELECT thread_id, body FROM dialog_log")
     qdrant = qdrant_client.QdrantClient("qdrant:6333")
+    rows=[(tid, json.loads(body)) for tid, body in cur]
+    # Все вопросы эмбеддятся одним батч-запросом через общий сервис
+    embs = get_many([msgs[0]["content"] for _, msgs in rows])
     points=[]
-    for tid, body in cur:
-        msgs=json.loads(body)
-        emb = get(msgs[0]["content"])
+    for (tid, msgs), emb in zip(rows, embs):
         ans = msgs[-1]["content"]
         points.append(qdrant_client.PointStruct(id=tid, vector=emb,
                        payload={"answer":ans}))
@@ -0,0 +1,260 @@
+"""
+Локальный OpenAI-совместимый сервер для нагрузочных тестов и замеров задержек без сети.
+Реализует /v1/chat/completions (включая stream) и /v1/embeddings, с настраиваемым
+распределением задержек, долей 5xx, инъекцией 429 и лимитом токенов в минуту.
+
+Запуск:
+    python -m scripts.fake_openai --port 8089 --latency lognormal:300:0.5 --rate-429 0.05
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=sk-fake uvicorn backend.main:app
+
+Параметры по умолчанию берутся из переменных FAKE_OPENAI_* (см. FakeProfile.from_env).
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from backend.embedding import stub_vectors, EMBED_DIM
+
+
+@dataclass
+class FakeProfile:
+    """
+    Поведение сервера.
+    latency — распределение задержки до первого байта ответа:
+      "none", "fixed:<ms>", "uniform:<lo_ms>:<hi_ms>", "lognormal:<median_ms>:<sigma>".
+    error_rate / rate_429 — доля ответов 500 и 429 (с Retry-After).
+    tokens_per_min — лимит токенов в минуту на весь сервер (0 — без лимита), сверх него 429.
+    stream_tps — скорость выдачи токенов в стриме; completion_tokens — длина обычного ответа.
+    """
+    latency: str = "none"
+    error_rate: float = 0.0
+    rate_429: float = 0.0
+    retry_after: float = 1.0
+    tokens_per_min: int = 0
+    stream_tps: float = 0.0
+    completion_tokens: int = 60
+    seed: int | None = None
+
+    @classmethod
+    def from_env(cls) -> "FakeProfile":
+        env = os.getenv
+        return cls(
+            latency=env("FAKE_OPENAI_LATENCY", "none"),
+            error_rate=float(env("FAKE_OPENAI_ERROR_RATE", "0")),
+            rate_429=float(env("FAKE_OPENAI_429_RATE", "0")),
+            retry_after=float(env("FAKE_OPENAI_RETRY_AFTER_SEC", "1")),
+            tokens_per_min=int(env("FAKE_OPENAI_TOKENS_PER_MIN", "0")),
+            stream_tps=float(env("FAKE_OPENAI_STREAM_TPS", "0")),
+            completion_tokens=int(env("FAKE_OPENAI_COMPLETION_TOKENS", "60")),
+            seed=int(env("FAKE_OPENAI_SEED")) if env("FAKE_OPENAI_SEED") else None,
+        )
+
+
+def sample_latency(spec: str, rng: random.Random) -> float:
+    """Задержка в секундах по строке распределения FakeProfile.latency."""
+    kind, *args = spec.split(":")
+    if kind == "none":
+        return 0.0
+    if kind == "fixed":
+        return float(args[0]) / 1000
+    if kind == "uniform":
+        return rng.uniform(float(args[0]), float(args[1])) / 1000
+    if kind == "lognormal":
+        median_ms, sigma = float(args[0]), float(args[1])
+        return rng.lognormvariate(0.0, sigma) * median_ms / 1000
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def _tokens(text: str) -> int:
+    # Оценка без tiktoken: сервер не должен тратить CPU, который меряет бенчмарк
+    return max(1, len(text) // 4)
+
+
+class TokenRateLimiter:
+    """Ведро токенов на минуту; try_take возвращает секунды до освобождения или 0."""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self.updated = time.monotonic()
+
+    def try_take(self, tokens: int) -> float:
+        if self.per_minute <= 0:
+            return 0.0
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+        if tokens <= self.available:
+            self.available -= tokens
+            return 0.0
+        return (tokens - self.available) * 60 / self.per_minute
+
+
+def reply_for(prompt: str, completion_tokens: int) -> str:
+    """Правдоподобный ответ по виду промпта, чтобы конвейер ассистента проходил до конца."""
+    if "Planner-агент" in prompt:
+        return json.dumps({"need_clarify": False, "clarify": "", "need_escalate": False,
+                           "draft": "Черновой ответ планировщика от локального сервера.",
+                           "plan": ["шаг 1"]}, ensure_ascii=False)
+    if '"intent"' in prompt:
+        phrase = prompt.rsplit("ФРАЗА:", 1)[-1].lower()
+        intent = "small_talk" if re.search(r"привет|спасибо|здравств", phrase) else "request"
+        return json.dumps({"intent": intent, "conf": 0.9})
+    if "одним числом 0-1" in prompt:
+        return "0.9"
+    return " ".join(["ответ"] * completion_tokens)
+
+
+def create_app(profile: FakeProfile | None = None) -> FastAPI:
+    profile = profile or FakeProfile.from_env()
+    rng = random.Random(profile.seed)
+    limiter = TokenRateLimiter(profile.tokens_per_min)
+    app = FastAPI(title="Fake OpenAI")
+    app.state.profile = profile
+    app.state.requests = 0
+
+    def _error(status: int, message: str, retry_after: float | None = None) -> JSONResponse:
+        headers = {"retry-after": f"{retry_after:.3f}"} if retry_after else None
+        kind = "rate_limit_exceeded" if status == 429 else "server_error"
+        return JSONResponse({"error": {"message": message, "type": kind, "code": kind}},
+                            status_code=status, headers=headers)
+
+    async def _admit(tokens: int) -> JSONResponse | None:
+        """Общая часть эндпоинтов: задержка, инъекция ошибок и лимит токенов."""
+        app.state.requests += 1
+        await asyncio.sleep(sample_latency(profile.latency, rng))
+        roll = rng.random()
+        if roll < profile.rate_429:
+            return _error(429, "Injected rate limit", profile.retry_after)
+        if roll < profile.rate_429 + profile.error_rate:
+            return _error(500, "Injected server error")
+        if (wait := limiter.try_take(tokens)) > 0:
+            return _error(429, "Token rate limit exceeded", wait)
+        return None
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt = "\n".join(str(m.get("content") or "") for m in body.get("messages", []))
+        content = reply_for(prompt, profile.completion_tokens)
+        prompt_tokens, completion_tokens = _tokens(prompt), _tokens(content)
+        if (error := await _admit(prompt_tokens + completion_tokens)) is not None:
+            return error
+
+        rsp_id, created, model = f"chatcmpl-{uuid.uuid4().hex}", int(time.time()), body.get("model", "fake")
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                 "total_tokens": prompt_tokens + completion_tokens}
+        if not body.get("stream"):
+            return {"id": rsp_id, "object": "chat.completion", "created": created, "model": model,
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": usage}
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage", False)
+
+        async def events():
+            def chunk(choices, **extra):
+                data = {"id": rsp_id, "object": "chat.completion.chunk", "created": created,
+                        "model": model, "choices": choices, **extra}
+                return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+            pieces = re.findall(r"\S+\s*|\s+", content)
+            delay = 1 / profile.stream_tps if profile.stream_tps > 0 else 0
+            for i, piece in enumerate(pieces):
+                delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+                yield chunk([{"index": 0, "delta": delta, "finish_reason": None}])
+                if delay:
+                    await asyncio.sleep(delay)
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if include_usage:
+                yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body.get("input", [])
+        texts = [texts] if isinstance(texts, str) else texts
+        tokens = sum(_tokens(str(t)) for t in texts)
+        if (error := await _admit(tokens)) is not None:
+            return error
+        vectors = stub_vectors([str(t) for t in texts], int(body.get("dimensions") or EMBED_DIM))
+        as_base64 = body.get("encoding_format") == "base64"
+        data = [{"object": "embedding", "index": i,
+                 "embedding": base64.b64encode(vec.tobytes()).decode() if as_base64 else vec.tolist()}
+                for i, vec in enumerate(vectors)]
+        return {"object": "list", "data": data, "model": body.get("model", "fake"),
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+    return app
+
+
+class FakeOpenAIServer:
+    """
+    Сервер в фоновом потоке для тестов и бенчмарков:
+        with FakeOpenAIServer(FakeProfile(latency="fixed:50")) as server:
+            os.environ["OPENAI_BASE_URL"] = server.base_url
+    """
+
+    def __init__(self, profile: FakeProfile | None = None, host: str = "127.0.0.1", port: int = 0):
+        self.app = create_app(profile)
+        self._server = uvicorn.Server(uvicorn.Config(self.app, host=host, port=port,
+                                                     log_level="warning", lifespan="off"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        sock = self._server.servers[0].sockets[0]
+        host, port = sock.getsockname()[:2]
+        return f"http://{host}:{port}/v1"
+
+    def __enter__(self) -> "FakeOpenAIServer":
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if time.monotonic() > deadline or not self._thread.is_alive():
+                raise RuntimeError("Fake OpenAI server failed to start")
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join(timeout=5)
+
+
+def main():
+    defaults = FakeProfile.from_env()
+    parser = argparse.ArgumentParser(description="Local OpenAI-compatible stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency", default=defaults.latency)
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate)
+    parser.add_argument("--rate-429", type=float, default=defaults.rate_429)
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after)
+    parser.add_argument("--tokens-per-min", type=int, default=defaults.tokens_per_min)
+    parser.add_argument("--stream-tps", type=float, default=defaults.stream_tps)
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens)
+    parser.add_argument("--seed", type=int, default=defaults.seed)
+    args = parser.parse_args()
+    profile = FakeProfile(latency=args.latency, error_rate=args.error_rate, rate_429=args.rate_429,
+                          retry_after=args.retry_after, tokens_per_min=args.tokens_per_min,
+                          stream_tps=args.stream_tps, completion_tokens=args.completion_tokens, seed=args.seed)
+    uvicorn.run(create_app(profile), host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
@@ -22,7 +22,7 @@ from typing import List
 
 from minio import Minio
 from qdrant_client import QdrantClient, models
-from backend.embedding import get as embed
+from backend.embedding import embed_document as embed
 import pdfminer.high_level
 import docx
 from tqdm import tqdm
@@ -114,6 +114,7 @@ def ingest_path(path: pathlib.Path, bucket: str = BUCKET_DEF, prefix: str = PREF
         mc.fput_object(bucket, key, str(path))
 
     text = extract_text_from_file(path)
+    # Весь документ: куски по границам токенов в одном батч-запросе, вектор — их среднее
     vec = embed(text)
     
     # Добавляем doc_id в payload
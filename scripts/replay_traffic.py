@@ -0,0 +1,92 @@
+"""
+Прогон записанного трафика через настоящий конвейер диалога (chat_stream → handle_message).
+Вход — JSONL, по строке на сообщение: {"message": "...", "thread_id": "..."} (thread_id необязателен;
+без "message" берётся "title" или "body"). Ответы LLM/эмбеддингов/browser_search берутся из
+кассеты (backend.cassette), записанной ранее с LLM_CASSETTE_MODE=record.
+
+    python -m scripts.replay_traffic traffic.jsonl --cassette /data/cassette.db --scale 0.5 --concurrency 8
+    python -m scripts.replay_traffic traffic.jsonl --mode record     # запись кассеты на живом API
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import time
+import uuid
+
+from backend import cassette
+
+
+def load_traffic(path: str) -> list[tuple[str, str]]:
+    """(thread_id, message) по строкам JSONL; строки без текста пропускаются."""
+    out = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            message = item.get("message") or item.get("title") or item.get("body")
+            if isinstance(message, str) and message:
+                out.append((item.get("thread_id") or f"replay-{uuid.uuid4().hex[:8]}", message))
+    return out
+
+
+async def _run_thread(thread_id: str, messages: list[str]) -> list[float]:
+    """Сообщения одного диалога по очереди; возвращает длительности ходов в секундах."""
+    from backend.chat_core import chat_stream
+
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(chat_stream(thread_id, in_q, out_q))
+    durations = []
+    for message in messages:
+        started = time.monotonic()
+        await in_q.put(json.dumps({"message": message}))
+        while True:
+            resp = await out_q.get()
+            if resp is None or resp.get("type") in ("chat", "error"):
+                break
+        durations.append(time.monotonic() - started)
+    await in_q.put(None)
+    await task
+    return durations
+
+
+async def replay(traffic: list[tuple[str, str]], concurrency: int) -> list[float]:
+    threads: dict[str, list[str]] = {}
+    for thread_id, message in traffic:
+        threads.setdefault(thread_id, []).append(message)
+    sem = asyncio.Semaphore(concurrency)
+
+    async def limited(thread_id, messages):
+        async with sem:
+            return await _run_thread(thread_id, messages)
+
+    results = await asyncio.gather(*(limited(t, m) for t, m in threads.items()))
+    return [d for durations in results for d in durations]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traffic through the dialog pipeline")
+    parser.add_argument("traffic", help="JSONL with one message per line")
+    parser.add_argument("--mode", choices=["replay", "record"], default="replay")
+    parser.add_argument("--cassette", default=cassette.PATH)
+    parser.add_argument("--scale", type=float, default=cassette.LATENCY_SCALE,
+                        help="multiplier for recorded latencies (0 — no delays)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    cassette.MODE, cassette.PATH, cassette.LATENCY_SCALE = args.mode, args.cassette, args.scale
+    traffic = load_traffic(args.traffic)
+    started = time.monotonic()
+    durations = sorted(asyncio.run(replay(traffic, args.concurrency)))
+    total = time.monotonic() - started
+    if not durations:
+        print("No messages replayed")
+        return
+    p95 = durations[min(len(durations) - 1, int(0.95 * len(durations)))]
+    print(f"{len(durations)} turns in {total:.2f}s — p50 {statistics.median(durations):.2f}s, "
+          f"p95 {p95:.2f}s, max {durations[-1]:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,9 +3,20 @@ import qdrant_client
 from qdrant_client.models import Distance, VectorParams, PointStruct
 import json
 import tqdm
-from backend.embedding_pool import get_embedding_async
+from backend import embedding_pool
 import asyncio
 
+async def _embed_questions(questions: list[str]) -> list:
+    """Эмбеддинги всех вопросов через один пул: батчи собираются из параллельных запросов."""
+    await embedding_pool.start()
+    try:
+        return await asyncio.gather(
+            *(embedding_pool.get_embedding_async(q) for q in questions),
+            return_exceptions=True,
+        )
+    finally:
+        await embedding_pool.stop()
+
 def main():
     """
     Основная функция для обновления эмбеддингов диалогов.
@@ -34,8 +45,10 @@ def main():
     cur = conn.execute("SELECT thread_id, body, ts FROM dialog_log ORDER BY ts")
     
     print("Starting to process dialogs...")
-    
-    for row in tqdm.tqdm(list(cur)):
+
+    # Сначала отбираем пары вопрос/ответ, затем эмбеддим все вопросы в одном event loop
+    pairs = []
+    for row in list(cur):
         tid, body, ts = row
         
         try:
@@ -50,10 +63,17 @@ def main():
             # Проверяем, что роли соответствуют вопросу и ответу
             if msgs[0]["role"] not in ["user", "human"] or msgs[-1]["role"] not in ["assistant", "ai"]:
                 continue
+            pairs.append((tid, question, answer, ts))
+        except (json.JSONDecodeError, IndexError, KeyError, TypeError) as e:
+            print(f"Could not process thread {tid}: {e}")
 
-            # Получаем эмбеддинг для вопроса
-            emb = asyncio.run(get_embedding_async(question))
+    embeddings = asyncio.run(_embed_questions([q for _, q, _, _ in pairs]))
 
+    for (tid, question, answer, ts), emb in tqdm.tqdm(list(zip(pairs, embeddings))):
+        if isinstance(emb, Exception):
+            print(f"Could not embed thread {tid}: {emb}")
+            continue
+        try:
             # Загружаем в Qdrant
             qdr.upsert(
                 collection_name="dialogs",
@@ -66,8 +86,6 @@ def main():
                     )
                 ]
             )
-        except (json.JSONDecodeError, IndexError) as e:
-            print(f"Could not process thread {tid}: {e}")
         except Exception as e:
             print(f"An unexpected error occurred with thread {tid}: {e}")
 
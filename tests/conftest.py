@@ -1,7 +1,9 @@
 # --- Импорты ---
+import asyncio
 import os
 import sys
 import pytest
+from types import SimpleNamespace
 from unittest.mock import patch, AsyncMock
 import socket
 import uuid
@@ -71,6 +73,102 @@ def reset_config():
     if hasattr(config, 'config') and hasattr(config.config, 'reload'):
         config.config.reload()
 
+@pytest.fixture(autouse=True)
+def reset_embedding_lru():
+    """LRU эмбеддингов живёт в процессе — сбрасываем, чтобы тесты не видели векторы друг друга"""
+    from backend.embedding import flush_local_cache
+    from backend import llm_cache
+    flush_local_cache()
+    llm_cache.flush_local()
+    yield
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    """
+    Фабрика локального OpenAI-совместимого сервера (scripts/fake_openai.py):
+    fake_openai(latency="fixed:50", rate_429=0.1) запускает сервер и направляет
+    на него backend через OPENAI_BASE_URL; клиенты пересоздаются под новый адрес.
+    """
+    from scripts.fake_openai import FakeOpenAIServer, FakeProfile
+    from backend import config, openai_helpers, embedding_pool
+    servers = []
+
+    def start(**profile):
+        server = FakeOpenAIServer(FakeProfile(**profile)).__enter__()
+        servers.append(server)
+        monkeypatch.setenv("OPENAI_BASE_URL", server.base_url)
+        monkeypatch.setenv("OPENAI_API_KEY", "sk-fake")
+        monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "OPENAI_API_KEY": "sk-fake"})
+        monkeypatch.setattr(openai_helpers, "_async_client", None)
+        monkeypatch.setattr(embedding_pool, "client", None)
+        return server
+
+    yield start
+    for server in servers:
+        server.__exit__(None, None, None)
+
+# --- Живой режим openai_helpers без сети ---
+class FakeStream:
+    """AsyncStream: чанки с дельтами, пауза после каждого, usage — в последнем чанке; close() отмечается."""
+    def __init__(self, pieces, pause=0.0, usage=None):
+        self.pieces, self.pause, self.usage = pieces, pause, usage
+        self.closed = False
+
+    async def __aiter__(self):
+        for piece in self.pieces:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=piece))])
+            await asyncio.sleep(self.pause)
+        yield SimpleNamespace(choices=[], usage=self.usage)
+
+    async def close(self):
+        self.closed = True
+
+class FakeAsyncClient:
+    """
+    AsyncClient с chat.completions.create по сценарию: каждый вызов берёт следующий шаг,
+    последний повторяется. Шаг — текст ответа, (задержка, текст), исключение или
+    callable(params) → шаг. При stream=True текст (или список дельт) отдаётся FakeStream,
+    задержка — пауза после каждого чанка. usage=(prompt, completion) приходит с ответом.
+    """
+    def __init__(self, *steps, usage=None):
+        self.steps = list(steps) or ["ответ"]
+        self.usage = SimpleNamespace(prompt_tokens=usage[0], completion_tokens=usage[1]) if usage else None
+        self.calls = []  # params каждого вызова
+        self.streams = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **params):
+        step = self.steps[min(len(self.calls), len(self.steps) - 1)]
+        self.calls.append(params)
+        if callable(step):
+            step = step(params)
+        if isinstance(step, Exception):
+            raise step
+        delay, content = step if isinstance(step, tuple) else (0.0, step)
+        if params.get("stream"):
+            stream = FakeStream([content] if isinstance(content, str) else content, delay, self.usage)
+            self.streams.append(stream)
+            return stream
+        await asyncio.sleep(delay)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=self.usage)
+
+@pytest.fixture
+def live_llm(monkeypatch):
+    """
+    Живой путь call_llm/call_llm_stream (реальный ключ, не тестовый режим) на FakeAsyncClient:
+    live_llm(*steps, usage=...) ставит клиент по сценарию и возвращает его.
+    """
+    from backend import openai_helpers
+    monkeypatch.setattr(openai_helpers.config.config, "_cache",
+                        {**openai_helpers.config.config._cache, "OPENAI_API_KEY": "sk-real"})
+    monkeypatch.setattr(openai_helpers, "is_test_mode", lambda: False)
+
+    def use(*steps, usage=None):
+        client = FakeAsyncClient(*steps, usage=usage)
+        monkeypatch.setattr(openai_helpers, "_get_async_client", lambda: client)
+        return client
+    return use
+
 def _service_available(host: str, port: int) -> bool:
     try:
         socket.create_connection((host, port), timeout=1)
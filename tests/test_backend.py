@@ -55,6 +55,30 @@ class TestEmbedding:
             
         assert result == [0.1] * 1536
         mock_client.embeddings.create.assert_called_once()
+        # В кеш пишется бинарный float32, а не JSON
+        cached = mock_redis.set.call_args[0][1]
+        assert isinstance(cached, bytes)
+        assert len(cached) == 4 + 1536 * 4
+
+    def test_embedding_cache_binary_roundtrip(self):
+        """Binary cache entries decode into a float32 array without copying"""
+        from backend.embedding import _pack, _unpack
+        raw = _pack([0.25, -1.0, 3.5])
+        vec = _unpack(raw)
+        assert vec.dtype.name == "float32"
+        assert vec.tolist() == [0.25, -1.0, 3.5]
+        assert not vec.flags.owndata
+
+    def test_embedding_cache_reads_legacy_json(self):
+        """Legacy JSON entries are still served and rewritten in binary form"""
+        import json
+        from backend import embedding
+        cache = {}
+        key = embedding._cache_key("legacy text")
+        cache[key] = json.dumps([0.5] * 1536)
+        with patch.object(embedding, "_r", cache):
+            assert embed("legacy text") == [0.5] * 1536
+        assert cache[key].startswith(embedding._CACHE_MAGIC)
 
 class TestMemory:
     """Test memory functionality"""
@@ -120,3 +144,102 @@ class TestMemory:
         # Verify isolation
         assert get_mem(session1) == data1
         assert get_mem(session2) == data2
+
+
+class TestLongDocumentEmbedding:
+    """Длинные тексты режутся по токенам и эмбеддятся одним батчем"""
+
+    def test_split_tokens_respects_limit(self):
+        from backend.embedding import split_tokens, _encoding, MODEL
+        text = "Политика информационной безопасности. " * 200
+        chunks = split_tokens(text, max_tokens=256)
+        enc = _encoding(MODEL)
+        # Без словаря tiktoken проверяем по байтам UTF-8 — это верхняя граница числа токенов
+        token_len = (lambda c: len(enc.encode(c))) if enc else (lambda c: len(c.encode()))
+        assert len(chunks) > 1
+        assert all(token_len(c) <= 256 for c in chunks)
+
+    def test_short_text_is_not_tokenized(self):
+        from backend.embedding import split_tokens
+        with patch("backend.embedding._encoding") as enc:
+            assert split_tokens("короткий вопрос", max_tokens=100) == ["короткий вопрос"]
+        enc.assert_not_called()
+
+    @patch('backend.embedding._get_client')
+    def test_long_text_single_batched_call(self, mock_get_client):
+        """Куски длинного текста уходят одним запросом, результат — нормированное среднее"""
+        import numpy as np
+        from backend import embedding
+
+        def create(model, input):
+            return MagicMock(data=[MagicMock(embedding=[float(i + 1), 0.0]) for i, _ in enumerate(input)])
+
+        mock_get_client.return_value.embeddings.create.side_effect = create
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "real-key"}), \
+             patch.object(embedding, "_r", {}), \
+             patch.object(embedding, "MAX_INPUT_TOKENS", 64):
+            vec = embed("Опросник по DLP. " * 100)
+            chunks = embedding.embed_document("Опросник по DLP. " * 100, mode="chunks")
+
+        mock_get_client.return_value.embeddings.create.assert_called_once()
+        assert np.isclose(np.linalg.norm(vec), 1.0)
+        assert len(chunks) > 1
+        assert all(isinstance(c, str) and len(v) == 2 for c, v in chunks)
+
+
+    @patch('backend.embedding._get_client')
+    def test_long_document_split_by_token_budget(self, mock_get_client):
+        """Промахи длинного документа делятся на запросы не больше бюджета токенов"""
+        from backend import embedding
+
+        text = ("Журнал событий SIEM с корреляцией инцидентов. " * 300).strip()
+        tokens = dict(embedding.split_counted(text, 64))
+        sizes = []
+
+        def create(model, input):
+            sizes.append(sum(tokens[c] for c in input))
+            return MagicMock(data=[MagicMock(embedding=[1.0, 0.0]) for _ in input])
+
+        mock_get_client.return_value.embeddings.create.side_effect = create
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "real-key"}), \
+             patch.object(embedding, "_r", {}), \
+             patch.object(embedding, "BATCH_TOKEN_BUDGET", 200):
+            chunks = embedding.embed_document(text, mode="chunks", chunk_tokens=64)
+
+        assert len(sizes) > 1
+        assert all(n <= 200 for n in sizes)
+        assert sum(sizes) == sum(tokens.values())  # повторяющиеся куски — один раз
+        assert len(chunks) == len(embedding.split_tokens(text, 64))
+
+    def test_mean_pool_weights_by_tokens(self):
+        """Вес куска — число токенов, а не символов"""
+        import numpy as np
+        from backend import embedding
+
+        pieces = [("a" * 10, 1), ("б" * 2, 3)]
+        with patch.object(embedding, "split_counted", lambda text, max_tokens=None: pieces), \
+             patch.object(embedding, "_get_flat", lambda texts, tokens: [[1.0, 0.0], [0.0, 1.0]]):
+            vec = embedding.embed_document("документ")
+
+        assert np.allclose(vec, np.array([1.0, 3.0]) / np.sqrt(10), atol=1e-6)
+
+
+class TestStubEmbedding:
+    """Векторизованный stub-эмбеддер"""
+
+    def test_stub_vectors_deterministic_and_normalized(self):
+        import numpy as np
+        from backend.embedding import stub_vectors, EMBED_DIM
+        batch = stub_vectors(["DLP", "SIEM", "DLP"])
+        assert batch.shape == (3, EMBED_DIM)
+        assert batch.dtype == np.float32
+        assert np.allclose(np.linalg.norm(batch, axis=1), 1.0, atol=1e-5)
+        assert np.array_equal(batch[0], batch[2])
+        assert np.array_equal(stub_vectors(["SIEM"])[0], batch[1])
+        # разные тексты почти ортогональны — cosine-пороги kb_search не срабатывают случайно
+        assert abs(float(batch[0] @ batch[1])) < 0.2
+
+    def test_stub_mode_uses_stub_vectors(self):
+        from backend import embedding
+        with patch.dict(os.environ, {"OPENAI_API_KEY": "stub"}), patch.object(embedding, "_r", {}):
+            assert embed("вопрос") == embedding.stub_vectors(["вопрос"])[0].tolist()
@@ -0,0 +1,119 @@
+"""
+Отключение клиента посреди хода: отмена задачи chat_stream прерывает handle_message
+"""
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+
+from backend import chat_core, metrics, usage
+
+
+async def empty_listen(thread_id):
+    if False:
+        yield
+
+
+@pytest.fixture
+def long_turn(monkeypatch):
+    """handle_message тратит 150 токенов и висит, пока его не отменят."""
+    state = {"started": asyncio.Event(), "cancelled": False}
+
+    async def handle_message(thread_id, user_q, slots, logger):
+        usage.record("gpt-4.1", 100, 50)
+        state["started"].set()
+        try:
+            await asyncio.sleep(300)
+        except asyncio.CancelledError:
+            state["cancelled"] = True
+            raise
+
+    async def enforce():
+        return chat_core.token_budget.OK
+
+    monkeypatch.setattr(chat_core, "handle_message", handle_message)
+    monkeypatch.setattr(chat_core, "get_mem", lambda tid: {})
+    async def charge(tokens):
+        pass
+
+    monkeypatch.setattr(chat_core.token_budget, "enforce", enforce)
+    monkeypatch.setattr(chat_core.token_budget, "charge", charge)
+    monkeypatch.setattr(chat_core.usage, "_write", lambda batch: None)
+    monkeypatch.setattr(chat_core, "_completed_turns", chat_core.deque([(10.0, 1000)] * 3, maxlen=200))
+    return state
+
+
+@pytest.mark.asyncio
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_cancel_aborts_turn_and_records_savings(long_turn):
+    cancelled = metrics.TURN_CANCELLED
+    tokens = metrics.CANCEL_SAVED_TOKENS
+    seconds = metrics.CANCEL_SAVED_SECONDS
+    before = cancelled._value.get(), tokens._value.get(), seconds._value.get()
+
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    task = asyncio.create_task(chat_core.chat_stream("gone-thread", in_q, out_q))
+    await in_q.put(json.dumps({"message": "Сравни EDR и XDR"}))
+    await asyncio.wait_for(long_turn["started"].wait(), 1)
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await asyncio.wait_for(task, 1)
+
+    assert long_turn["cancelled"]
+    assert await out_q.get() is None
+    assert cancelled._value.get() - before[0] == 1
+    assert tokens._value.get() - before[1] == 850
+    assert seconds._value.get() - before[2] == pytest.approx(10.0, abs=0.5)
+    assert usage.pop_turn_tokens("gone-thread", 0) == 0
+
+
+@pytest.mark.asyncio
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_completed_turn_feeds_estimate(monkeypatch):
+    """Завершённый ход попадает в окно оценки вместе со своими токенами"""
+    async def handle_message(thread_id, user_q, slots, logger):
+        usage.record("gpt-4.1-mini", 30, 12)
+        return {"type": "chat", "role": "assistant", "content": "ok"}
+
+    monkeypatch.setattr(chat_core, "handle_message", handle_message)
+    monkeypatch.setattr(chat_core, "get_mem", lambda tid: {})
+    monkeypatch.setattr(chat_core, "get_current_thread_messages", lambda tid: [])
+    monkeypatch.setattr(chat_core, "save_dialog_full", lambda tid, msgs: None)
+    monkeypatch.setattr(chat_core.usage, "_write", lambda batch: None)
+    monkeypatch.setattr(chat_core, "_completed_turns", chat_core.deque(maxlen=200))
+
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    await in_q.put(json.dumps({"message": "привет"}))
+    await in_q.put(None)
+    await chat_core.chat_stream("done-thread", in_q, out_q)
+
+    assert [t[1] for t in chat_core._completed_turns] == [42]
+
+
+@pytest.mark.asyncio
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_ws_disconnect_cancels_pipeline(long_turn, monkeypatch):
+    """WebSocketDisconnect в main.chat отменяет ход, а не ждёт его окончания"""
+    from unittest.mock import AsyncMock
+    from fastapi import WebSocketDisconnect
+    from backend import main
+
+    async def receive_text():
+        if not long_turn["started"].is_set() and ws.receive_text.await_count == 1:
+            return json.dumps({"message": "Сравни EDR и XDR"})
+        await long_turn["started"].wait()
+        raise WebSocketDisconnect(1001)
+
+    async def not_limited(ip):
+        return False
+
+    ws = AsyncMock()
+    ws.receive_text.side_effect = receive_text
+    monkeypatch.setattr(main, "check_rate_limit", not_limited)
+    monkeypatch.setattr(main, "_status_forwarder", AsyncMock())
+
+    await asyncio.wait_for(main.chat(ws), 2)
+
+    assert long_turn["cancelled"]
@@ -0,0 +1,76 @@
+"""
+Кассета: запись живых ответов LLM/эмбеддингов и воспроизведение без API
+"""
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import backend.openai_helpers as h
+from backend import cassette, embedding_pool
+
+
+@pytest.fixture
+def tape(tmp_path, monkeypatch):
+    monkeypatch.setattr(cassette, "PATH", str(tmp_path / "cassette.db"))
+    monkeypatch.setattr(h.llm_cache, "ENABLED", False)
+
+    def use(mode, scale=1.0):
+        monkeypatch.setattr(cassette, "MODE", mode)
+        monkeypatch.setattr(cassette, "LATENCY_SCALE", scale)
+    return use
+
+
+@pytest.mark.asyncio
+async def test_llm_record_then_replay(tape, live_llm):
+    """Записанный ответ воспроизводится с масштабированной задержкой, API не вызывается"""
+    tape("record")
+    live_llm((0.2, '{"draft": "план"}'), usage=(12, 4))
+    recorded, recorded_ms = await h.call_llm("gpt-4.1", "Planner-агент: вопрос", temperature=0.2)
+
+    tape("replay", scale=0.25)
+    live_llm(lambda params: pytest.fail("replay must not call the API"))
+    started = time.monotonic()
+    replayed, replayed_ms = await h.call_llm("gpt-4.1", "Planner-агент: вопрос", temperature=0.2)
+    elapsed = time.monotonic() - started
+
+    assert replayed == recorded == '{"draft": "план"}'
+    assert replayed_ms == recorded_ms >= 200
+    assert 0.04 <= elapsed < 0.15
+    deltas = [d async for d in h.call_llm_stream("gpt-4.1", "Planner-агент: вопрос", temperature=0.2)]
+    assert "".join(deltas) == replayed
+
+
+@pytest.mark.asyncio
+async def test_replay_miss_falls_back_to_stub(tape, monkeypatch):
+    """Промах кассеты уходит обычным путём — в stub-режиме это stub-ответ"""
+    tape("replay")
+    monkeypatch.setattr(h.config.config, "_cache", {**h.config.config._cache, "OPENAI_API_KEY": "stub"})
+    text, _ = await h.call_llm("gpt-4.1", "незаписанный вопрос")
+    assert text.startswith("[stub]")
+
+
+@pytest.mark.asyncio
+async def test_embeddings_record_then_replay(tape, monkeypatch):
+    """Векторы батча пишутся по тексту и воспроизводятся для любого состава батча"""
+    async def create(model, input):
+        return SimpleNamespace(data=[SimpleNamespace(embedding=[float(len(t)), 0.5]) for t in input])
+
+    monkeypatch.setattr(embedding_pool, "_offline_mode", lambda: False)
+    monkeypatch.setattr(embedding_pool, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    tape("record")
+    await embedding_pool._embed_batch(["а", "бб", "ввв"])
+
+    monkeypatch.setattr(embedding_pool, "client", None)
+    monkeypatch.setattr(embedding_pool, "_ensure_client", lambda: pytest.fail("replay must not call the API"))
+    tape("replay", scale=0)
+    assert await embedding_pool._embed_batch(["ввв", "а"]) == [[3.0, 0.5], [1.0, 0.5]]
+    assert cassette.embed_lookup(["нет в кассете"], embedding_pool.MODEL) is None
+
+
+def test_store_creates_missing_directory(tmp_path):
+    """Первая запись в ещё не созданный каталог не падает на sqlite3.connect"""
+    store = cassette.CassetteStore(str(tmp_path / "new" / "dir" / "cassette.db"))
+    store.put_many("llm", [("k", cassette.Entry("ответ".encode(), 5, {}))])
+    store._loaded = None
+    assert store.get("k").latency_ms == 5
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+
+import pytest
+
+from backend import coalesce, config, metrics, status_bus
+
+test_logger = logging.getLogger("test_coalesce")
+
+
+@pytest.fixture
+def slow_handler(monkeypatch):
+    """handle_message на 0.1 с; считает, сколько раз реально выполнялся конвейер."""
+    monkeypatch.setattr(status_bus, "_redis_pub", None)
+    calls = []
+
+    async def handler(thread_id, user_q, slots, logger):
+        calls.append(thread_id)
+        await status_bus.publish(thread_id, "thinking", None)
+        await asyncio.sleep(0.1)
+        return {"type": "chat", "role": "assistant", "content": f"ответ для {thread_id}"}
+
+    handler.calls = calls
+    return handler
+
+
+def test_normalize_ignores_case_and_punctuation():
+    assert coalesce.normalize("Как настроить  InfoWatch DLP?!") == coalesce.normalize("как настроить infowatch dlp")
+    assert coalesce.key("Ещё вопрос", {}) == coalesce.key("еще вопрос.", {})
+    assert coalesce.key("вопрос", {"file_key": "a"}) != coalesce.key("вопрос", {})
+
+
+@pytest.mark.asyncio
+async def test_identical_questions_share_one_run(slow_handler):
+    """Одинаковые вопросы трёх сессий — один прогон конвейера"""
+    follower = metrics.COALESCE.labels(role="follower")
+    before = follower._value.get()
+
+    async def ask(tid, q, delay):
+        await asyncio.sleep(delay)
+        return await coalesce.run(slow_handler, tid, q, {}, test_logger)
+
+    results = await asyncio.gather(ask("lead", "Как настроить InfoWatch DLP?", 0),
+                                   ask("f1", "как настроить infowatch dlp", 0.01),
+                                   ask("f2", "Как настроить InfoWatch DLP", 0.01))
+
+    assert slow_handler.calls == ["lead"]
+    assert [r["content"] for r in results] == ["ответ для lead"] * 3
+    assert results[1] is not results[2]
+    assert follower._value.get() - before == 2
+    assert not coalesce._inflight and not status_bus._followers
+
+
+@pytest.mark.asyncio
+async def test_follower_receives_leader_status(slow_handler):
+    """Статусы, опубликованные ведущим после присоединения, приходят и в поток ведомого"""
+    async def publishing(thread_id, user_q, slots, logger):
+        await asyncio.sleep(0.05)
+        await status_bus.publish(thread_id, "searching", "local KB")
+        return {"type": "chat", "role": "assistant", "content": "ok"}
+
+    status_bus._local_queues.pop("mirror-f", None)
+    await asyncio.gather(coalesce.run(publishing, "mirror-lead", "статус", {}, test_logger),
+                         coalesce.run(publishing, "mirror-f", "статус", {}, test_logger))
+
+    item = status_bus._local_queues["mirror-f"].get_nowait()
+    assert item["stage"] == "searching" and item["thread"] == "mirror-f"
+
+
+@pytest.mark.asyncio
+async def test_fanout_limit_runs_overflow_separately(slow_handler, monkeypatch):
+    monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "COALESCE_MAX_FOLLOWERS": "1"})
+    overflow = metrics.COALESCE.labels(role="overflow")
+    before = overflow._value.get()
+
+    await asyncio.gather(*(coalesce.run(slow_handler, tid, "вопрос", {}, test_logger) for tid in ("a", "b", "c")))
+
+    assert sorted(slow_handler.calls) == ["a", "c"]
+    assert overflow._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_leader_disconnect_keeps_followers(slow_handler):
+    """Отмена ведущего не обрывает ответ ведомому; без ожидающих конвейер отменяется"""
+    leader = asyncio.create_task(coalesce.run(slow_handler, "lead", "вопрос", {}, test_logger))
+    await asyncio.sleep(0.01)
+    follower = asyncio.create_task(coalesce.run(slow_handler, "f1", "вопрос", {}, test_logger))
+    await asyncio.sleep(0.01)
+    flight = next(iter(coalesce._inflight.values()))
+
+    leader.cancel()
+    assert (await follower)["content"] == "ответ для lead"
+    assert not flight.task.cancelled()
+
+    alone = asyncio.create_task(coalesce.run(slow_handler, "solo", "другой вопрос", {}, test_logger))
+    await asyncio.sleep(0.01)
+    flight = next(iter(coalesce._inflight.values()))
+    alone.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await alone
+    assert flight.task.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_disabled_runs_every_request(slow_handler, monkeypatch):
+    monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "COALESCE_ENABLED": "0"})
+
+    await asyncio.gather(*(coalesce.run(slow_handler, tid, "вопрос", {}, test_logger) for tid in ("a", "b")))
+
+    assert slow_handler.calls == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_follower_receives_chunks_and_pays(monkeypatch):
+    """Стрим общего прогона — всем ожидающим; ведущий платит по ходу прогона, ведомый — по его итогу"""
+    from backend import token_budget, usage
+    from backend.openai_helpers import partial_sink
+
+    charged = []
+
+    async def charge(tokens):
+        charged.append((token_budget.current_scope.get(), tokens))
+
+    monkeypatch.setattr(coalesce.token_budget, "charge", charge)
+    monkeypatch.setattr(usage, "_write", lambda batch: None)
+
+    async def streaming(thread_id, user_q, slots, logger):
+        assert token_budget.current_scope.get() == ("lead", "10.0.0.1")
+        sink = partial_sink.get()
+        await sink("раз ")
+        usage.record("gpt-4.1", 100, 20)
+        await token_budget.charge(120)  # как _log_api_usage
+        await asyncio.sleep(0.05)
+        await sink("два")
+        return {"type": "chat", "role": "assistant", "content": "раз два"}
+
+    async def ask(tid, delay):
+        got = []
+
+        async def sink(delta):
+            got.append(delta)
+
+        partial_sink.set(sink)
+        usage.current_turn.set((tid, 0))
+        token_budget.current_scope.set((tid, "10.0.0.1"))
+        await asyncio.sleep(delay)
+        await coalesce.run(streaming, tid, "стрим", {}, test_logger)
+        return got, usage.pop_turn_tokens(tid, 0)
+
+    (lead_chunks, lead_tokens), (f_chunks, f_tokens) = await asyncio.gather(ask("lead", 0), ask("f", 0.01))
+
+    assert lead_chunks == f_chunks == ["раз ", "два"]
+    assert lead_tokens == f_tokens == 120
+    assert sorted(charged) == [(("f", "10.0.0.1"), 120), (("lead", "10.0.0.1"), 120)]
+
+
+@pytest.mark.asyncio
+async def test_leader_budget_exceeded_follower_runs_alone(monkeypatch):
+    """Жёсткий лимит ведущего — ошибка только ведущему, ведомый отвечает своим прогоном"""
+    from backend import token_budget
+
+    monkeypatch.setattr(status_bus, "_redis_pub", None)
+
+    async def handler(thread_id, user_q, slots, logger):
+        await asyncio.sleep(0.05)
+        if thread_id == "broke":
+            raise token_budget.TokenBudgetExceeded("session", 100, 100)
+        return {"type": "chat", "role": "assistant", "content": f"ответ для {thread_id}"}
+
+    lead, follower = await asyncio.gather(coalesce.run(handler, "broke", "лимит", {}, test_logger),
+                                          coalesce.run(handler, "rich", "лимит", {}, test_logger),
+                                          return_exceptions=True)
+
+    assert isinstance(lead, token_budget.TokenBudgetExceeded)
+    assert follower["content"] == "ответ для rich"
@@ -0,0 +1,321 @@
+import asyncio
+import httpx
+import openai
+import pytest
+from types import SimpleNamespace
+from unittest.mock import AsyncMock, MagicMock
+
+from backend import embedding_pool
+from backend.embedding import _cache_key, _pack
+
+
+class FakeAsyncRedis:
+    """Минимальный async-Redis: get + pipeline().set/execute"""
+    def __init__(self):
+        self.data = {}
+
+    async def get(self, key):
+        return self.data.get(key)
+
+    def pipeline(self, transaction=False):
+        redis = self
+
+        class _Pipe:
+            def __init__(self):
+                self.ops = []
+            async def __aenter__(self):
+                return self
+            async def __aexit__(self, *exc):
+                return False
+            def set(self, key, value, ex=None):
+                self.ops.append((key, value))
+            async def execute(self):
+                redis.data.update(self.ops)
+
+        return _Pipe()
+
+
+@pytest.fixture
+def fake_cache(monkeypatch):
+    cache = FakeAsyncRedis()
+    monkeypatch.setattr(embedding_pool.EmbeddingPool, "_get_cache", AsyncMock(return_value=cache))
+    return cache
+
+
+@pytest.fixture
+async def pool():
+    """Пул текущего loop'а; по завершении теста останавливается с дренажом"""
+    yield embedding_pool.get_pool()
+    await embedding_pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_cache_hit_skips_queue(fake_cache, monkeypatch):
+    """Попадание в кеш не ставит задачу в очередь батчей"""
+    fake_cache.data[_cache_key("вопрос", embedding_pool.MODEL)] = _pack([0.5, 0.25])
+    started = MagicMock()
+    monkeypatch.setattr(embedding_pool.EmbeddingPool, "start", started)
+
+    vec = await embedding_pool.get_embedding_async("вопрос")
+
+    assert vec == [0.5, 0.25]
+    started.assert_not_called()
+    await embedding_pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_batch_results_written_back(fake_cache, pool, monkeypatch):
+    """После ответа API весь батч записывается в кеш"""
+    create = AsyncMock(return_value=SimpleNamespace(data=[
+        SimpleNamespace(embedding=[0.5, 0.5]),
+        SimpleNamespace(embedding=[0.25, 0.75]),
+    ]))
+    monkeypatch.setattr(embedding_pool, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(embedding_pool, "_offline_mode", lambda: False)
+
+    first, second = await asyncio.gather(
+        embedding_pool.get_embedding_async("один"),
+        embedding_pool.get_embedding_async("два"),
+    )
+    assert first == [0.5, 0.5]
+    assert second == [0.25, 0.75]
+    create.assert_awaited_once()
+    await pool.queue.join()
+    assert _cache_key("один", embedding_pool.MODEL) in fake_cache.data
+    assert _cache_key("два", embedding_pool.MODEL) in fake_cache.data
+
+
+@pytest.mark.asyncio
+async def test_sync_and_async_paths_agree(fake_cache, pool, monkeypatch):
+    """Синхронный get и асинхронный пул дают одинаковый вектор для одного текста"""
+    from backend import embedding
+    monkeypatch.setattr(embedding, "_r", {})
+
+    async_vec = await embedding_pool.get_embedding_async("  как настроить DLP\n")
+    assert embedding.get("как настроить DLP") == async_vec
+    assert embedding_pool.MODEL == embedding.MODEL
+
+
+@pytest.mark.asyncio
+async def test_chunk_token_counts_not_recomputed(fake_cache, pool, monkeypatch):
+    """Куски длинного текста ставятся в очередь с числом токенов из split_counted"""
+    from backend import embedding
+    monkeypatch.setattr(embedding, "MAX_INPUT_TOKENS", 8)
+    monkeypatch.setattr(embedding_pool, "count_tokens",
+                        lambda *a: pytest.fail("count_tokens called for a counted chunk"))
+    text = "длинный документ про настройку DLP"
+    chunks = embedding.split_counted(text)
+    assert len(chunks) > 1
+
+    vec = await embedding_pool.get_embedding_async(text)
+
+    assert len(vec) > 0
+    assert await embedding_pool.get_embedding_async("коротко") != []
+
+
+def test_batch_policy_adapts_to_latency():
+    """Лимит батча растёт при быстрых полных батчах и падает при медленных"""
+    policy = embedding_pool.BatchPolicy(max_size=32, min_size=4, target_latency_ms=100)
+    start = policy.limit
+    policy.observe(0.01, policy.limit)
+    assert policy.limit > start
+    grown = policy.limit
+    policy.observe(0.5, 1)
+    assert policy.limit < grown
+    for _ in range(50):
+        policy.observe(0.5, 1)
+    assert policy.limit == 4
+
+
+@pytest.mark.asyncio
+async def test_token_budget_splits_batch():
+    """Задача, не влезающая в бюджет токенов, уходит в следующий батч"""
+    policy = embedding_pool.BatchPolicy(max_size=16, linger_ms=5, token_budget=100)
+    pool = embedding_pool.EmbeddingPool(policy=policy)
+    loop = asyncio.get_running_loop()
+    for text, tokens in [("b", 40), ("c", 50), ("d", 30)]:
+        pool.queue.put_nowait((text, loop.create_future(), tokens, loop.time() + 30))
+
+    batch, carry = await pool._collect_batch(("a", loop.create_future(), 5, loop.time() + 30), loop)
+
+    assert [item[0] for item in batch] == ["a", "b", "c"]
+    assert carry[0] == "d"
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_share_one_future(fake_cache, pool, monkeypatch):
+    """Одновременные одинаковые запросы уходят в API один раз"""
+    create = AsyncMock(return_value=SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0])]))
+    monkeypatch.setattr(embedding_pool, "client", SimpleNamespace(embeddings=SimpleNamespace(create=create)))
+    monkeypatch.setattr(embedding_pool, "_offline_mode", lambda: False)
+    before = embedding_pool.metrics.EMBED_DEDUP.labels(path="async")._value.get()
+
+    results = await asyncio.gather(*(
+        embedding_pool.get_embedding_async("как настроить DLP") for _ in range(5)
+    ))
+    assert results == [[1.0, 0.0]] * 5
+    create.assert_awaited_once()
+    assert create.await_args.kwargs["input"] == ["как настроить DLP"]
+    assert embedding_pool.metrics.EMBED_DEDUP.labels(path="async")._value.get() - before == 4
+    assert not pool._inflight
+
+
+def test_sync_path_single_flight(monkeypatch):
+    """Потоки с одинаковым текстом ждут первого, а не зовут API повторно"""
+    import threading
+    import time
+    from backend import embedding
+
+    calls = []
+    def slow_embed(texts):
+        calls.append(list(texts))
+        time.sleep(0.1)
+        return [[0.5, 0.5] for _ in texts]
+
+    monkeypatch.setattr(embedding, "_r", {})
+    monkeypatch.setattr(embedding, "_embed_uncached", slow_embed)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(embedding.get("общий вопрос"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert calls == [["общий вопрос"]]
+    assert results == [[0.5, 0.5]] * 4
+    assert not embedding._flight_locks
+
+
+def test_pool_per_event_loop(fake_cache):
+    """Каждый asyncio.run получает свой пул — очередь не привязана к чужому loop'у"""
+    async def run():
+        pool = embedding_pool.get_pool()
+        vec = await embedding_pool.get_embedding_async("изоляция loop")
+        await embedding_pool.stop()
+        return pool, vec
+
+    pool1, vec1 = asyncio.run(run())
+    pool2, vec2 = asyncio.run(run())
+    assert pool1 is not pool2
+    assert vec1 == vec2
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_pending_requests(fake_cache, monkeypatch):
+    """stop() дожидается батча в полёте, а не обрывает ожидающих"""
+    async def slow_batch(texts):
+        await asyncio.sleep(0.05)
+        return [[float(len(t)), 0.0] for t in texts]
+
+    monkeypatch.setattr(embedding_pool, "_embed_batch", slow_batch)
+    pool = embedding_pool.get_pool()
+    pending = [asyncio.create_task(embedding_pool.get_embedding_async(t)) for t in ("a", "bb", "ccc")]
+    await asyncio.sleep(0.01)
+
+    await embedding_pool.stop()
+
+    assert [await t for t in pending] == [[1.0, 0.0], [2.0, 0.0], [3.0, 0.0]]
+    assert not pool._tasks
+    assert embedding_pool.get_pool() is not pool
+    await embedding_pool.stop()
+
+
+@pytest.mark.asyncio
+async def test_bounded_queue_backpressure(fake_cache, monkeypatch):
+    """Заполненная очередь задерживает новых вызывающих, пока воркер не освободит место"""
+    release = asyncio.Event()
+
+    async def gated_batch(texts):
+        await release.wait()
+        return [[1.0] for _ in texts]
+
+    monkeypatch.setattr(embedding_pool, "_embed_batch", gated_batch)
+    pool = embedding_pool.EmbeddingPool(workers=1, maxsize=1,
+                                        policy=embedding_pool.BatchPolicy(max_size=1, min_size=1))
+    pool.start()
+    try:
+        first = asyncio.create_task(pool.embed("первый"))     # в батче у воркера
+        second = asyncio.create_task(pool.embed("второй"))    # занимает очередь
+        third = asyncio.create_task(pool.embed("третий"))     # ждёт места в очереди
+        for _ in range(100):
+            if pool.queue.full() and "третий" in pool._inflight:
+                break
+            await asyncio.sleep(0.01)
+        assert pool.queue.full()
+        assert "третий" in pool._inflight and not third.done()
+
+        release.set()
+        assert await asyncio.gather(first, second, third) == [[1.0]] * 3
+    finally:
+        await pool.stop()
+
+
+def _rate_limited(retry_after: str) -> openai.RateLimitError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/embeddings")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+@pytest.mark.asyncio
+async def test_aimd_limiter_caps_concurrency():
+    """Лимит падает вдвое при перегрузке, растёт аддитивно и ограничивает acquire()"""
+    limiter = embedding_pool.AIMDLimiter(max_limit=4, cooldown=0)
+    limiter.on_overload()
+    assert limiter.limit == 2
+    limiter.on_overload()
+    limiter.on_overload()
+    assert limiter.limit == 1
+
+    await limiter.acquire()
+    second = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not second.done()
+    limiter.release()
+    await asyncio.wait_for(second, 1)
+    limiter.release()
+
+    for _ in range(20):
+        limiter.on_success()
+    assert 1 < limiter.limit <= 4
+
+
+def test_retry_delay_honors_retry_after():
+    """Задержка повтора не меньше Retry-After сервера"""
+    from backend.retry import retry_delay, retry_reason
+    assert retry_delay(_rate_limited("2"), attempt=0, base=0.2, cap=10) >= 2
+    assert retry_reason(_rate_limited("1")) == "429"
+    assert retry_reason(ValueError("bad input")) is None
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_batch_is_retried(fake_cache, pool, monkeypatch):
+    """429 не роняет батч: повтор после Retry-After, лимит конкурентности уменьшается"""
+    calls = []
+
+    async def flaky_batch(texts):
+        calls.append(list(texts))
+        if len(calls) == 1:
+            raise _rate_limited("0.01")
+        return [[1.0, 0.0] for _ in texts]
+
+    monkeypatch.setattr(embedding_pool, "_embed_batch", flaky_batch)
+    retries = embedding_pool.metrics.EMBED_RETRIES.labels(reason="429")
+    before = retries._value.get()
+
+    assert await embedding_pool.get_embedding_async("квота") == [1.0, 0.0]
+    assert calls == [["квота"], ["квота"]]
+    assert retries._value.get() - before == 1
+    assert pool.limiter.limit < pool.limiter.max_limit
+
+
+@pytest.mark.asyncio
+async def test_retry_respects_caller_deadline(fake_cache, pool, monkeypatch):
+    """Если Retry-After дольше дедлайна вызывающего — TimeoutError, а не ожидание"""
+    async def throttled(texts):
+        raise _rate_limited("5")
+
+    monkeypatch.setattr(embedding_pool, "_embed_batch", throttled)
+    started = asyncio.get_running_loop().time()
+    with pytest.raises(asyncio.TimeoutError):
+        await embedding_pool.get_embedding_async("срочно", timeout=0.5)
+    assert asyncio.get_running_loop().time() - started < 1
@@ -99,7 +99,7 @@ class TestSearchAgent:
     """Тесты поискового агента"""
     
     @pytest.mark.asyncio
-    @patch('agents.expert_gc.local_search')
+    @patch('agents.expert_gc.local_search_async')
     async def test_search_basic(self, mock_search):
         """Тест базового поиска"""
         mock_search.return_value = [
@@ -115,7 +115,7 @@ class TestSearchAgent:
         mock_search.assert_called_once_with("DLP", top_k=5)
     
     @pytest.mark.asyncio
-    @patch('agents.expert_gc.local_search')
+    @patch('agents.expert_gc.local_search_async')
     async def test_search_long_text_truncation(self, mock_search):
         """Тест обрезания длинного текста до 40 слов"""
         long_text = " ".join([f"слово{i}" for i in range(50)])  # 50 слов
@@ -131,7 +131,7 @@ class TestSearchAgent:
         assert len(result_words) <= 40
     
     @pytest.mark.asyncio
-    @patch('agents.expert_gc.local_search')
+    @patch('agents.expert_gc.local_search_async')
     async def test_search_without_prefix(self, mock_search):
         """Тест поиска без префикса search:"""
         mock_search.return_value = [{"text": "результат", "score": 0.9}]
@@ -0,0 +1,75 @@
+"""
+Локальный OpenAI-совместимый сервер: backend работает с ним через настоящий HTTP-стек
+"""
+import random
+
+import pytest
+
+import backend.openai_helpers as h
+from backend import embedding_pool
+from scripts.fake_openai import sample_latency, TokenRateLimiter
+
+
+def test_latency_distributions():
+    rng = random.Random(1)
+    assert sample_latency("none", rng) == 0
+    assert sample_latency("fixed:250", rng) == 0.25
+    assert all(0.1 <= sample_latency("uniform:100:200", rng) <= 0.2 for _ in range(100))
+    samples = sorted(sample_latency("lognormal:100:0.5", rng) for _ in range(2001))
+    assert 0.08 < samples[1000] < 0.12
+
+
+def test_token_rate_limiter():
+    limiter = TokenRateLimiter(per_minute=600)
+    assert limiter.try_take(500) == 0
+    assert limiter.try_take(200) == pytest.approx(10, abs=0.5)
+
+
+@pytest.mark.asyncio
+async def test_chat_completion_over_http(fake_openai, monkeypatch):
+    """call_llm ходит в сервер по HTTP, usage из ответа попадает в учёт"""
+    server = fake_openai(latency="fixed:20")
+    monkeypatch.setattr(h.llm_cache, "ENABLED", False)
+    recorded = []
+    real_record = h.usage.record
+    monkeypatch.setattr(h.usage, "record", lambda *a, **k: recorded.append(a) or real_record(*a, **k))
+
+    text, latency_ms = await h.call_llm("gpt-4.1", "Ты — Planner-агент. Вопрос", temperature=0.2)
+
+    assert '"draft"' in text
+    assert latency_ms >= 20
+    assert recorded and recorded[0][1] > 0 and recorded[0][2] > 0
+    assert server.app.state.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_streaming_and_429_retry(fake_openai, monkeypatch):
+    """Стрим приходит по кусочкам; инъекция 429 повторяется с Retry-After"""
+    server = fake_openai(completion_tokens=5, rate_429=0.5, retry_after=0.01, seed=3)
+    monkeypatch.setattr(h.llm_cache, "ENABLED", False)
+    monkeypatch.setattr(h.config.config, "_cache", {**h.config.config._cache, "LLM_RETRY_MAX": "10"})
+
+    text, _ = await h.call_llm("gpt-4.1", "вопрос", temperature=0.2)
+    assert text == "ответ ответ ответ ответ ответ"
+    assert server.app.state.requests == 2  # первый ответ — 429 (seed=3)
+
+    server.app.state.profile.rate_429 = 0
+    deltas = [d async for d in h.call_llm_stream("gpt-4.1", "вопрос")]
+    assert len(deltas) == 5
+
+
+@pytest.mark.asyncio
+async def test_embeddings_over_http(fake_openai, monkeypatch):
+    """Пул эмбеддингов получает из сервера те же векторы, что и stub-режим"""
+    fake_openai()
+    monkeypatch.setattr(embedding_pool.EmbeddingPool, "_get_cache", lambda self: _no_cache())
+    try:
+        vec = await embedding_pool.get_embedding_async("вектор по HTTP")
+    finally:
+        await embedding_pool.stop()
+    expected = embedding_pool.stub_vectors(["вектор по HTTP"])[0]
+    assert vec == pytest.approx(expected.tolist(), abs=1e-6)
+
+
+async def _no_cache():
+    return None
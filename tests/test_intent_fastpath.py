@@ -0,0 +1,107 @@
+"""
+Локальный классификатор интента: правила, центроиды и обращение к LLM только ниже порога
+"""
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from agents import dialog_manager, intent_fastpath
+from backend import config, metrics
+
+
+@pytest.mark.parametrize("q, intent", [
+    ("Привет!", "small_talk"),
+    ("спасибо большое", "small_talk"),
+    ("Пришли, пожалуйста, чек-лист аудита", "file"),
+    ("нужен pdf с политикой", "file"),
+    ("У тебя же было про настройку SIEM", "kb_search"),
+])
+def test_rules(q, intent):
+    guess = intent_fastpath.classify_rules(q)
+    assert guess.intent == intent and guess.source == "rule"
+
+
+@pytest.mark.parametrize("q", ["Привет, как защитить файлы от утечки через почту?", "Как настроить DLP?"])
+def test_rules_leave_analytic_questions(q):
+    assert intent_fastpath.classify_rules(q) is None
+
+
+@pytest.fixture
+def axis_embeddings(monkeypatch):
+    """Эмбеддинг примера — орт своего интента; запрос задаётся тестом"""
+    axis = {t: i for i, intent in enumerate(intent_fastpath.INTENTS) for t in intent_fastpath.INTENT_EXAMPLES[intent]}
+    queries = {}
+
+    async def embed(text, timeout=None):
+        vec = np.zeros(8, dtype=np.float32)
+        if text in axis:
+            vec[axis[text]] = 1.0
+        else:
+            vec[:4] = queries[text]
+        return vec.tolist()
+
+    monkeypatch.setattr(intent_fastpath.embedding_pool, "get_embedding_async", embed)
+    monkeypatch.setattr(intent_fastpath, "_centroids", None)
+    monkeypatch.setattr(intent_fastpath, "_centroid_task", None)
+    return queries
+
+
+@pytest.mark.asyncio
+async def test_centroid_confident_skips_llm(axis_embeddings, monkeypatch):
+    """Запрос рядом с центроидом request классифицируется локально, без LLM"""
+    axis_embeddings["Как выстроить SOC?"] = [0.05, 0.0, 0.1, 0.95]
+
+    async def llm(*args):
+        pytest.fail("LLM classifier must not run above threshold")
+
+    monkeypatch.setattr(dialog_manager, "_classify_intent_llm", llm)
+    monkeypatch.setattr(dialog_manager.random, "random", lambda: 1.0)
+    centroid = metrics.INTENT_FASTPATH.labels(source="centroid")
+    before = centroid._value.get()
+
+    intent, conf = await dialog_manager._classify_intent("Как выстроить SOC?", {})
+
+    assert intent == "request" and conf >= 0.85
+    assert centroid._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_ambiguous_query_goes_to_llm(axis_embeddings, monkeypatch):
+    """Ниже порога решает LLM, совпадение с локальным ответом идёт в метрику согласия"""
+    axis_embeddings["Что-то про DLP и файлы"] = [0.0, 0.6, 0.0, 0.62]
+
+    async def llm(q, slots):
+        return "request", 0.8
+
+    monkeypatch.setattr(dialog_manager, "_classify_intent_llm", llm)
+    agree = metrics.INTENT_AGREEMENT.labels(result="agree")
+    before = agree._value.get()
+
+    assert await dialog_manager._classify_intent("Что-то про DLP и файлы", {}) == ("request", 0.8)
+    assert agree._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_slow_centroid_build_falls_back_to_llm(monkeypatch):
+    """Медленная сборка центроидов не задерживает ход дольше INTENT_FASTPATH_TIMEOUT_SEC; сборка продолжается в фоне"""
+    async def slow_embed(text, timeout=None):
+        await asyncio.sleep(0.3)
+        return [1.0, 0.0, 0.0, 0.0]
+
+    async def llm(q, slots):
+        return "request", 0.8
+
+    monkeypatch.setattr(intent_fastpath.embedding_pool, "get_embedding_async", slow_embed)
+    monkeypatch.setattr(intent_fastpath, "_centroids", None)
+    monkeypatch.setattr(intent_fastpath, "_centroid_task", None)
+    monkeypatch.setattr(dialog_manager, "_classify_intent_llm", llm)
+    monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "INTENT_FASTPATH_TIMEOUT_SEC": "0.05"})
+
+    started = time.monotonic()
+    assert await dialog_manager._classify_intent("Как выстроить SOC?", {}) == ("request", 0.8)
+    assert time.monotonic() - started < 0.2
+
+    await intent_fastpath._centroid_task
+    assert intent_fastpath._centroids is not None
@@ -1,5 +1,7 @@
 import pytest
 import asyncio
+import time
+from types import SimpleNamespace
 from unittest.mock import Mock, AsyncMock, patch
 from backend.agents.kb_search import kb_search, SIM_HARD, SIM_SOFT
 
@@ -11,6 +13,13 @@ class MockHit:
         self.payload = payload
 
 
+def points_of(search):
+    """Оборачивает мок поиска (список попаданий) в ответ query_points"""
+    async def query_points(collection_name, query, limit):
+        return SimpleNamespace(points=await search(collection_name, query, limit))
+    return query_points
+
+
 def test_reuse(monkeypatch):
     """Тест сценария reuse - когда найден очень похожий диалог"""
     
@@ -18,15 +27,15 @@ def test_reuse(monkeypatch):
     async def mock_get_async_vec(query):
         return [0.1, 0.2, 0.3]  # Dummy vector
     
-    # Мокаем qdr.search для возврата высокого score
-    def mock_search(collection_name, query_vector, limit):
+    # Мокаем aqdr.query_points для возврата высокого score
+    async def mock_search(collection_name, query, limit):
         if collection_name == "dialogs":
             return [MockHit(0.98, {"answer": "Это готовый ответ из диалогов"})]
         return []
     
     # Применяем моки
     monkeypatch.setattr("backend.agents.kb_search.get_async_vec", mock_get_async_vec)
-    monkeypatch.setattr("backend.agents.kb_search.qdr.search", mock_search)
+    monkeypatch.setattr("backend.agents.kb_search.aqdr.query_points", points_of(mock_search))
     
     # Запускаем тест
     status, result = asyncio.run(kb_search("повтори"))
@@ -43,8 +52,8 @@ def test_escalate_low_score(monkeypatch):
     async def mock_get_async_vec(query):
         return [0.1, 0.2, 0.3]
     
-    # Мокаем qdr.search для возврата низкого score
-    def mock_search(collection_name, query_vector, limit):
+    # Мокаем aqdr.query_points для возврата низкого score
+    async def mock_search(collection_name, query, limit):
         if collection_name == "dialogs":
             return [MockHit(0.5, {"question": "Похожий вопрос", "answer": "Похожий ответ"})]
         elif collection_name == "docs":
@@ -53,7 +62,7 @@ def test_escalate_low_score(monkeypatch):
     
     # Применяем моки
     monkeypatch.setattr("backend.agents.kb_search.get_async_vec", mock_get_async_vec)
-    monkeypatch.setattr("backend.agents.kb_search.qdr.search", mock_search)
+    monkeypatch.setattr("backend.agents.kb_search.aqdr.query_points", points_of(mock_search))
     
     # Запускаем тест
     status, context = asyncio.run(kb_search("новый вопрос"))
@@ -73,8 +82,8 @@ def test_escalate_with_similar_dialogs(monkeypatch):
     async def mock_get_async_vec(query):
         return [0.1, 0.2, 0.3]
     
-    # Мокаем qdr.search
-    def mock_search(collection_name, query_vector, limit):
+    # Мокаем aqdr.query_points
+    async def mock_search(collection_name, query, limit):
         if collection_name == "dialogs":
             return [
                 MockHit(0.75, {"question": "Похожий вопрос 1", "answer": "Ответ 1"}),
@@ -87,7 +96,7 @@ def test_escalate_with_similar_dialogs(monkeypatch):
     
     # Применяем моки
     monkeypatch.setattr("backend.agents.kb_search.get_async_vec", mock_get_async_vec)
-    monkeypatch.setattr("backend.agents.kb_search.qdr.search", mock_search)
+    monkeypatch.setattr("backend.agents.kb_search.aqdr.query_points", points_of(mock_search))
     
     # Запускаем тест
     status, context = asyncio.run(kb_search("вопрос средней похожести"))
@@ -104,13 +113,13 @@ def test_dynamic_k_calculation():
     async def mock_get_async_vec(query):
         return [0.1, 0.2, 0.3]
     
-    def mock_search(collection_name, query_vector, limit):
+    async def mock_search(collection_name, query, limit):
         # Проверяем, что limit соответствует ожидаемому k
         assert limit == 5  # max(3, min(10, 1500 // 400)) = max(3, min(10, 3)) = max(3, 3) = 3, но мы ожидаем 5 для 2000 tokens
         return []
     
     with patch("backend.agents.kb_search.get_async_vec", mock_get_async_vec):
-        with patch("backend.agents.kb_search.qdr.search", mock_search):
+        with patch("backend.agents.kb_search.aqdr.query_points", points_of(mock_search)):
             # Тест с большим expected_tokens
             asyncio.run(kb_search("тест", expected_tokens=2000))
 
@@ -122,8 +131,8 @@ def test_collection_error_handling(monkeypatch):
     async def mock_get_async_vec(query):
         return [0.1, 0.2, 0.3]
     
-    # Мокаем qdr.search для симуляции ошибки
-    def mock_search(collection_name, query_vector, limit):
+    # Мокаем aqdr.query_points для симуляции ошибки
+    async def mock_search(collection_name, query, limit):
         if collection_name == "dialogs":
             raise Exception("Collection not found")
         elif collection_name == "docs":
@@ -132,7 +141,7 @@ def test_collection_error_handling(monkeypatch):
     
     # Применяем моки
     monkeypatch.setattr("backend.agents.kb_search.get_async_vec", mock_get_async_vec)
-    monkeypatch.setattr("backend.agents.kb_search.qdr.search", mock_search)
+    monkeypatch.setattr("backend.agents.kb_search.aqdr.query_points", points_of(mock_search))
     
     # Запускаем тест
     status, context = asyncio.run(kb_search("тест ошибки"))
@@ -141,3 +150,42 @@ def test_collection_error_handling(monkeypatch):
     assert status == "escalate"
     assert context["similar_dialogs"] == []
     assert len(context["rag"]) == 1
+
+
+def test_searches_run_concurrently(monkeypatch):
+    """dialogs и docs ищутся одновременно; при reuse недоконченный поиск по docs отменяется"""
+
+    async def mock_get_async_vec(query):
+        return [0.1, 0.2, 0.3]
+
+    cancelled = []
+
+    async def mock_search(collection_name, query, limit):
+        try:
+            await asyncio.sleep(0.1 if collection_name == "dialogs" or query is not reuse_vec else 1)
+        except asyncio.CancelledError:
+            cancelled.append(collection_name)
+            raise
+        if collection_name == "dialogs":
+            return [MockHit(0.98 if query is reuse_vec else 0.7, {"answer": "готово"})]
+        return [MockHit(0.8, {"text": "Документация"})]
+
+    reuse_vec = [0.9]
+    monkeypatch.setattr("backend.agents.kb_search.get_async_vec", mock_get_async_vec)
+    monkeypatch.setattr("backend.agents.kb_search.aqdr.query_points", points_of(mock_search))
+
+    async def run():
+        started = time.monotonic()
+        status, context = await kb_search("новый вопрос")
+        elapsed = time.monotonic() - started
+        assert status == "escalate" and len(context["rag"]) == 1
+        assert elapsed < 0.18  # два поиска по 0.1 с — не 0.2 с
+
+        monkeypatch.setattr("backend.agents.kb_search.get_async_vec", AsyncMock(return_value=reuse_vec))
+        started = time.monotonic()
+        assert await kb_search("повтори") == ("reuse", "готово")
+        assert time.monotonic() - started < 0.5
+        await asyncio.sleep(0)
+        assert cancelled == ["docs"]
+
+    asyncio.run(run())
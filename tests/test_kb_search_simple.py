@@ -4,7 +4,7 @@
 """
 import pytest
 from unittest.mock import patch, AsyncMock
-from qdrant_client.http.models import ScoredPoint
+from qdrant_client.http.models import QueryResponse, ScoredPoint
 
 # Поскольку мы тестируем из корня проекта, нужно добавить backend в путь
 import sys
@@ -17,7 +17,7 @@ from backend.agents.kb_search import kb_search
     "Какие существуют угрозы безопасности?",
     "Как защититься от фишинга?"
 ])
-@patch('backend.agents.kb_search.qdr')
+@patch('backend.agents.kb_search.aqdr')
 @patch('backend.agents.kb_search.get_async_vec', new_callable=AsyncMock)
 async def test_dialog_search_mocked(mock_get_async_vec, mock_qdr, question: str):
     """Тестируем логику kb_search с моками для внешних зависимостей."""
@@ -28,9 +28,9 @@ async def test_dialog_search_mocked(mock_get_async_vec, mock_qdr, question: str)
 
     # 2. Настраиваем мок для клиента Qdrant, который ищет в базе
     # Возвращаем пример найденной точки
-    mock_qdr.search.return_value = [
+    mock_qdr.query_points = AsyncMock(return_value=QueryResponse(points=[
         ScoredPoint(id='some-uuid', version=1, score=0.95, payload={'answer': 'Mocked answer', 'question': question})
-    ]
+    ]))
 
     # 3. Вызываем тестируемую функцию
     status, result = await kb_search(question)
@@ -41,5 +41,5 @@ async def test_dialog_search_mocked(mock_get_async_vec, mock_qdr, question: str)
 
     # 5. Убедимся, что наши моки были вызваны
     mock_get_async_vec.assert_awaited_once_with(question)
-    mock_qdr.search.assert_called_once()
+    assert mock_qdr.query_points.await_count == 2  # dialogs и docs запускаются одновременно
 
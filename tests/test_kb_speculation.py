@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+import pytest
+
+from agents import dialog_manager
+from backend import config, metrics
+
+test_logger = logging.getLogger("test_kb_speculation")
+
+
+@pytest.fixture
+def slow_pipeline(monkeypatch):
+    """Классификация и kb_search по 0.2 с; планировщик сразу отдаёт черновик."""
+    calls = {"kb_started": 0, "kb_cancelled": 0}
+
+    async def kb_search(q):
+        calls["kb_started"] += 1
+        try:
+            await asyncio.sleep(0.2)
+        except asyncio.CancelledError:
+            calls["kb_cancelled"] += 1
+            raise
+        return "escalate", {"similar_dialogs": [], "rag": []}
+
+    async def ask_planner(tid, user_q, slots, logger):
+        return {"need_clarify": False, "need_escalate": False, "draft": "черновик"}
+
+    async def stream_llm(*args, **kwargs):
+        return "Здравствуйте!", None
+
+    monkeypatch.setattr(dialog_manager, "kb_search", kb_search)
+    monkeypatch.setattr("backend.agents.planner.ask_planner", ask_planner)
+    monkeypatch.setattr(dialog_manager, "stream_llm", stream_llm)
+    return calls
+
+
+def _classifier(intent, monkeypatch):
+    async def classify(q, slots):
+        await asyncio.sleep(0.2)
+        return intent, 0.9
+    monkeypatch.setattr(dialog_manager, "_classify_intent", classify)
+
+
+@pytest.mark.asyncio
+async def test_request_overlaps_search_with_classification(slow_pipeline, monkeypatch):
+    """kb_search идёт параллельно с классификацией: ход занимает ~0.2 с, а не 0.4 с"""
+    _classifier("request", monkeypatch)
+    used = metrics.KB_SPECULATION.labels(result="used")
+    saved = metrics.KB_SPECULATION_SECONDS.labels(kind="saved")
+    used_before, saved_before = used._value.get(), saved._value.get()
+
+    started = asyncio.get_running_loop().time()
+    out = await dialog_manager.handle_message("t-spec", "Как выстроить SOC?", {}, test_logger)
+    elapsed = asyncio.get_running_loop().time() - started
+
+    assert out["content"] == "черновик"
+    assert elapsed < 0.35
+    assert slow_pipeline["kb_started"] == 1
+    assert used._value.get() - used_before == 1
+    assert saved._value.get() - saved_before == pytest.approx(0.2, abs=0.08)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("intent,q,slots", [("small_talk", "Как дела?", {}),
+                                            ("file", "Что там по документу?", {"file_key": "dlp.pdf"})])
+async def test_search_cancelled_when_not_needed(slow_pipeline, monkeypatch, intent, q, slots):
+    """small_talk и file с ключом файла отменяют начатый поиск и списывают его в wasted"""
+    _classifier(intent, monkeypatch)
+
+    async def get_file_link(key):
+        return {"type": "file", "url": key}
+
+    monkeypatch.setattr("backend.agents.file_retrieval.get_file_link", get_file_link)
+    cancelled = metrics.KB_SPECULATION.labels(result="cancelled")
+    before = cancelled._value.get()
+
+    await dialog_manager.handle_message("t-spec", q, slots, test_logger)
+    await asyncio.sleep(0)
+
+    assert slow_pipeline["kb_cancelled"] == 1
+    assert cancelled._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_disabled_runs_sequentially(slow_pipeline, monkeypatch):
+    """KB_SPECULATIVE=0: поиск стартует только после классификации"""
+    monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "KB_SPECULATIVE": "0"})
+    _classifier("small_talk", monkeypatch)
+
+    await dialog_manager.handle_message("t-spec", "Привет", {}, test_logger)
+
+    assert slow_pipeline["kb_started"] == 0
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("q", ["Привет!", "Спасибо большое", "Пришли PDF с политикой ИБ"])
+async def test_rule_hit_skips_speculation(slow_pipeline, monkeypatch, q):
+    """Интент по правилу fast-path известен сразу — поиск (и запрос эмбеддинга) не стартует"""
+    _classifier("small_talk", monkeypatch)
+
+    await dialog_manager.handle_message("t-spec", q, {}, test_logger)
+
+    assert slow_pipeline["kb_started"] == 0
@@ -0,0 +1,54 @@
+"""
+call_llm не блокирует event loop: параллельные сессии идут одновременно
+"""
+import asyncio
+import time
+
+import pytest
+
+import backend.openai_helpers as h
+
+
+@pytest.fixture
+def slow_client(live_llm, monkeypatch):
+    """Каждый chat-completion отвечает через 0.2 с"""
+    client = live_llm((0.2, " ответ "))
+    monkeypatch.setattr(h, "_get_client", lambda: pytest.fail("sync client must not be used"))
+    monkeypatch.setattr(h.llm_cache, "_get_redis", lambda: None)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_do_not_block_loop(slow_client):
+    """Пять одновременных вызовов укладываются во время одного, loop не «замирает»"""
+    lags = []
+
+    async def ticker():
+        loop = asyncio.get_running_loop()
+        while True:
+            t = loop.time()
+            await asyncio.sleep(0.01)
+            lags.append(loop.time() - t - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    started = time.perf_counter()
+    try:
+        results = await asyncio.gather(*(h.call_llm("gpt-4.1", f"вопрос {i}") for i in range(5)))
+    finally:
+        tick.cancel()
+    elapsed = time.perf_counter() - started
+
+    assert [r for r, _ in results] == ["ответ"] * 5
+    assert elapsed < 0.5
+    assert max(lags) < 0.1
+
+
+@pytest.mark.asyncio
+async def test_per_call_timeout(slow_client):
+    """Таймаут передаётся в запрос: явный, иначе LLM_TIMEOUT_SEC"""
+    await h.call_llm("o3-mini", "ping", timeout=7)
+    await h.call_llm("o3-mini", "pong")
+    # таймаут запроса — остаток бюджета вызова
+    assert slow_client.calls[0]["timeout"] == pytest.approx(7, abs=0.1)
+    assert slow_client.calls[1]["timeout"] == pytest.approx(h.config.config.LLM_TIMEOUT_SEC, abs=0.1)
+    assert "temperature" not in slow_client.calls[0]
@@ -0,0 +1,122 @@
+"""
+Кеш ответов LLM: детерминированные вызовы не уходят в API повторно
+"""
+import pytest
+
+import backend.openai_helpers as h
+from backend import llm_cache, metrics
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+        self.ttls[key] = ex
+
+
+@pytest.fixture
+def client(live_llm):
+    """Ответы нумеруются: «ответ N» — N-й запрос к API"""
+    client = live_llm(lambda params: f"ответ {len(client.calls)}")
+    return client
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    r = FakeRedis()
+    monkeypatch.setattr(llm_cache, "_get_redis", lambda: r)
+    return r
+
+
+@pytest.mark.asyncio
+async def test_temperature_zero_is_cached(client, fake_redis):
+    """Повторный вызов с temperature=0 на месте из SITE_TTLS берётся из LRU, счётчики по модели растут"""
+    hits = metrics.LLM_CACHE.labels(model="gpt-4.1-mini", tier="memory", result="hit")
+    before = hits._value.get()
+
+    first, _ = await h.call_llm("gpt-4.1-mini", "оцени: привет", temperature=0, site="critic")
+    second, _ = await h.call_llm("gpt-4.1-mini", "оцени: привет", temperature=0, site="critic")
+
+    assert first == second == "ответ 1"
+    assert len(client.calls) == 1
+    assert hits._value.get() - before == 1
+    assert list(fake_redis.ttls.values()) == [llm_cache.SITE_TTLS["critic"]]
+
+
+@pytest.mark.asyncio
+async def test_redis_tier_survives_lru_flush(client, fake_redis):
+    """После сброса LRU ответ читается из Redis, а не из API"""
+    await h.call_llm("gpt-4.1-mini", "оцени ответ", temperature=0, site="critic")
+    llm_cache.flush_local()
+    again, _ = await h.call_llm("gpt-4.1-mini", "оцени ответ", temperature=0, site="critic")
+    assert again == "ответ 1"
+    assert len(client.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_nonzero_temperature_not_cached_unless_opted_in(client, fake_redis):
+    """temperature>0 не кешируется, пока вызывающий явно не попросит cache=True"""
+    await h.call_llm("o3-mini", "поболтаем", temperature=0.5)
+    await h.call_llm("o3-mini", "поболтаем", temperature=0.5)
+    assert len(client.calls) == 2
+
+    await h.call_llm("o3-mini", "поболтаем", temperature=0.5, cache=True)
+    await h.call_llm("o3-mini", "поболтаем", temperature=0.5, cache=True)
+    assert len(client.calls) == 3
+
+
+def test_key_depends_on_model_tools_and_temperature():
+    base = llm_cache.policy("o3-mini", "q", None, 0, cache=True)
+    assert base.key == llm_cache.policy("o3-mini", "q", None, 0, cache=True).key
+    assert base.key != llm_cache.policy("gpt-4.1", "q", None, 0, cache=True).key
+    assert base.key != llm_cache.policy("o3-mini", "q", [{"type": "function"}], 0, cache=True).key
+    assert base.key != llm_cache.policy("o3-mini", "q", None, 0.2, cache=True).key
+    assert llm_cache.policy("o3-mini", "q", None, 0, cache=False) is None
+
+
+def test_temperature_rule_limited_to_listed_sites_and_non_reasoning():
+    """Без cache=True: только места вызова из SITE_TTLS и не o-серия (она игнорирует temperature)"""
+    assert llm_cache.policy("gpt-4.1-mini", "q", None, 0, site="critic") is not None
+    assert llm_cache.policy("gpt-4.1-mini", "q", None, 0, site="small_talk") is None
+    assert llm_cache.policy("gpt-4.1-mini", "q", None, 0) is None
+    assert llm_cache.policy("o3-mini", "q", None, 0, site="critic") is None
+    assert llm_cache.policy("o3-mini", "q", None, 0, site="critic", cache=True) is not None
+
+
+@pytest.mark.asyncio
+async def test_stream_cache_keyed_by_model_actually_used(client, fake_redis, monkeypatch):
+    """Ответ пониженной на мягком лимите модели не отдаётся из кеша сессиям без лимита"""
+    from backend import token_budget
+
+    level = {"now": token_budget.SOFT}
+    used = []
+
+    async def enforce():
+        return level["now"]
+
+    async def call_llm_stream(model, prompt, routed=None, **kwargs):
+        used.append(routed)
+        yield f"ответ {routed}"
+
+    async def sink(delta):
+        pass
+
+    monkeypatch.setattr(token_budget, "enforce", enforce)
+    monkeypatch.setattr(h, "call_llm_stream", call_llm_stream)
+    token = h.partial_sink.set(sink)
+    try:
+        soft, _ = await h.stream_llm("gpt-4.1", "план", temperature=0, site="planner")
+        level["now"] = token_budget.OK
+        full, _ = await h.stream_llm("gpt-4.1", "план", temperature=0, site="planner")
+        again, _ = await h.stream_llm("gpt-4.1", "план", temperature=0, site="planner")
+    finally:
+        h.partial_sink.reset(token)
+
+    assert used == [token_budget.downgrade("gpt-4.1"), "gpt-4.1"]
+    assert soft != full == again == "ответ gpt-4.1"
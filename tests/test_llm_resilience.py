@@ -0,0 +1,127 @@
+"""
+Бюджеты, повторы и хеджирование вызовов LLM
+"""
+import asyncio
+import collections
+import time
+
+import httpx
+import openai
+import pytest
+
+import backend.openai_helpers as h
+from backend import deadline, metrics
+
+
+def _rate_limited(retry_after: str) -> openai.RateLimitError:
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return openai.RateLimitError("rate limited", response=response, body=None)
+
+
+@pytest.fixture
+def use_client(live_llm, monkeypatch):
+    """live_llm по сценарию: исключение или (задержка, ответ); кеш выключен, окна роутера пустые"""
+    monkeypatch.setattr(h.llm_cache, "ENABLED", False)
+    monkeypatch.setattr(h.model_router, "stats", collections.defaultdict(h.model_router.ModelStats))
+    return live_llm
+
+
+@pytest.mark.asyncio
+async def test_transient_error_retried_within_budget(use_client):
+    """429 с коротким Retry-After повторяется, счётчик повторов растёт"""
+    client = use_client(_rate_limited("0.01"), (0, "готово"))
+    retries = metrics.LLM_RETRIES.labels(model="gpt-4.1", reason="429")
+    before = retries._value.get()
+
+    text, _ = await h.call_llm("gpt-4.1", "вопрос", site="planner")
+
+    assert text == "готово"
+    assert len(client.calls) == 2
+    assert retries._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_no_retry_past_budget(use_client):
+    """Retry-After дольше остатка бюджета — ошибка сразу, без ожидания"""
+    use_client(_rate_limited("30"), (0, "поздно"))
+    started = time.monotonic()
+    with pytest.raises(openai.RateLimitError):
+        await h.call_llm("gpt-4.1", "вопрос", timeout=2)
+    assert time.monotonic() - started < 1
+
+
+@pytest.mark.asyncio
+async def test_turn_deadline_caps_call(use_client):
+    """Дедлайн хода урезает бюджет вызова, даже если бюджет места вызова больше"""
+    use_client((5, "не успеет"))
+    started = time.monotonic()
+    with deadline.budget(0.2):
+        with pytest.raises(asyncio.TimeoutError):
+            await h.call_llm("gpt-4.1", "вопрос", site="planner")
+        await asyncio.sleep(0.25)
+        with pytest.raises(asyncio.TimeoutError):
+            await h.call_llm("gpt-4.1", "ещё вопрос")
+    assert time.monotonic() - started < 1
+    assert deadline.remaining() is None
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_wins_after_p95(use_client):
+    """Для o3-mini после p95 уходит второй запрос, побеждает быстрый"""
+    client = use_client((2, "медленный"), (0.01, "быстрый"))
+    for _ in range(30):
+        h.model_router.stats["o3-mini"].add(0.05)
+    won = metrics.LLM_HEDGE.labels(model="o3-mini", result="hedge_won")
+    before = won._value.get()
+
+    started = time.monotonic()
+    text, _ = await h.call_llm("o3-mini", "классифицируй", site="intent")
+
+    assert text == "быстрый"
+    assert len(client.calls) == 2
+    assert time.monotonic() - started < 0.5
+    assert won._value.get() - before == 1
+
+
+@pytest.mark.asyncio
+async def test_handle_message_sets_turn_deadline(monkeypatch):
+    """handle_message задаёт дедлайн хода, вложенные вызовы его видят"""
+    import logging
+    from agents import dialog_manager
+    seen = []
+
+    async def classify(q, slots):
+        seen.append(deadline.remaining())
+        return "small_talk", 1.0
+
+    async def small_talk(*args, **kwargs):
+        return "привет", 0
+
+    monkeypatch.setattr(dialog_manager, "_classify_intent", classify)
+    monkeypatch.setattr(dialog_manager, "stream_llm", small_talk)
+    monkeypatch.setattr(dialog_manager.status_bus, "publish", lambda *a: asyncio.sleep(0))
+
+    await dialog_manager.handle_message("t", "привет", {}, logging.getLogger("test"))
+
+    assert seen[0] is not None
+    assert 0 < seen[0] <= h.config.config.TURN_BUDGET_SEC
+    assert deadline.remaining() is None
+
+
+@pytest.mark.asyncio
+async def test_cancel_before_hedge_aborts_primary(use_client):
+    """Отмена вызывающего до срабатывания хеджа гасит и основной запрос"""
+    client = use_client((5, "никому не нужен"))
+    for _ in range(30):
+        h.model_router.stats["o3-mini"].add(1.0)
+
+    task = asyncio.create_task(h.call_llm("o3-mini", "классифицируй", site="intent"))
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    await asyncio.sleep(0.01)
+
+    assert len(client.calls) == 1
+    assert not [t for t in asyncio.all_tasks() if "_timed_create" in repr(t.get_coro())]
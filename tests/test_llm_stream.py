@@ -0,0 +1,141 @@
+"""
+Стриминг ответа LLM: call_llm_stream → stream_llm → chat_stream (type="chunk")
+"""
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+
+import backend.openai_helpers as h
+from backend.json_utils import JsonFieldStreamer
+
+
+def test_json_field_streamer_handles_split_escapes():
+    """Поле draft достаётся из JSON, порезанного в любых местах, включая escape-последовательности"""
+    raw = json.dumps({"need_clarify": False, "draft": 'Шаг 1:\n"DLP" «ок»', "plan": ["x"]}, ensure_ascii=True)
+    for size in (1, 3, 7):
+        streamer = JsonFieldStreamer("draft")
+        out = "".join(streamer.feed(raw[i:i + size]) for i in range(0, len(raw), size))
+        assert out == 'Шаг 1:\n"DLP" «ок»'
+
+
+@pytest.mark.asyncio
+async def test_stream_llm_pushes_deltas_to_sink(live_llm):
+    """Дельты уходят в partial_sink по мере прихода, возвращается полный текст"""
+    client = live_llm(["Здрав", "ствуйте", "!"])
+
+    received = []
+
+    async def sink(delta):
+        received.append(delta)
+
+    token = h.partial_sink.set(sink)
+    try:
+        text, _ = await h.stream_llm("o3-mini", "привет", temperature=0.5)
+    finally:
+        h.partial_sink.reset(token)
+
+    assert received == ["Здрав", "ствуйте", "!"]
+    assert text == "Здравствуйте!"
+    assert client.calls[0]["stream"] is True
+
+
+@pytest.mark.asyncio
+async def test_stream_usage_taken_from_final_chunk(live_llm, monkeypatch):
+    """Стрим запрашивает include_usage и пишет токены из последнего чанка"""
+    client = live_llm("ок", usage=(9, 1))
+    recorded = []
+    monkeypatch.setattr(h.usage, "record",
+                        lambda *args: recorded.append(args) or h.usage.UsageRecord(None, None, *args[:3]))
+
+    assert [d async for d in h.call_llm_stream("gpt-4.1", "привет")] == ["ок"]
+    assert client.calls[0]["stream_options"] == {"include_usage": True}
+    assert recorded[0][:3] == ("gpt-4.1", 9, 1)
+
+
+@pytest.mark.asyncio
+async def test_stream_ttft_kept_out_of_completion_stats(live_llm, monkeypatch):
+    """TTFT стрима — в своё окно; окно полной задержки (хедж, SLO роутера) стрим не трогает"""
+    import collections
+    from backend import model_router
+
+    live_llm((0.2, ["первый ", "второй"]))
+    monkeypatch.setattr(model_router, "stats", collections.defaultdict(model_router.ModelStats))
+
+    assert [d async for d in h.call_llm_stream("gpt-4.1", "привет")] == ["первый ", "второй"]
+
+    [(_, ok, seconds)] = model_router.stats[("gpt-4.1", "ttft")]._window()
+    assert ok and seconds < 0.1
+    assert model_router.stats["gpt-4.1"]._window() == []
+
+
+@pytest.mark.asyncio
+async def test_cancelled_stream_closes_upstream(live_llm):
+    """Отмена чтения стрима закрывает соединение с API, а не оставляет его дочитываться"""
+    client = live_llm((10, ["первый"]))
+    got = []
+
+    async def consume():
+        async for delta in h.call_llm_stream("gpt-4.1", "привет"):
+            got.append(delta)
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.05)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert got == ["первый"]
+    assert client.streams[0].closed
+
+
+@pytest.mark.asyncio
+async def test_offline_stream_passes_site_to_call_llm(monkeypatch):
+    """Stub-путь стрима зовёт call_llm с тем же site (роутинг, бюджет и кеш места вызова)"""
+    seen = {}
+
+    async def call_llm(model, prompt, **kwargs):
+        seen.update(kwargs)
+        return "раз два", 1
+
+    monkeypatch.setattr(h, "call_llm", call_llm)
+
+    assert [d async for d in h.call_llm_stream("gpt-4.1", "привет", site="planner", timeout=5)] == ["раз ", "два"]
+    assert seen["site"] == "planner" and seen["timeout"] == 5
+
+
+async def empty_listen(thread_id):
+    if False:
+        yield
+
+
+@pytest.mark.asyncio
+@patch('backend.chat_core.get_mem', lambda tid: {})
+@patch('backend.chat_core.get_current_thread_messages', lambda tid: [])
+@patch('backend.chat_core.save_dialog_full', lambda tid, msgs: None)
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_chat_stream_emits_chunks_before_final(monkeypatch):
+    """chat_stream отдаёт chunk-сообщения до финального chat"""
+    from backend import chat_core
+
+    async def streaming_handler(tid, msg, slots, logger):
+        text, _ = await h.stream_llm("o3-mini", "Ты — Planner-агент",
+                                     visible=JsonFieldStreamer("draft").feed)
+        return {"type": "chat", "role": "assistant", "content": json.loads(text)["draft"]}
+
+    monkeypatch.setattr(chat_core, "handle_message", streaming_handler)
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    await in_q.put(json.dumps({"message": "как настроить DLP"}))
+    await in_q.put(None)
+
+    await chat_core.chat_stream("stream-thread", in_q, out_q)
+
+    messages = []
+    while (m := out_q.get_nowait()) is not None:
+        messages.append(m)
+    chunks = [m for m in messages if m["type"] == "chunk"]
+    assert len(chunks) > 1
+    assert messages[-1]["type"] == "chat"
+    assert "".join(c["content"] for c in chunks) == messages[-1]["content"]
+    assert h.partial_sink.get() is None
@@ -0,0 +1,66 @@
+import time
+import numpy as np
+from unittest.mock import patch
+
+from backend.lru_cache import LRUCache
+
+
+def test_lru_evicts_by_bytes():
+    """Самые старые записи вытесняются при превышении лимита в байтах"""
+    cache = LRUCache(max_bytes=3 * 4 * 10)
+    for i in range(4):
+        cache.put(f"k{i}", np.zeros(10, dtype=np.float32))
+    assert cache.get("k0") is None
+    assert cache.get("k3") is not None
+    assert cache.bytes == 3 * 40
+    assert cache.evictions == 1
+
+
+def test_lru_recently_used_survives():
+    """Обращение к записи продлевает ей жизнь в LRU"""
+    cache = LRUCache(max_bytes=20)
+    cache.put("a", b"x" * 10)
+    cache.put("b", b"x" * 10)
+    cache.get("a")
+    cache.put("c", b"x" * 10)
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+
+
+def test_lru_ttl_expiry():
+    """Записи с истёкшим TTL считаются промахом"""
+    cache = LRUCache(max_bytes=100, ttl=10)
+    cache.put("a", b"abc")
+    with patch("backend.lru_cache.time.monotonic", return_value=time.monotonic() + 11):
+        assert cache.get("a") is None
+    assert cache.misses == 1
+    assert cache.bytes == 0
+
+
+def test_embedding_memory_tier_skips_redis():
+    """Повторный запрос эмбеддинга обслуживается из памяти, без обращения к Redis"""
+    from backend import embedding
+
+    class CountingDict(dict):
+        reads = 0
+        def get(self, key, default=None):
+            CountingDict.reads += 1
+            return super().get(key, default)
+
+    cache = CountingDict()
+    with patch.object(embedding, "_r", cache):
+        first = embedding.get("частый вопрос")
+        reads_after_first = CountingDict.reads
+        second = embedding.get("частый вопрос")
+    assert first == second
+    assert CountingDict.reads == reads_after_first
+    assert embedding.flush_local_cache() == 1
+
+
+def test_flush_endpoint(client):
+    """Админ-хук сбрасывает LRU эмбеддингов"""
+    from backend import embedding
+    embedding._mem_put("emb:test:1", [0.5, 0.5])
+    response = client.post("/admin/cache/embeddings/flush")
+    assert response.status_code == 200
+    assert response.json() == {"flushed": 1}
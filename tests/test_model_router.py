@@ -0,0 +1,114 @@
+"""
+Роутер моделей: fallback при деградации p95/ошибок, явные цепочки и веса стоимости
+"""
+import collections
+
+import pytest
+
+import backend.openai_helpers as h
+from backend import model_router
+
+
+@pytest.fixture(autouse=True)
+def fresh_stats(monkeypatch):
+    monkeypatch.setattr(model_router, "stats", collections.defaultdict(model_router.ModelStats))
+
+
+def _set(monkeypatch, **values):
+    monkeypatch.setattr(model_router.config.config, "_cache", {**model_router.config.config._cache, **values})
+
+
+def test_primary_kept_while_healthy():
+    """Без статистики и при нормальной задержке остаётся модель вызывающего"""
+    for _ in range(30):
+        model_router.stats["o3-mini"].add(0.5)
+    assert model_router.route("intent", "o3-mini") == "o3-mini"
+    assert model_router.chain("intent", "o3-mini") == ["o3-mini", "gpt-4.1-mini"]
+
+
+def test_latency_spike_shifts_to_fallback():
+    """p95 выше половины бюджета места вызова (intent: 8 с) — трафик уходит на fallback"""
+    for _ in range(30):
+        model_router.stats["o3-mini"].add(6.0)
+    assert model_router.degraded("o3-mini", "intent")
+    assert model_router.route("intent", "o3-mini") == "gpt-4.1-mini"
+
+
+def test_error_rate_degrades_model():
+    for _ in range(15):
+        model_router.stats["gpt-4.1"].add(1.0)
+    for _ in range(10):
+        model_router.stats["gpt-4.1"].add_error()
+    assert model_router.route("planner", "gpt-4.1") == "gpt-4.1-mini"
+
+
+def test_explicit_route_and_cost_weight(monkeypatch):
+    """ROUTE_<CLASS> задаёт цепочку; ROUTER_COST_WEIGHT сдвигает выбор к дешёвой здоровой модели"""
+    _set(monkeypatch, ROUTE_PLAN="gpt-4.1,gpt-4.1-mini")
+    assert model_router.route("planner", "o3-mini") == "gpt-4.1"
+    _set(monkeypatch, ROUTE_PLAN="gpt-4.1,gpt-4.1-mini", ROUTER_COST_WEIGHT="1")
+    assert model_router.route("planner", "o3-mini") == "gpt-4.1-mini"
+
+
+def test_all_degraded_picks_fastest():
+    for _ in range(30):
+        model_router.stats["o3-mini"].add(7.0)
+        model_router.stats["gpt-4.1-mini"].add(5.0)
+    assert model_router.route("intent", "o3-mini") == "gpt-4.1-mini"
+
+
+@pytest.mark.asyncio
+async def test_call_llm_uses_routed_model(live_llm, monkeypatch):
+    """call_llm отправляет запрос в выбранную роутером модель и пишет исход в её окно"""
+    client = live_llm("ок")
+    monkeypatch.setattr(h.llm_cache, "ENABLED", False)
+    for _ in range(30):
+        model_router.stats["gpt-4.1"].add_error()
+
+    await h.call_llm("gpt-4.1", "вопрос", site="planner")
+
+    assert [c["model"] for c in client.calls] == ["gpt-4.1-mini"]
+    assert len(model_router.stats["gpt-4.1-mini"]._samples) == 1
+
+
+def test_degraded_primary_recovers_after_window(monkeypatch):
+    """Исходы старше ROUTER_WINDOW_SEC забываются — трафик возвращается на восстановившийся primary"""
+    now = [1000.0]
+    monkeypatch.setattr(model_router.time, "monotonic", lambda: now[0])
+    _set(monkeypatch, ROUTER_WINDOW_SEC="300")
+    for _ in range(30):
+        model_router.stats["o3-mini"].add(6.0)
+    assert model_router.route("intent", "o3-mini") == "gpt-4.1-mini"
+
+    now[0] += 301
+    assert not model_router.degraded("o3-mini", "intent")
+    assert model_router.route("intent", "o3-mini") == "o3-mini"
+
+
+def test_expert_gc_agent_calls_feed_router_stats(monkeypatch):
+    """Вызовы агентов autogen (мимо call_llm) пишут задержки и ошибки в окно модели агента"""
+    autogen = pytest.importorskip("autogen")
+    import openai
+    from openai.types.chat import ChatCompletion
+    from backend.agents import expert_gc
+
+    outcomes = iter([None, RuntimeError("503")])
+
+    def create(self, **params):
+        if (error := next(outcomes)) is not None:
+            raise error
+        return ChatCompletion.model_validate({
+            "id": "c1", "object": "chat.completion", "created": 0, "model": params["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ок"}}],
+        })
+
+    monkeypatch.setattr(openai.resources.chat.completions.Completions, "create", create)
+    monkeypatch.setattr("autogen.oai.client.LEGACY_DEFAULT_CACHE_SEED", None)
+    agent = autogen.AssistantAgent("Critic", llm_config={"model": "gpt-4-turbo"})
+    expert_gc._AgentMeter().attach(agent)
+
+    agent.client.create(messages=[{"role": "user", "content": "вопрос"}])
+    with pytest.raises(Exception):
+        agent.client.create(messages=[{"role": "user", "content": "вопрос"}])
+
+    assert [ok for _, ok, _ in model_router.stats["gpt-4-turbo"]._window()] == [True, False]
@@ -231,6 +231,68 @@ class TestPerformance:
         assert max_response_time < 5.0  # Max response under 5 seconds
         assert total_time < 15.0  # Total time under 15 seconds
 
+class TestFakeOpenAIBenchmarks:
+    """Сквозные замеры через локальный OpenAI-совместимый сервер (scripts/fake_openai.py) без сети"""
+
+    @pytest.mark.slow
+    @pytest.mark.asyncio
+    async def test_concurrent_llm_calls_share_pool(self, fake_openai, monkeypatch):
+        """50 параллельных call_llm при задержке 100 мс укладываются примерно в одну задержку"""
+        import asyncio
+        from backend import llm_cache
+        from backend.openai_helpers import call_llm
+
+        fake_openai(latency="fixed:100")
+        monkeypatch.setattr(llm_cache, "ENABLED", False)
+
+        start_time = time.time()
+        results = await asyncio.gather(*(call_llm("gpt-4.1", f"вопрос {i}", temperature=0.2) for i in range(50)))
+        total_time = time.time() - start_time
+
+        latencies = sorted(latency for _, latency in results)
+        print(f"Fake OpenAI LLM - 50 calls in {total_time:.2f}s, "
+              f"p50: {latencies[25]}ms, p95: {latencies[47]}ms")
+        assert total_time < 2.0
+
+    @pytest.mark.slow
+    @pytest.mark.asyncio
+    async def test_embedding_batching_throughput(self, fake_openai):
+        """200 параллельных эмбеддингов уходят батчами, а не 200 запросами"""
+        import asyncio
+        from backend import embedding_pool
+
+        server = fake_openai(latency="lognormal:50:0.3")
+        start_time = time.time()
+        try:
+            vectors = await asyncio.gather(*(embedding_pool.get_embedding_async(f"benchmark text {i}")
+                                             for i in range(200)))
+        finally:
+            await embedding_pool.stop()
+        total_time = time.time() - start_time
+
+        print(f"Fake OpenAI embeddings - 200 texts in {total_time:.2f}s, "
+              f"{server.app.state.requests} HTTP requests")
+        assert all(len(v) > 0 for v in vectors)
+        assert server.app.state.requests < 50
+
+    @pytest.mark.slow
+    @pytest.mark.asyncio
+    async def test_rate_limited_server_is_survived(self, fake_openai, monkeypatch):
+        """При 20% инъекции 429 и 5% ошибок 5xx повторы доводят вызовы до ответа"""
+        import asyncio
+        from backend import config, llm_cache
+        from backend.openai_helpers import call_llm
+
+        fake_openai(latency="uniform:10:50", rate_429=0.2, error_rate=0.05, retry_after=0.05, seed=7)
+        monkeypatch.setattr(llm_cache, "ENABLED", False)
+        monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "LLM_RETRY_MAX": "6"})
+
+        results = await asyncio.gather(*(call_llm("gpt-4.1", f"вопрос {i}", temperature=0.2) for i in range(30)),
+                                       return_exceptions=True)
+        failures = [r for r in results if isinstance(r, Exception)]
+        print(f"Fake OpenAI resilience - {len(results) - len(failures)}/30 succeeded")
+        assert len(failures) <= 1
+
 class TestStressTests:
     """Stress tests for system limits"""
     
@@ -21,7 +21,7 @@ async def test_build_plan_parses_json_correctly():
     mock_call_llm = AsyncMock(return_value=(json.dumps(mock_response, ensure_ascii=False), 100))
 
     # Вызываем функцию с моком
-    with patch('backend.agents.planner.call_llm', mock_call_llm):
+    with patch('backend.agents.planner.stream_llm', mock_call_llm):
         logger = MagicMock()
         plan = await _build_plan("какой-то вопрос", {}, logger)
 
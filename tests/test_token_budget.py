@@ -0,0 +1,154 @@
+"""
+Бюджет токенов на сессию/IP: мягкий лимит понижает модель, жёсткий — ошибка в WS
+"""
+import asyncio
+import json
+import logging
+from unittest.mock import patch
+
+import pytest
+
+import backend.openai_helpers as h
+from backend import token_budget
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    """Локальный бюджет (без Redis) с лимитом сессии 100 токенов"""
+    b = token_budget.TokenBudget()
+    b._redis_initialized = True
+    monkeypatch.setattr(token_budget, "budget", b)
+    monkeypatch.setattr(token_budget, "session_limit", lambda: 100)
+    return b
+
+
+@pytest.mark.asyncio
+async def test_levels_follow_session_usage(budget):
+    """ok → soft после 80% → hard на лимите; IP считается отдельно"""
+    assert await budget.check("s1", "10.0.0.1") == token_budget.OK
+    await budget.charge("s1", "10.0.0.1", 85)
+    assert await budget.check("s1", "10.0.0.1") == token_budget.SOFT
+    await budget.charge("s1", "10.0.0.1", 15)
+    with pytest.raises(token_budget.TokenBudgetExceeded) as exc:
+        await budget.check("s1", "10.0.0.1")
+    assert exc.value.scope == "session"
+    assert await budget.check("s2", "10.0.0.1") == token_budget.OK
+    assert (await budget.used("s2", "10.0.0.1"))["ip"] == 100
+
+
+@pytest.mark.asyncio
+async def test_soft_limit_downgrades_model(budget, live_llm):
+    """На мягком лимите call_llm уходит в дешёвую модель, расход списывается из usage"""
+    client = live_llm("ок", usage=(3, 2))
+    await budget.charge("soft-session", None, 90)
+
+    token = token_budget.current_scope.set(("soft-session", None))
+    try:
+        await h.call_llm("gpt-4.1", "вопрос", temperature=0.3)
+        assert token_budget.soft_limited()
+    finally:
+        token_budget.current_scope.reset(token)
+
+    assert [c["model"] for c in client.calls] == ["gpt-4.1-mini"]
+    assert (await budget.used("soft-session", None))["session"] == 95
+
+
+async def empty_listen(thread_id):
+    if False:
+        yield
+
+
+@pytest.mark.asyncio
+@patch('backend.chat_core.get_mem', lambda tid: {})
+@patch('backend.chat_core.get_current_thread_messages', lambda tid: [])
+@patch('backend.chat_core.save_dialog_full', lambda tid, msgs: None)
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_hard_limit_rejects_turn(budget, monkeypatch):
+    """Исчерпанный бюджет отклоняет ход с понятной ошибкой, handle_message не вызывается"""
+    from backend import chat_core
+
+    async def handler(*args):
+        pytest.fail("handle_message must not run over budget")
+
+    monkeypatch.setattr(chat_core, "handle_message", handler)
+    await budget.charge("spent-thread", "10.0.0.2", 100)
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    await in_q.put(json.dumps({"message": "ещё вопрос"}))
+    await in_q.put(None)
+
+    await chat_core.chat_stream("spent-thread", in_q, out_q, client_ip="10.0.0.2")
+
+    msg = await out_q.get()
+    assert msg["type"] == "error"
+    assert "лимит токенов" in msg["content"]
+
+
+@pytest.mark.asyncio
+@patch('backend.chat_core.get_mem', lambda tid: {})
+@patch('backend.chat_core.get_current_thread_messages', lambda tid: [])
+@patch('backend.chat_core.save_dialog_full', lambda tid, msgs: None)
+@patch('backend.status_bus.listen', lambda tid: empty_listen(tid))
+async def test_limits_apply_inside_coalesced_turn(budget, monkeypatch):
+    """Склейка вопросов (COALESCE_ENABLED=1) не отключает мягкий и жёсткий лимит внутри хода"""
+    from backend import chat_core, config
+
+    monkeypatch.setattr(config.config, "_cache", {**config.config._cache, "COALESCE_ENABLED": "1"})
+    seen = []
+
+    async def handler(thread_id, user_q, slots, logger):
+        await token_budget.enforce()
+        seen.append(token_budget.soft_limited())
+        await token_budget.charge(10)
+        await token_budget.enforce()  # второй вызов LLM в том же ходе — уже за лимитом
+        return {"type": "chat", "role": "assistant", "content": "не должно дойти"}
+
+    monkeypatch.setattr(chat_core, "handle_message", handler)
+    await budget.charge("coalesced-thread", "10.0.0.3", 90)
+    in_q, out_q = asyncio.Queue(), asyncio.Queue()
+    await in_q.put(json.dumps({"message": "вопрос"}))
+    await in_q.put(None)
+
+    await chat_core.chat_stream("coalesced-thread", in_q, out_q, client_ip="10.0.0.3")
+
+    assert seen == [True]
+    msg = await out_q.get()
+    assert msg["type"] == "error"
+    assert "лимит токенов" in msg["content"]
+
+
+@pytest.mark.asyncio
+async def test_expert_gc_charges_agents_and_stops_at_limit(budget, monkeypatch):
+    """Ответы агентов autogen списываются с бюджета хода; за лимитом следующий раунд не начинается"""
+    import openai
+    from openai.types.chat import ChatCompletion
+    from backend import status_bus
+    from backend.agents import expert_gc
+
+    calls = []
+
+    def create(self, **params):
+        calls.append(params["model"])
+        return ChatCompletion.model_validate({
+            "id": f"c{len(calls)}", "object": "chat.completion", "created": 0, "model": params["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": f"реплика {len(calls)}"}}],
+            "usage": {"prompt_tokens": 50, "completion_tokens": 10, "total_tokens": 60},
+        })
+
+    monkeypatch.setattr(openai.resources.chat.completions.Completions, "create", create)
+    monkeypatch.setattr("autogen.oai.client.LEGACY_DEFAULT_CACHE_SEED", None)  # без DiskCache в .cache/
+    monkeypatch.setattr(status_bus, "_redis_pub", None)
+
+    await budget.charge("gc-session", None, 50)
+
+    token = token_budget.current_scope.set(("gc-session", None))
+    try:
+        with pytest.raises(token_budget.TokenBudgetExceeded):
+            await expert_gc.run_expert_gc("gc-session", "вопрос", {}, {"context": {"plan": []}},
+                                          logging.getLogger("test_token_budget"))
+    finally:
+        token_budget.current_scope.reset(token)
+
+    # Ответ эксперта (60 токенов) списан перед следующим раундом; 110 из 100 — группа остановлена
+    assert len(calls) == 1
+    assert (await budget.used("gc-session", None))["session"] == 110
@@ -0,0 +1,41 @@
+"""
+Подсчёт токенов: реестр токенизаторов по моделям, батч-подсчёт, целые результаты
+"""
+from unittest.mock import patch
+
+import pytest
+
+from backend import token_counter
+from backend.token_counter import count_tokens, count_tokens_many, count_messages_tokens
+
+
+@pytest.mark.parametrize("model,encoding", [
+    ("gpt-4.1", "o200k_base"),
+    ("gpt-4.1-mini", "o200k_base"),
+    ("4.1-mini", "o200k_base"),
+    ("o3-mini", "o200k_base"),
+    ("gpt-4-turbo", "cl100k_base"),
+    ("text-embedding-3-small", "cl100k_base"),
+])
+def test_encoding_per_model_family(model, encoding):
+    assert token_counter._encoding_name(model) == encoding
+
+
+def test_encoder_loaded_once_per_model():
+    """Повторные вызовы не обращаются к tiktoken.get_encoding — в том числе после неудачи"""
+    token_counter.get_encoder.cache_clear()
+    try:
+        with patch.object(token_counter.tiktoken, "get_encoding", side_effect=OSError("offline")) as get:
+            for _ in range(3):
+                assert count_tokens("привет мир", "o3-mini") == 3
+        get.assert_called_once_with("o200k_base")
+    finally:
+        token_counter.get_encoder.cache_clear()
+
+
+def test_results_are_integers():
+    texts = ["Политика ИБ", "", "DLP и SIEM <|endoftext|>"]
+    counts = count_tokens_many(texts, "gpt-4.1")
+    assert all(type(c) is int for c in counts)
+    assert counts == [count_tokens(t, "gpt-4.1") for t in texts]
+    assert type(count_messages_tokens([{"role": "user", "content": "привет"}], "gpt-4.1")) is int
@@ -0,0 +1,81 @@
+"""
+Учёт токенов: usage из ответа API, thread/turn из контекста хода, пакетная запись в SQLite
+"""
+import asyncio
+
+import pytest
+
+import backend.openai_helpers as h
+from backend import usage
+
+
+@pytest.fixture
+def written(monkeypatch):
+    """Перехватывает пачки, уходящие в chat_db.log_usage_many"""
+    batches = []
+    monkeypatch.setattr("backend.chat_db.log_usage_many", lambda records: batches.append(list(records)))
+    usage._drain()
+    return batches
+
+
+@pytest.fixture
+def real_client(live_llm, monkeypatch):
+    """Ответ с usage, как у настоящего API"""
+    client = live_llm("ответ", usage=(11, 7))
+    monkeypatch.setattr(h.llm_cache, "_get_redis", lambda: None)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_call_llm_records_api_usage_for_current_turn(real_client, written, monkeypatch):
+    """Токены берутся из usage ответа, без локальной токенизации; thread/turn — из контекста"""
+    monkeypatch.setattr(h, "count_tokens_many", lambda *a, **k: pytest.fail("must not tokenize locally"))
+    token = usage.current_turn.set(("t-usage", 3))
+    try:
+        await h.call_llm("gpt-4.1", "вопрос об учёте", temperature=0.3)
+    finally:
+        usage.current_turn.reset(token)
+
+    assert written == []  # запись не на пути запроса
+    assert await usage.flush() == 1
+    rec = written[0][0]
+    assert (rec.thread_id, rec.turn_index, rec.model) == ("t-usage", 3, "gpt-4.1")
+    assert (rec.prompt_tokens, rec.completion_tokens) == (11, 7)
+
+
+@pytest.mark.asyncio
+async def test_records_are_batched(written, monkeypatch):
+    """Записи копятся и уходят одной пачкой по таймеру или при достижении FLUSH_MAX"""
+    monkeypatch.setattr(usage, "FLUSH_INTERVAL", 0.05)
+    monkeypatch.setattr(usage, "FLUSH_MAX", 1000)
+    for i in range(5):
+        usage.record("gpt-4.1", 10, i, thread_id="t-batch", turn_index=i)
+    assert written == []
+    await asyncio.sleep(0.15)
+    assert [len(b) for b in written] == [5]
+
+    monkeypatch.setattr(usage, "FLUSH_MAX", 3)
+    for i in range(3):
+        usage.record("gpt-4.1", 1, 1)
+    await asyncio.sleep(0.01)
+    assert [len(b) for b in written] == [5, 3]
+
+
+def test_log_usage_many_writes_meta_rows_hidden_from_history(tmp_path, monkeypatch):
+    """Строки учёта пишутся как role=meta и не попадают в историю диалога"""
+    import json
+    import sqlite3
+    from backend import chat_db
+
+    monkeypatch.setattr(chat_db, "DB_PATH", tmp_path / "chat.db")
+    with sqlite3.connect(chat_db.DB_PATH) as c:
+        c.execute("""CREATE TABLE chatlog(id INTEGER PRIMARY KEY AUTOINCREMENT, thread_id TEXT,
+                     turn_index INT, role TEXT, content TEXT, model TEXT, latency_ms INT,
+                     intent TEXT, ts DATETIME DEFAULT CURRENT_TIMESTAMP)""")
+    chat_db.log_message("t-db", 0, "user", "привет")
+    chat_db.log_usage_many([usage.UsageRecord("t-db", 0, "gpt-4.1", 5, 2, 120)])
+
+    with sqlite3.connect(chat_db.DB_PATH) as c:
+        content, model = c.execute("SELECT content, model FROM chatlog WHERE role='meta'").fetchone()
+    assert json.loads(content)["total_tokens"] == 7 and model == "gpt-4.1"
+    assert chat_db.get_current_thread_messages("t-db") == [{"role": "user", "content": "привет"}]